@@ -0,0 +1,132 @@
+# encoding:utf-8
+"""
+TaskScheduler 热路径的微基准, 与 run.py 使用同样的替身
+
+    python benchmarks/micro.py --output micro.json
+
+- message: on_handle_context 处理一条消息, 包括与任务无关的聊天消息和其他插件的命令
+- fire: 任务触发时的 dispatch.prepare(改写事件、匹配 custom_commands 并生成回复), 以及其中单独的匹配与指标分组
+- trigger: 添加任务时根据周期与时间生成 Trigger
+结果为每次调用的纳秒数(多轮中最快的一轮), 可以用来比较不同版本
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+from run import DEFAULT_OVERRIDES, PLUGIN_DIR, Harness, git_revision, merge
+
+
+def bench(func, number, repeat):
+    timer = timeit.Timer(func)
+    return round(min(timer.repeat(repeat=repeat, number=number)) / number * 1e9, 1)
+
+
+def message_context(harness, text):
+    """与 Harness.handle 相同的消息, 只构造一次, 计时只包含 on_handle_context"""
+    from bridge.context import Context, ContextType
+    from channel.chat_message import ChatMessage
+    from plugins import Event, EventContext
+
+    msg = ChatMessage({})
+    msg.is_group = True
+    msg.other_user_id = "@@g0"
+    msg.other_user_nickname = "群0"
+    msg.actual_user_id = "@u0"
+    msg.actual_user_nickname = "用户0"
+    return EventContext(Event.ON_HANDLE_CONTEXT, {"context": Context(ContextType.TEXT, text, {"msg": msg})})
+
+
+def job_payload(harness, i, text):
+    _, content = harness.handle(i, f"{harness.command} {text}")
+    task_id = content.rsplit(" ", 1)[-1]
+    return harness.plugin.scheduler.get_job(task_id).args[0]
+
+
+def run(args):
+    harness = Harness(args.workdir, args.overrides)
+    harness.start()
+    from plugins.TaskScheduler import dispatch
+    from plugins.TaskScheduler.commands import command_table
+    from plugins.TaskScheduler.metrics import task_labels
+    from plugins.TaskScheduler.records import TaskRecord
+
+    plugin = harness.plugin
+    result = {"message": {}, "fire": {}, "trigger": {}}
+    for name, text in (
+        ("chat", "今天天气怎么样, 晚上一起吃饭吗"),
+        ("other_plugin", "$tool 早报"),
+        ("task_prefix_only", f"{harness.command}x"),
+    ):
+        e_context = message_context(harness, text)
+        result["message"][name] = bench(lambda: plugin.on_handle_context(e_context), args.number, args.repeat)
+
+    # 任务不会真正触发, 只调用 prepare; 替身 channel 的 send 不在计时之内
+    payloads = {
+        "text": job_payload(harness, 0, "每天 08:00 提醒开会"),
+        "custom_command": job_payload(harness, 1, "每天 08:00 点歌 晴天"),
+        "broadcast": job_payload(harness, 2, "每天 08:00 提醒开会 group[群1,群2,群3,群4]"),
+    }
+    fire_number = max(args.number // 10, 1)
+    for name, payload in payloads.items():
+        result["fire"][f"prepare_{name}"] = bench(lambda: dispatch.prepare(payload), fire_number, args.repeat)
+    for name, payload in payloads.items():
+        event = TaskRecord.decode(payload).event
+        result["fire"][f"match_{name}"] = bench(lambda: command_table().match(event), args.number, args.repeat)
+    record = TaskRecord.decode(payloads["custom_command"])
+    result["fire"]["task_labels"] = bench(lambda: task_labels(record), args.number, args.repeat)
+
+    for name, (cycle, time_str) in (
+        ("daily", ("每天", "08:30")),
+        ("weekly", ("每周三", "09:00")),
+        ("cron", ("cron[30 8 * * 1-5]", None)),
+        ("relative", ("明天", "10:00")),
+    ):
+        result["trigger"][name] = bench(
+            lambda: plugin.get_trigger(cycle, time_str), fire_number, args.repeat
+        )
+    harness.plugin.scheduler.remove_all_jobs()
+    harness.stop()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TaskScheduler 热路径微基准")
+    parser.add_argument("--output", help="结果 JSON 的保存路径, 默认输出到 stdout")
+    parser.add_argument("--override", default="{}", help="覆盖 config.json 的 JSON")
+    parser.add_argument("--number", type=int, default=20000, help="每轮调用次数, prepare 与 Trigger 为其十分之一")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    args.overrides = merge(json.loads(json.dumps(DEFAULT_OVERRIDES)), json.loads(args.override))
+
+    args.workdir = tempfile.mkdtemp(prefix="taskscheduler-micro-")
+    try:
+        shutil.copytree(
+            PLUGIN_DIR,
+            os.path.join(args.workdir, "plugins", "TaskScheduler"),
+            ignore=shutil.ignore_patterns(".git", "benchmarks", "tests", "tasks.db*", "__pycache__"),
+        )
+        report = {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "unit": "ns/op",
+            "results": run(args),
+        }
+    finally:
+        shutil.rmtree(args.workdir, ignore_errors=True)
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
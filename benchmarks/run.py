@@ -0,0 +1,380 @@
+# encoding:utf-8
+"""
+TaskScheduler 离线性能测试, 不需要 chatgpt-on-wechat 与微信登录
+
+    python benchmarks/run.py --sizes 1000 10000 100000 --output bench.json
+
+benchmarks/stubs 里是 channel/bridge/plugins/config/lib.itchat 的替身
+每个规模分两个进程运行:
+- populate: 通过 on_handle_context 添加任务, 记录 add_task 的延迟
+- measure: 重新启动插件, 记录启动时间、重载插件的耗时、任务列表/添加/取消的延迟、批量触发的延迟与内存
+插件代码会被复制到临时目录运行, 不会改动插件目录里的 tasks.db
+结果为 JSON, 可以用来比较不同版本
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.dirname(BENCH_DIR)
+STUBS_DIR = os.path.join(BENCH_DIR, "stubs")
+PACKAGE = "plugins.TaskScheduler"
+
+GROUPS = 200
+USERS = 50
+WEEKDAYS = "一二三四五六日"
+
+# 不限流、不错峰, 测的是插件本身
+DEFAULT_OVERRIDES = {"rate_limit": {"global_rate": 0, "per_chat_rate": 0}, "jitter_window": 0}
+
+
+def percentiles(samples):
+    """毫秒"""
+    if not samples:
+        return {"n": 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000, 3)
+
+    return {
+        "n": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": pick(0.5),
+        "p90_ms": pick(0.9),
+        "p99_ms": pick(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def memory():
+    with open("/proc/self/statm") as f:
+        rss_pages = int(f.read().split()[1])
+    return {
+        "rss_mb": round(rss_pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def merge(base, overrides):
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+class Harness:
+    """在 worker 进程里加载替身与插件, 构造消息并调用插件"""
+
+    def __init__(self, workdir, overrides):
+        sys.path.insert(0, STUBS_DIR)
+        import config
+        import plugins
+        from lib import itchat
+
+        plugins.__path__.append(os.path.join(workdir, "plugins"))
+        with open(os.path.join(workdir, "plugins", "TaskScheduler", "config.json"), encoding="utf-8") as f:
+            plugin_config = merge(json.load(f), overrides)
+        config.plugin_config["TaskScheduler"] = plugin_config
+        self.command = f"{config.conf()['plugin_trigger_prefix']}{plugin_config.get('command_prefix', 'time')}"
+        itchat.chatrooms[:] = [{"NickName": f"群{i}", "UserName": f"@@g{i}"} for i in range(GROUPS)]
+        itchat.friends[:] = [{"NickName": f"用户{i}", "RemarkName": "", "UserName": f"@u{i}"} for i in range(USERS)]
+
+        from channel.channel_factory import create_channel
+        from plugins.TaskScheduler.task_scheduler import TaskScheduler
+
+        self.plugin_class = TaskScheduler
+        self.channel = create_channel("wx")
+        self.plugin = None
+
+    def start(self):
+        started = time.perf_counter()
+        self.plugin = self.plugin_class()
+        return time.perf_counter() - started
+
+    def reload(self):
+        """
+        与 scanp 一样 importlib.reload 插件包与它的每个模块, 再创建新的插件对象, 返回耗时
+        调度器应当沿用, 重新创建了(比如某个单例在重载后丢失)时抛出 RuntimeError
+        """
+        scheduler = self.plugin.scheduler
+        started = time.perf_counter()
+        importlib.reload(sys.modules[PACKAGE])
+        for name in [name for name in sys.modules if name.startswith(PACKAGE + ".")]:
+            importlib.reload(sys.modules[name])
+        self.plugin_class = sys.modules[PACKAGE + ".task_scheduler"].TaskScheduler
+        self.plugin = self.plugin_class()
+        elapsed = time.perf_counter() - started
+        if self.plugin.scheduler is not scheduler or not scheduler.running:
+            raise RuntimeError("插件重载后调度器被重新创建")
+        return elapsed
+
+    def stop(self):
+        # 与进程退出时一样显式关闭调度器, 下一次 start 重新加载所有任务
+        from plugins.TaskScheduler.service import scheduler_service
+
+        self.plugin = None
+        scheduler_service.shutdown()
+
+    def handle(self, i, text):
+        """以第 i 个会话的身份发送一条消息, 返回 (耗时, 回复内容)"""
+        from bridge.context import Context, ContextType
+        from channel.chat_message import ChatMessage
+        from plugins import Event, EventContext
+
+        user = i % USERS
+        msg = ChatMessage({})
+        msg.ctype = ContextType.TEXT
+        msg.content = text
+        msg.from_user_id = f"@u{user}"
+        msg.from_user_nickname = f"用户{user}"
+        msg.to_user_id = "bot"
+        msg.to_user_nickname = "bot"
+        msg.actual_user_id = f"@u{user}"
+        msg.actual_user_nickname = f"用户{user}"
+        # 十分之一的任务在私聊中创建
+        msg.is_group = i % 10 != 9
+        if msg.is_group:
+            msg.other_user_id = f"@@g{i % GROUPS}"
+            msg.other_user_nickname = f"群{i % GROUPS}"
+        else:
+            msg.other_user_id = msg.from_user_id
+            msg.other_user_nickname = msg.from_user_nickname
+        e_context = EventContext(
+            Event.ON_HANDLE_CONTEXT, {"context": Context(ContextType.TEXT, text, {"msg": msg})}
+        )
+        started = time.perf_counter()
+        self.plugin.on_handle_context(e_context)
+        elapsed = time.perf_counter() - started
+        reply = e_context.econtext.get("reply")
+        return elapsed, reply.content if reply is not None else None
+
+    def add_command(self, i):
+        hour, minute = (i // 60) % 24, i % 60
+        kind = i % 5
+        if kind == 0:
+            return f"{self.command} 每天 {hour:02d}:{minute:02d} 提醒{i}"
+        if kind == 1:
+            return f"{self.command} 工作日 {hour:02d}:{minute:02d} 打卡{i}"
+        if kind == 2:
+            return f"{self.command} 每周{WEEKDAYS[i % 7]} {hour:02d}:{minute:02d} 周报{i}"
+        if kind == 3:
+            return f"{self.command} cron[{minute} {hour} * * *] 早报"
+        return f"{self.command} 明天 {hour:02d}:{minute:02d} 开会{i} group[群{(i * 7) % GROUPS}]"
+
+    def add(self, i):
+        elapsed, content = self.handle(i, self.add_command(i))
+        match = re.search(r"任务编号: (\w+)", content or "")
+        return elapsed, match.group(1) if match else None
+
+
+def populate(args):
+    harness = Harness(args.workdir, args.overrides)
+    harness.start()
+    latencies = []
+    ids = []
+    failures = 0
+    started = time.perf_counter()
+    for i in range(args.size):
+        elapsed, task_id = harness.add(i)
+        latencies.append(elapsed)
+        if task_id is None:
+            failures += 1
+        else:
+            ids.append(task_id)
+    harness.stop()
+    with open(os.path.join(args.workdir, "ids.json"), "w") as f:
+        json.dump(ids, f)
+    return {
+        "populate_seconds": round(time.perf_counter() - started, 3),
+        "populate_add": percentiles(latencies),
+        "populate_failures": failures,
+    }
+
+
+def measure(args):
+    with open(os.path.join(args.workdir, "ids.json")) as f:
+        ids = json.load(f)
+    rng = random.Random(args.seed)
+    harness = Harness(args.workdir, args.overrides)
+    result = {"memory_before_start": memory()}
+    result["startup_seconds"] = round(harness.start(), 3)
+    result["memory_after_start"] = memory()
+    result["reload"] = percentiles([harness.reload() for _ in range(args.reload_samples)])
+
+    # 任务列表: 在随机的会话里列出第一页
+    latencies = []
+    for _ in range(args.list_samples):
+        elapsed, _ = harness.handle(rng.randrange(args.size), f"{harness.command} 任务列表")
+        latencies.append(elapsed)
+    result["list"] = percentiles(latencies)
+
+    # 在已有 size 个任务的情况下添加, 再全部取消, 保持任务数不变
+    added = []
+    latencies = []
+    for i in range(args.size, args.size + args.op_samples):
+        elapsed, task_id = harness.add(i)
+        latencies.append(elapsed)
+        if task_id is not None:
+            added.append((i, task_id))
+    result["add"] = percentiles(latencies)
+    latencies = []
+    for i, task_id in added:
+        elapsed, _ = harness.handle(i, f"{harness.command} 取消任务 {task_id}")
+        latencies.append(elapsed)
+    result["cancel"] = percentiles(latencies)
+
+    # 批量触发: 暂停调度, 把一批任务的下次运行时间改为现在, 恢复调度后统计到 channel.send 的延迟
+    # 延迟从恢复调度的时刻算起, 不包含修改任务本身的耗时
+    fire_ids = rng.sample(ids, min(args.fire_count, len(ids)))
+    scheduler = harness.plugin.scheduler
+    harness.channel.send_delay = args.send_delay
+    from apscheduler.events import EVENT_JOB_MISSED
+
+    missed = []
+    scheduler.add_listener(lambda event: missed.append(event.job_id), EVENT_JOB_MISSED)
+    scheduler.pause()
+    now = datetime.now(timezone.utc)
+    for task_id in fire_ids:
+        scheduler.modify_job(task_id, next_run_time=now)
+    harness.channel.expect(len(fire_ids))
+    scheduled = time.time()
+    started = time.perf_counter()
+    scheduler.resume()
+    harness.channel.wait(args.fire_timeout)
+    elapsed = time.perf_counter() - started
+    sent = list(harness.channel.sent)
+    result["fire"] = {
+        "jobs": len(fire_ids),
+        "sent": len(sent),
+        # 限流或执行池排队导致的错过执行, 应当为 0
+        "missed": len(missed),
+        "seconds": round(elapsed, 3),
+        "throughput_per_second": round(len(sent) / elapsed, 1) if elapsed else None,
+        "lag": percentiles([max(sent_at - scheduled, 0.0) for sent_at, _, _ in sent]),
+    }
+    result["memory_after_fire"] = memory()
+    harness.stop()
+    return result
+
+
+def run_worker(phase, size, workdir, args):
+    result_path = os.path.join(workdir, f"{phase}.json")
+    command = [
+        sys.executable, os.path.abspath(__file__),
+        "--worker", phase,
+        "--workdir", workdir,
+        "--size", str(size),
+        "--result", result_path,
+        "--override", json.dumps(args.overrides, ensure_ascii=False),
+        "--list-samples", str(args.list_samples),
+        "--op-samples", str(args.op_samples),
+        "--reload-samples", str(args.reload_samples),
+        "--fire-count", str(args.fire_count),
+        "--fire-timeout", str(args.fire_timeout),
+        "--send-delay", str(args.send_delay),
+        "--seed", str(args.seed),
+    ]
+    if args.with_rate_limit:
+        command.append("--with-rate-limit")
+    subprocess.run(command, check=True)
+    with open(result_path) as f:
+        return json.load(f)
+
+
+def run_size(size, args):
+    workdir = tempfile.mkdtemp(prefix=f"taskscheduler-bench-{size}-")
+    try:
+        shutil.copytree(
+            PLUGIN_DIR,
+            os.path.join(workdir, "plugins", "TaskScheduler"),
+            ignore=shutil.ignore_patterns(".git", "benchmarks", "tests", "tasks.db*", "__pycache__"),
+        )
+        result = {"tasks": size}
+        result.update(run_worker("populate", size, workdir, args))
+        result["db_mb"] = round(
+            os.path.getsize(os.path.join(workdir, "plugins", "TaskScheduler", "tasks.db")) / 2 ** 20, 2
+        )
+        result.update(run_worker("measure", size, workdir, args))
+        return result
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "-C", PLUGIN_DIR, "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TaskScheduler 离线性能测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--output", help="结果 JSON 的保存路径, 默认输出到 stdout")
+    parser.add_argument("--override", default="{}", help="覆盖 config.json 的 JSON, 例如 '{\"executor\": {\"mode\": \"async\"}}'")
+    parser.add_argument("--list-samples", type=int, default=20)
+    parser.add_argument("--op-samples", type=int, default=200)
+    parser.add_argument("--reload-samples", type=int, default=5, help="插件重载的次数")
+    parser.add_argument("--fire-count", type=int, default=2000, help="批量触发的任务数")
+    parser.add_argument("--fire-timeout", type=float, default=300)
+    parser.add_argument("--send-delay", type=float, default=0.0, help="模拟每次 channel.send 的耗时(秒)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--with-rate-limit", action="store_true", help="使用 config.json 里的 rate_limit, 默认不限流"
+    )
+    parser.add_argument("--keep", action="store_true", help="保留临时目录")
+    parser.add_argument("--worker", choices=["populate", "measure"], help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    defaults = json.loads(json.dumps(DEFAULT_OVERRIDES))
+    if args.with_rate_limit:
+        defaults.pop("rate_limit")
+    args.overrides = merge(defaults, json.loads(args.override))
+
+    if args.worker:
+        result = populate(args) if args.worker == "populate" else measure(args)
+        with open(args.result, "w") as f:
+            json.dump(result, f)
+        return
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "overrides": args.overrides,
+        "results": [],
+    }
+    for size in args.sizes:
+        print(f"[bench] {size} 个任务...", file=sys.stderr)
+        report["results"].append(run_size(size, args))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+# encoding:utf-8
+from enum import Enum
+
+
+class ContextType(Enum):
+    TEXT = 1
+
+
+class Context:
+    def __init__(self, type: ContextType = None, content=None, kwargs=None):
+        self.type = type
+        self.content = content
+        self.kwargs = dict(kwargs or {})
+
+    def __contains__(self, key):
+        return key in self.kwargs
+
+    def __getitem__(self, key):
+        return self.kwargs[key]
+
+    def __setitem__(self, key, value):
+        self.kwargs[key] = value
+
+    def get(self, key, default=None):
+        return self.kwargs.get(key, default)
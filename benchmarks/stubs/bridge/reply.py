@@ -0,0 +1,15 @@
+# encoding:utf-8
+from enum import Enum
+
+
+class ReplyType(Enum):
+    TEXT = 1
+    VOICE = 2
+    IMAGE = 3
+    IMAGE_URL = 4
+
+
+class Reply:
+    def __init__(self, type: ReplyType = None, content=None):
+        self.type = type
+        self.content = content
@@ -0,0 +1,9 @@
+# encoding:utf-8
+from channel.chat_channel import ChatChannel
+
+_channel = ChatChannel()
+
+
+def create_channel(channel_type) -> ChatChannel:
+    # 与 chatgpt-on-wechat 一样, channel 是单例的
+    return _channel
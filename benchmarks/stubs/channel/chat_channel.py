@@ -0,0 +1,42 @@
+# encoding:utf-8
+import threading
+import time
+
+from bridge.context import Context
+
+
+class ChatChannel:
+    """
+    不联网的 channel: send 只记录 (发送时间, 内容, 接收者)
+    send_delay 模拟网络耗时, expect(n) 之后可以用 wait() 等待第 n 条发送
+    """
+
+    user_id = "bot"
+
+    def __init__(self):
+        self.send_delay = 0.0
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._expected = None
+        self.sent = []
+
+    def _compose_context(self, ctype, content, **kwargs):
+        kwargs.setdefault("receiver", kwargs["msg"].other_user_id)
+        return Context(ctype, content, kwargs)
+
+    def send(self, reply, context):
+        if self.send_delay:
+            time.sleep(self.send_delay)
+        with self._lock:
+            self.sent.append((time.time(), reply.content, context["receiver"]))
+            if self._expected is not None and len(self.sent) >= self._expected:
+                self._done.set()
+
+    def expect(self, count):
+        with self._lock:
+            self.sent = []
+            self._expected = count
+            self._done.clear()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
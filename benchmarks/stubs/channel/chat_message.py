@@ -0,0 +1,23 @@
+# encoding:utf-8
+
+
+class ChatMessage:
+    def __init__(self, _rawmsg):
+        self.msg_id = None
+        self.create_time = None
+        self.ctype = None
+        self.content = None
+        self.from_user_id = None
+        self.from_user_nickname = None
+        self.to_user_id = None
+        self.to_user_nickname = None
+        self.other_user_id = None
+        self.other_user_nickname = None
+        self.my_msg = False
+        self.self_display_name = None
+        self.is_group = False
+        self.is_at = False
+        self.actual_user_id = None
+        self.actual_user_nickname = None
+        self.at_list = None
+        self._rawmsg = _rawmsg
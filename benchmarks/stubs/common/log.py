@@ -0,0 +1,5 @@
+# encoding:utf-8
+import logging
+
+logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger("bench")
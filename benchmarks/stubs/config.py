@@ -0,0 +1,17 @@
+# encoding:utf-8
+"""chatgpt-on-wechat 的 config 模块的替身, 由 benchmarks/run.py 填充 plugin_config"""
+
+global_config = {
+    "channel_type": "wx",
+    "plugin_trigger_prefix": "$",
+    "single_chat_prefix": [""],
+}
+plugin_config = {}
+
+
+def conf():
+    return global_config
+
+
+def pconf(plugin_name: str) -> dict:
+    return plugin_config.get(plugin_name.lower()) or plugin_config.get(plugin_name)
@@ -0,0 +1,21 @@
+# encoding:utf-8
+"""itchat 通讯录的替身, 供插件的 WrappedChannelTools 使用, 由 benchmarks/run.py 填充"""
+
+chatrooms = []
+friends = []
+
+
+def get_chatrooms(update=False):
+    return list(chatrooms)
+
+
+def get_friends(update=False):
+    return list(friends)
+
+
+def search_chatrooms(name=None):
+    return [c for c in chatrooms if c["NickName"] == name]
+
+
+def search_friends(name=None):
+    return [f for f in friends if name in (f.get("RemarkName"), f.get("NickName"))]
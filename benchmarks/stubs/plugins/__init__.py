@@ -0,0 +1,8 @@
+# encoding:utf-8
+from .event import *
+from .plugin import *
+from .plugin_manager import PluginManager
+
+instance = PluginManager()
+
+register = instance.register
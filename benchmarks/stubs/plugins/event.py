@@ -0,0 +1,37 @@
+# encoding:utf-8
+from enum import Enum
+
+
+class Event(Enum):
+    ON_RECEIVE_MESSAGE = 1
+    ON_HANDLE_CONTEXT = 2
+    ON_DECORATE_REPLY = 3
+    ON_SEND_REPLY = 4
+
+
+class EventAction(Enum):
+    CONTINUE = 1
+    BREAK = 2
+    BREAK_PASS = 3
+
+
+class EventContext:
+    def __init__(self, event, econtext=None):
+        self.event = event
+        self.econtext = econtext if econtext is not None else {}
+        self.action = EventAction.CONTINUE
+
+    def __getitem__(self, key):
+        return self.econtext[key]
+
+    def __setitem__(self, key, value):
+        self.econtext[key] = value
+
+    def __delitem__(self, key):
+        del self.econtext[key]
+
+    def is_pass(self):
+        return self.action == EventAction.BREAK_PASS
+
+    def is_break(self):
+        return self.action == EventAction.BREAK or self.action == EventAction.BREAK_PASS
@@ -0,0 +1,15 @@
+# encoding:utf-8
+# 与 chatgpt-on-wechat 相同, 这些名字会随 from plugins import * 导出, 插件依赖这一点
+import json
+import os
+
+from common.log import logger
+from config import conf, pconf
+
+
+class Plugin:
+    def __init__(self):
+        self.handlers = {}
+
+    def load_config(self) -> dict:
+        return pconf(self.__class__.__name__)
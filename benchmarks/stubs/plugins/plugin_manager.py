@@ -0,0 +1,33 @@
+# encoding:utf-8
+from plugins.event import EventAction
+
+
+class PluginManager:
+    """
+    只保留插件需要的部分: pconf 开关与 emit_event
+    handler(e_context) 模拟其他插件的处理, 可以设置 plugin_delay 模拟耗时
+    """
+
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.pconf = {"plugins": {"TaskScheduler": {"enabled": True}}}
+            cls._instance.handler = None
+        return cls._instance
+
+    def register(self, name: str, desire_priority: int = 0, **kwargs):
+        def wrapper(plugincls):
+            plugincls.name = name
+            plugincls.priority = desire_priority
+            return plugincls
+
+        return wrapper
+
+    def emit_event(self, e_context, *args, **kwargs):
+        if self.handler is not None:
+            self.handler(e_context)
+            if e_context.action == EventAction.CONTINUE:
+                e_context.action = EventAction.BREAK_PASS
+        return e_context
@@ -0,0 +1,297 @@
+# encoding:utf-8
+import os
+import re
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+from apscheduler.job import Job
+from sqlalchemy import select
+
+from channel.chat_message import ChatMessage
+from common.log import logger
+
+from .catchup import MISFIRE_GRACE_TIME
+from .executors import route_pool
+from .listing import chat_key, index_many_op, index_t, index_values
+from .metrics import cycle_type
+from .preview import fire_preview
+from .records import TaskRecord
+from .runtime import runtime_state
+from .storage import insert_jobs
+
+# 导出命令最多回复的行数, 完整导出请使用 Python API
+EXPORT_REPLY_LIMIT = 200
+
+
+def parse_spec(text: str):
+    """
+    解析一条任务描述, 与添加任务的命令格式相同:
+    cycle time_str event [group[...]] 或 cron[* * * * *] event [group[...]]
+    返回 (cycle, time_str, event, group_name)
+    """
+    # 组名称必须以 group[组名称] 的形式出现, 且位于尾部
+    match = re.search(r"group\[(.*?)\]$", text)
+    group_name = match.group(1) if match else None
+    text = text.replace(f"group[{group_name}]", "").strip()
+
+    # 如果是 cron, 格式就是 cron[* * * * *] event_str
+    if text.startswith("cron["):
+        cron_end = text.find("]")
+        if cron_end == -1:
+            raise ValueError("指令格式错误，cron 表达式不完整")
+        return text[: cron_end + 1], None, text[cron_end + 1 :].strip(), group_name
+
+    # 否则就是普通周期和时间, 格式就是 cycle time_str event_str
+    parts = text.split(" ", 2)
+    if len(parts) != 3:
+        raise ValueError("指令格式错误")
+    return parts[0], parts[1], parts[2], group_name
+
+
+def format_spec(cycle: str, time_str: Optional[str], event: str, group_name: Optional[str]) -> str:
+    parts = [cycle]
+    if time_str and not cycle.startswith("cron["):
+        parts.append(time_str)
+    parts.append(event)
+    if group_name:
+        parts.append(f"group[{group_name}]")
+    return " ".join(parts)
+
+
+class ImportReport:
+    """一次导入的结果, errors 为 (行号, 原文, 错误) 列表"""
+
+    __slots__ = ("dry_run", "total", "valid", "added", "errors")
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.total = 0
+        self.valid = 0
+        # (行号, 任务编号)
+        self.added = []
+        self.errors = []
+
+    def summary(self, max_errors=20):
+        if self.dry_run:
+            lines = [f"导入预览: 共 {self.total} 行, 有效 {self.valid} 行, 错误 {len(self.errors)} 行"]
+        elif self.errors:
+            lines = [f"导入失败: 共 {self.total} 行, 错误 {len(self.errors)} 行, 没有导入任何任务"]
+        else:
+            lines = [f"导入完成: 已添加 {len(self.added)} 个任务"]
+        for lineno, line, error in self.errors[:max_errors]:
+            lines.append(f"第 {lineno} 行: {error}")
+            lines.append(f"  {line}")
+        if len(self.errors) > max_errors:
+            lines.append(f"... 还有 {len(self.errors) - max_errors} 行错误")
+        return "\n".join(lines)
+
+
+class _Spec:
+    __slots__ = ("lineno", "line", "cycle", "time_str", "event", "group_name", "trigger", "names")
+
+    def __init__(self, lineno, line, cycle, time_str, event, group_name, trigger, names):
+        self.lineno = lineno
+        self.line = line
+        self.cycle = cycle
+        self.time_str = time_str
+        self.event = event
+        self.group_name = group_name
+        # 同样的周期与时间是同一个 Trigger 对象, 见 triggers.build_trigger
+        self.trigger = trigger
+        # group[...] 展开后的群名, 没有指定 group 时为 None
+        self.names = names
+
+
+def read_lines(source) -> Iterable[str]:
+    """source 为文件路径、文件对象或逐行的字符串"""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, encoding="utf-8") as f:
+            yield from f
+    else:
+        yield from source
+
+
+def import_tasks(plugin, lines: Iterable[str], msg: Optional[ChatMessage] = None, dry_run=False) -> ImportReport:
+    """
+    批量添加任务, 每行一条任务描述, 空行与 # 开头的行忽略
+    - 先校验所有行, 同一个群名只查找一次; 任何一行有错误时不导入任何任务
+    - 所有任务与列表索引在一个事务里写入
+    - msg 为发起导入的消息, 没有 group[...] 的任务发到该会话; Python API 可以不传, 此时每行都必须指定 group[...]
+    """
+    report = ImportReport(dry_run)
+    specs: List[_Spec] = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        report.total += 1
+        try:
+            cycle, time_str, event, group_name = parse_spec(line)
+            if not event:
+                raise ValueError("任务内容为空")
+            trigger = plugin.get_trigger(cycle, time_str)
+            if group_name is not None:
+                names = plugin.expand_groups(group_name)
+            elif msg is None:
+                raise ValueError("没有指定 group[...]")
+            else:
+                names = None
+        except ValueError as e:
+            report.errors.append((lineno, line, str(e)))
+            continue
+        specs.append(_Spec(lineno, line, cycle, time_str, event, group_name, trigger, names))
+
+    # 同一个群名只查找一次
+    group_ids = {}
+    for spec in specs:
+        for name in spec.names or ():
+            if name not in group_ids:
+                group_ids[name] = plugin.channel_tools.get_group_id_by_name(name)
+    valid = []
+    for spec in specs:
+        missing = [name for name in spec.names or () if group_ids[name] is None]
+        if missing:
+            report.errors.append((spec.lineno, spec.line, f"没有找到 {'、'.join(missing)}"))
+        else:
+            valid.append(spec)
+    report.errors.sort()
+    report.valid = len(valid)
+    if dry_run or report.errors or not valid:
+        return report
+
+    scheduler = plugin.scheduler
+    jobstore = scheduler._lookup_jobstore("default")
+    api = msg is None
+    if api:
+        msg = _api_message()
+    task_ids = plugin.new_task_ids(len(valid))
+    now = datetime.now(scheduler.timezone)
+    next_run_times = {}
+    jobs = []
+    index_rows = []
+    for spec, task_id in zip(valid, task_ids):
+        trigger = plugin.add_jitter(task_id, spec.trigger)
+        # 没有错峰偏移时, 同一个 Trigger 的下次运行时间也相同
+        if trigger is spec.trigger:
+            if id(trigger) not in next_run_times:
+                next_run_times[id(trigger)] = trigger.get_next_fire_time(None, now)
+            next_run_time = next_run_times[id(trigger)]
+        else:
+            next_run_time = trigger.get_next_fire_time(None, now)
+        recipient_keys, no_need_at, actual_user_id, actual_user_nickname = plugin.task_target(
+            msg, spec.group_name, group_ids
+        )
+        record = TaskRecord(
+            task_id,
+            spec.event,
+            spec.group_name,
+            recipient_keys[0],
+            no_need_at,
+            actual_user_id,
+            actual_user_nickname,
+            spec.cycle,
+            spec.time_str,
+            recipient_keys if len(recipient_keys) > 1 else None,
+        )
+        jobs.append(_new_job(plugin, task_id, trigger, record, next_run_time))
+        if api:
+            owner, chat = None, chat_key(True, spec.names[0])
+        else:
+            owner, chat = plugin.owner_and_chat(msg)
+        index_rows.append(index_values(record, owner, chat))
+        report.added.append((spec.lineno, task_id))
+    # 发送目标是按会话共享的, 先于任务提交
+    plugin.write_behind.flush()
+    try:
+        insert_jobs(jobstore, jobs, [index_many_op(index_rows)])
+    except Exception:
+        report.added = []
+        raise
+    # 直接写入 job store, 不会产生 job 添加事件
+    fire_preview.touch(job.id for job in jobs)
+    scheduler.wakeup()
+    logger.info(f"[TaskScheduler] 已导入 {len(jobs)} 个任务")
+    return report
+
+
+def _api_message():
+    """Python API 导入时没有发起消息, 用当前登录的机器人作为任务的接收方"""
+    channel = runtime_state.channel
+    msg = ChatMessage({})
+    msg.is_group = False
+    msg.to_user_id = getattr(channel, "user_id", None)
+    msg.to_user_nickname = getattr(channel, "name", None)
+    return msg
+
+
+def _new_job(plugin, task_id, trigger, record, next_run_time):
+    """与 scheduler.add_job 构造的 job 相同, 但不逐个写入 job store"""
+    from .task_scheduler import task_execute
+
+    scheduler = plugin.scheduler
+    job = Job(
+        scheduler,
+        id=task_id,
+        func=task_execute,
+        trigger=trigger,
+        executor=route_pool(plugin.config, record),
+        args=(record.encode(),),
+        kwargs={},
+        misfire_grace_time=MISFIRE_GRACE_TIME,
+        coalesce=scheduler._job_defaults["coalesce"],
+        max_instances=scheduler._job_defaults["max_instances"],
+        next_run_time=next_run_time,
+    )
+    return job
+
+
+def iter_specs(jobstore, timezone=None, chat=None, owner=None):
+    """
+    按任务描述的格式逐个导出任务, 产出 (job_id, 任务描述), 无法还原的任务描述为 None
+    分批读取任务列表索引, 不反序列化任何 job
+    今天/明天/后天 这类相对日期按下次运行时间导出为具体日期
+    """
+    jobs_t = jobstore.jobs_t
+    conditions = []
+    if chat is not None:
+        conditions.append(index_t.c.chat == chat)
+    if owner is not None:
+        conditions.append(index_t.c.owner == owner)
+    query = (
+        select(
+            index_t.c.job_id, index_t.c.cycle, index_t.c.time_str, index_t.c.content,
+            index_t.c.group_name, jobs_t.c.next_run_time,
+        )
+        .select_from(index_t.join(jobs_t, jobs_t.c.id == index_t.c.job_id))
+        .where(*conditions)
+        .order_by(index_t.c.job_id)
+    )
+    with jobstore.engine.connect() as connection:
+        result = connection.execution_options(yield_per=500).execute(query)
+        for job_id, cycle, time_str, content, group_name, next_run_time in result:
+            if not cycle or not content:
+                yield job_id, None
+                continue
+            if cycle in ("今天", "明天", "后天") and next_run_time is not None:
+                run_date = datetime.fromtimestamp(next_run_time, timezone)
+                cycle, time_str = run_date.strftime("%Y-%m-%d"), run_date.strftime("%H:%M")
+            elif cycle_type(cycle) == "other":
+                yield job_id, None
+                continue
+            yield job_id, format_spec(cycle, time_str, content, group_name)
+
+
+def export_tasks(jobstore, out, timezone=None, chat=None, owner=None) -> int:
+    """把任务逐行写入 out(文件路径或文件对象), 格式可以直接用于导入, 返回导出的任务数"""
+    if isinstance(out, (str, os.PathLike)):
+        with open(out, "w", encoding="utf-8") as f:
+            return export_tasks(jobstore, f, timezone, chat, owner)
+    count = 0
+    out.write(f"# TaskScheduler 任务导出 {datetime.now(timezone).strftime('%Y-%m-%d %H:%M:%S')}\n")
+    for job_id, spec in iter_specs(jobstore, timezone, chat, owner):
+        if spec is None:
+            out.write(f"# {job_id} 缺少周期信息, 无法导出\n")
+            continue
+        out.write(spec + "\n")
+        count += 1
+    return count
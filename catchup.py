@@ -0,0 +1,254 @@
+# encoding:utf-8
+import threading
+import time
+from datetime import datetime, timedelta
+
+from apscheduler.executors.base import MaxInstancesReachedError
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.triggers.date import DateTrigger
+
+from common.log import logger
+
+from .leases import leases
+from .metrics import cycle_type, metrics
+from .records import TaskRecord
+from .runtime import runtime_state
+from .storage import paused_jobs
+
+# add_job 的 misfire_grace_time: 到期后这段时间内仍然正常执行, 重启时错过更久的任务交给补发处理
+MISFIRE_GRACE_TIME = 60
+
+# 最多补发多久以前(秒)的运行, date 为一次性任务, recurring 为没有单独配置的周期任务
+DEFAULT_MAX_STALENESS = {"date": 3600, "recurring": 600}
+
+
+class _Replay:
+    __slots__ = ("job_id", "run_time", "expires_at", "superseded_at", "labels")
+
+    def __init__(self, job_id, run_time, expires_at, superseded_at, labels):
+        self.job_id = job_id
+        # 被合并的多次运行中最近的一次
+        self.run_time = run_time
+        # 超过这个时间还没补发就放弃, None 为不限制
+        self.expires_at = expires_at
+        # 周期任务的下一次正常运行时间, 到了这个时间补发就没有必要了; 一次性任务为 None
+        self.superseded_at = superseded_at
+        self.labels = labels
+
+    @property
+    def once(self):
+        return self.superseded_at is None
+
+
+class CatchUp:
+    """
+    重启后对错过的任务的补发策略
+    - 启动时(调度器暂停中)只读取到期超过 MISFIRE_GRACE_TIME 的任务与暂停中的一次性任务, 不扫描整张表
+    - 周期任务错过的多次运行合并为一次, 超过 max_staleness 的不再补发, 任务按原周期继续调度
+    - 一次性任务在补发前保持暂停, 补发时删除, 补发完成前重启也不会丢失
+    - channel 登录后才开始补发, 前 replay_burst 个立即执行, 之后每秒 replay_rate 个
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.configure()
+
+    def configure(self, enabled=True, max_staleness=None, replay_rate=1, replay_burst=10, ready_timeout=600):
+        self.enabled = bool(enabled)
+        self.max_staleness = dict(DEFAULT_MAX_STALENESS)
+        self.max_staleness.update(max_staleness or {})
+        self.replay_rate = replay_rate
+        self.replay_burst = max(int(replay_burst), 1)
+        self.ready_timeout = ready_timeout
+
+    def staleness_of(self, job, once):
+        """该任务最多补发多久以前的运行(秒), None 为不限制; 周期任务先按周期类型查找"""
+        if once:
+            return self.max_staleness.get("date")
+        try:
+            kind = cycle_type(TaskRecord.decode(job.args[0]).cycle)
+        except Exception:
+            kind = None
+        if kind != "date" and kind in self.max_staleness:
+            return self.max_staleness[kind]
+        return self.max_staleness.get("recurring")
+
+    def scan(self, scheduler):
+        """插件启动、调度器恢复之前调用, 返回需要补发的任务数"""
+        if not self.enabled:
+            return 0
+        jobstore = scheduler._lookup_jobstore("default")
+        now = datetime.now(scheduler.timezone)
+        cutoff = now - timedelta(seconds=MISFIRE_GRACE_TIME)
+        jobs = jobstore.get_due_jobs(cutoff)
+        # 上次补发完成前退出时留下的一次性任务
+        jobs.extend(
+            job for job in paused_jobs(jobstore)
+            if isinstance(job.trigger, DateTrigger) and job.trigger.run_date <= cutoff
+        )
+        if not jobs:
+            return 0
+        replays = []
+        dropped = 0
+        for job in jobs:
+            replay = self._plan(scheduler, jobstore, job, now)
+            if replay is None:
+                dropped += 1
+            else:
+                replays.append(replay)
+        logger.info(f"[TaskScheduler] 启动时发现 {len(jobs)} 个错过的任务: 补发 {len(replays)} 个, 超过补发时限放弃 {dropped} 个")
+        if replays:
+            # 先错过的先补发
+            replays.sort(key=lambda replay: replay.run_time)
+            with self._lock:
+                self.pending += len(replays)
+            threading.Thread(
+                target=self._replay, args=(scheduler, replays), name="TaskScheduler-catchup", daemon=True
+            ).start()
+        return len(replays)
+
+    def stats(self):
+        with self._lock:
+            return {"pending": self.pending, "replayed": self.replayed, "dropped": self.dropped}
+
+    def _plan(self, scheduler, jobstore, job, now):
+        once = isinstance(job.trigger, DateTrigger)
+        staleness = self.staleness_of(job, once)
+        window_start = now - timedelta(seconds=staleness) if staleness is not None else None
+        if once:
+            run_time, next_run_time = job.trigger.run_date, None
+            if window_start is not None and run_time < window_start:
+                run_time = None
+        else:
+            run_time, next_run_time = latest_run(job.trigger, job.next_run_time, window_start, now)
+        labels = metrics.job_labels(job) if metrics.enabled else ()
+        if run_time is None:
+            self._count("dropped", labels)
+            if metrics.enabled:
+                metrics.inc("misfires_total", labels)
+            if next_run_time is None:
+                scheduler.remove_job(job.id, "default")
+            else:
+                job._modify(next_run_time=next_run_time)
+                jobstore.update_job(job)
+            return None
+        # 一次性任务(包括已经没有下一次运行的周期任务)暂停到补发时再删除
+        job._modify(next_run_time=next_run_time)
+        jobstore.update_job(job)
+        expires_at = run_time + timedelta(seconds=staleness) if staleness is not None else None
+        return _Replay(job.id, run_time, expires_at, next_run_time, labels)
+
+    def _replay(self, scheduler, replays):
+        remaining = len(replays)
+        try:
+            # channel 登录之前执行器会跳过任务, 补发要等登录完成
+            waited_until = time.monotonic() + self.ready_timeout
+            while not self._ready():
+                if not scheduler.running:
+                    return
+                if time.monotonic() >= waited_until:
+                    logger.warning(f"[TaskScheduler] {self.ready_timeout} 秒内 channel 没有就绪, 放弃补发 {remaining} 个任务")
+                    for replay in replays:
+                        self._drop(scheduler, replay)
+                    return
+                time.sleep(1)
+            interval = 1.0 / self.replay_rate if self.replay_rate else 0.0
+            started = time.monotonic()
+            for i, replay in enumerate(replays):
+                release_at = started + max(i - self.replay_burst + 1, 0) * interval
+                while True:
+                    if not scheduler.running:
+                        return
+                    delay = release_at - time.monotonic()
+                    if delay <= 0:
+                        break
+                    time.sleep(min(delay, 1))
+                try:
+                    self._release(scheduler, replay)
+                except Exception as e:
+                    logger.error(f"[TaskScheduler] 补发任务 {replay.job_id} 失败: {e}")
+                remaining -= 1
+                with self._lock:
+                    self.pending -= 1
+            logger.info(f"[TaskScheduler] 补发完成, 用时 {time.monotonic() - started:.1f}s")
+        finally:
+            with self._lock:
+                self.pending -= remaining
+
+    def _release(self, scheduler, replay):
+        now = datetime.now(scheduler.timezone)
+        if replay.expires_at is not None and now > replay.expires_at:
+            self._drop(scheduler, replay)
+            return
+        if not replay.once and now >= replay.superseded_at:
+            # 下一次正常运行已经到了, 补发与它合并
+            self._count("dropped", replay.labels)
+            return
+        job = scheduler._lookup_jobstore("default").lookup_job(replay.job_id)
+        if job is None:
+            # 补发前任务已被取消
+            return
+        if leases.enabled and not leases.claim_once(job.id, replay.run_time):
+            # 同时启动的其它进程已经补发了这次运行
+            self._count("dropped", replay.labels)
+            return
+        if replay.once:
+            try:
+                scheduler.remove_job(job.id, "default")
+            except JobLookupError:
+                return
+        try:
+            # 以补发时刻作为本次运行时间, 执行池的截止时间与触发延迟都从补发时算起
+            scheduler._lookup_executor(job.executor).submit_job(job, [now])
+        except MaxInstancesReachedError:
+            logger.warning(f"[TaskScheduler] 任务 {job.id} 正在执行, 跳过补发")
+            return
+        logger.info(f"[TaskScheduler] 补发任务 {job.id}, 原定运行时间 {replay.run_time}")
+        self._count("replayed", replay.labels)
+
+    def _drop(self, scheduler, replay):
+        self._count("dropped", replay.labels)
+        if metrics.enabled:
+            metrics.inc("misfires_total", replay.labels)
+        if replay.once:
+            try:
+                scheduler.remove_job(replay.job_id, "default")
+            except JobLookupError:
+                pass
+
+    def _count(self, result, labels):
+        with self._lock:
+            setattr(self, result, getattr(self, result) + 1)
+        if metrics.enabled:
+            metrics.inc("catchup_total", labels + (("result", result),))
+
+    @staticmethod
+    def _ready():
+        try:
+            if not runtime_state.enabled():
+                return False
+            return not runtime_state.is_chat_channel or runtime_state.bot_user_id() is not None
+        except Exception:
+            return False
+
+
+def latest_run(trigger, next_run_time, window_start, now):
+    """
+    返回 (window_start 之后最近一次错过的运行时间, 下一次正常运行时间)
+    只遍历窗口内的运行时间, 停机再久也不会逐个计算更早的运行
+    """
+    run_time = next_run_time
+    if window_start is not None and window_start > run_time:
+        run_time = trigger.get_next_fire_time(None, window_start)
+    last = None
+    while run_time is not None and run_time <= now:
+        last = run_time
+        run_time = trigger.get_next_fire_time(run_time, now)
+    return last, run_time
+
+
+if "catch_up" not in globals():
+    catch_up = CatchUp()
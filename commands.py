@@ -0,0 +1,87 @@
+# encoding:utf-8
+import threading
+from typing import Optional
+
+from config import pconf
+
+# $task 之后的第一个词, 其余内容按添加任务解析
+OPERATIONS = frozenset(("任务列表", "状态", "取消任务", "导入", "导出", "预览", "profile"))
+
+
+class CommandTable:
+    """
+    custom_commands 按关键词首字符建立的前缀索引, 在配置加载时编译一次
+    匹配结果与按配置顺序逐个 startswith 相同: 多个关键词都是前缀时取配置中靠前的
+    """
+
+    __slots__ = ("source", "_buckets", "_fallback")
+
+    def __init__(self, custom_commands):
+        self.source = custom_commands
+        # 空关键词匹配所有内容, 按原来的顺序放进每个桶里
+        self._fallback = tuple((c["key_word"], c) for c in custom_commands or () if not c["key_word"])
+        buckets = {}
+        for custom_command in custom_commands or ():
+            key_word = custom_command["key_word"]
+            if key_word and key_word[0] not in buckets:
+                first = key_word[0]
+                buckets[first] = tuple(
+                    (c["key_word"], c) for c in custom_commands if not c["key_word"] or c["key_word"][0] == first
+                )
+        self._buckets = buckets
+
+    def match(self, event: str) -> Optional[dict]:
+        candidates = self._buckets.get(event[:1], self._fallback)
+        for key_word, custom_command in candidates:
+            if event.startswith(key_word):
+                return custom_command
+        return None
+
+
+# id(custom_commands) -> CommandTable, 索引持有 source 的引用, 缓存期间 id 不会被复用
+_tables = {}
+_table_lock = threading.Lock()
+# 插件自己的配置与全局插件配置可能是两个对象, 各留一份; 重新加载后旧的按加入顺序淘汰
+MAX_TABLES = 4
+
+
+def command_table(config=None) -> CommandTable:
+    """
+    custom_commands 编译后的索引, config 为空时读取全局插件配置
+    按 custom_commands 对象分别缓存, 配置重新加载(被替换)后重建, 读取方不需要加锁
+    """
+    if config is None:
+        config = pconf("TaskScheduler") or {}
+    source = config.get("custom_commands")
+    table = _tables.get(id(source))
+    if table is None or table.source is not source:
+        with _table_lock:
+            table = _tables.get(id(source))
+            if table is None or table.source is not source:
+                table = _tables[id(source)] = CommandTable(source)
+                while len(_tables) > MAX_TABLES:
+                    del _tables[next(iter(_tables))]
+    return table
+
+
+class CommandRouter:
+    """
+    on_handle_context 的命令解析, 每条聊天消息都会经过这里
+    插件加载配置时按 plugin_trigger_prefix 与 command_prefix 编译, 不是任务命令的消息只做一次 startswith
+    """
+
+    __slots__ = ("conf", "head")
+
+    def __init__(self, global_conf, plugin_config):
+        # 全局配置重新加载后 conf() 返回新对象, 调用方据此重建
+        self.conf = global_conf
+        self.head = f"{global_conf.get('plugin_trigger_prefix', '$')}{plugin_config.get('command_prefix', 'time')} "
+
+    def route(self, content: str):
+        """不是任务命令时返回 None, 否则返回 (操作, 去掉命令前缀的内容), 不是已知操作时操作为 None"""
+        if not content.startswith(self.head):
+            return None
+        remaining = content[len(self.head):].strip()
+        words = remaining.split(maxsplit=1)
+        operation = words[0] if words and words[0] in OPERATIONS else None
+        return operation, remaining
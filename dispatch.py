@@ -0,0 +1,250 @@
+# encoding:utf-8
+import concurrent.futures
+import contextlib
+import functools
+import threading
+import time
+from datetime import datetime
+from typing import List
+
+from pytz import utc
+
+from bridge.context import ContextType
+from bridge.reply import Reply, ReplyType
+from channel.chat_channel import ChatChannel
+from channel.channel_factory import create_channel
+from common.log import logger
+from config import conf, pconf
+from plugins import Event, EventContext, PluginManager
+
+from .commands import command_table
+from .leases import leases
+from .metrics import metrics
+from .profiling import profiler
+from .ratelimit import send_gate
+from .records import TaskRecord
+from .recipients import registry
+from .results import result_cache
+from .runtime import runtime_state
+
+
+class Delivery:
+    """prepare 阶段的产物: 发给一个目标的回复与上下文"""
+
+    __slots__ = ("channel", "reply", "context", "record", "recipient_key", "labels", "admitted", "deadline", "pool_stats", "lease")
+
+    def __init__(self, channel, reply, context, record, recipient_key, labels=None):
+        self.channel = channel
+        self.reply = reply
+        self.context = context
+        self.record = record
+        self.recipient_key = recipient_key
+        # 指标的 labels, 未开启指标时为 None
+        self.labels = labels
+        # 已经通过限流(异步执行器在事件循环里等待过)
+        self.admitted = False
+        # 执行池配置了 deadline 时的截止时间(UTC), 超过后不再发送
+        self.deadline = None
+        self.pool_stats = None
+        # 多进程协调时本次运行的租约, 发送前确认没有被其它进程接管
+        self.lease = None
+
+
+# 线程执行器执行任务期间的截止时间与租约, 见 executors._BaseThreadExecutor
+_local = globals().get("_local") or threading.local()
+
+
+@contextlib.contextmanager
+def deadline_scope(deadline, pool_stats=None, lease=None):
+    _local.deadline = deadline
+    _local.pool_stats = pool_stats
+    _local.lease = lease
+    try:
+        yield
+    finally:
+        _local.deadline = None
+        _local.pool_stats = None
+        _local.lease = None
+
+
+def prepare(payload: bytes) -> List[Delivery]:
+    """
+    执行任务的第一阶段: 改写事件、调用其他插件并生成回复, 每个发送目标一个 Delivery
+    广播任务的内容只生成一次; 可能阻塞在插件调用上
+    """
+    record = TaskRecord.decode(payload)
+    task_id = record.task_id
+    event = record.event
+    logger.info(f"开始执行任务{task_id}: {event}, 组: {record.group_name}")
+    labels = metrics.job_started(record) if metrics.enabled else None
+    bot_user_id = runtime_state.bot_user_id() if runtime_state.is_chat_channel else None
+    recipients = []
+    for key in record.recipient_keys:
+        recipient = registry.get(key)
+        if recipient is None:
+            logger.error(f"任务 {task_id} 的发送目标 {key} 不存在")
+            continue
+        if bot_user_id is not None and recipient.bot_user_id != bot_user_id:
+            # 登录时没能修复的发送目标, 在执行线程里再试一次, 不占用调度线程
+            registry.repair(recipient, bot_user_id)
+        recipients.append(recipient)
+    if not recipients:
+        raise ValueError(f"发送目标 {record.recipient_key} 不存在")
+    prefix = conf().get("single_chat_prefix", [""])
+
+    call_other_plugins = False
+    shared_command = None
+    plugin_config = pconf('TaskScheduler')
+    if plugin_config.get('allow_call_other_plugins', True):
+        call_other_plugins = True
+        custom_command = command_table(plugin_config).match(event)
+        if custom_command is not None:
+            event = f"{custom_command['command_prefix']}{event}"
+            if custom_command.get('shared', False):
+                shared_command = custom_command
+
+    # channel 是单例的
+    channel = create_channel(conf().get("channel_type"))
+    if not isinstance(channel, ChatChannel):
+        return []
+
+    deliveries = []
+    shared = None
+    for recipient in recipients:
+        msg = registry.to_message(recipient, record.event, record.actual_user_id, record.actual_user_nickname)
+        content = f"{prefix[0]} {event}" if not msg.is_group else event
+        content_dict = {
+            "no_need_at": record.no_need_at,
+            "isgroup": msg.is_group,
+            "msg": msg,
+        }
+        context = channel._compose_context(
+            ContextType.TEXT, content, **content_dict
+        )
+        if shared is None:
+            if labels is not None:
+                started = time.perf_counter()
+            reply = _render(channel, context, event, call_other_plugins, shared_command, labels)
+            if labels is not None and call_other_plugins:
+                metrics.observe("plugin_seconds", time.perf_counter() - started, labels)
+            # 文件对象之类不能重复读取的回复, 每个目标各自生成
+            if reply and isinstance(reply.content, str):
+                shared = (reply.type, reply.content)
+        else:
+            reply = Reply(*shared)
+        if not reply:
+            continue
+        if not reply.content:
+            reply.type = ReplyType.TEXT
+            reply.content = f"【执行定时任务】\n任务编号: {task_id}\n任务内容: {event}"
+        if msg.is_group and reply.type == ReplyType.TEXT and not context.get('no_need_at', False):
+            reply.content = f"@{msg.actual_user_nickname}\n{reply.content}"
+        deliveries.append(Delivery(channel, reply, context, record, recipient.key, labels))
+    return deliveries
+
+
+def _render(channel, context, event, call_other_plugins, shared_command, labels=None):
+    try:
+        if not call_other_plugins:
+            return Reply()
+        if shared_command is not None:
+            return _shared_reply(channel, context, event, shared_command)
+        return _invoke_plugins(channel, context)
+    except Exception as e:
+        logger.error(f"执行任务失败: {e}")
+        if labels is not None:
+            metrics.failure(labels, "plugin")
+        reply = Reply()
+        reply.type = ReplyType.TEXT
+        reply.content = f"执行任务失败: {e}"
+        return reply
+
+
+def _invoke_plugins(channel, context):
+    e_context = PluginManager().emit_event(
+        EventContext(
+            Event.ON_HANDLE_CONTEXT,
+            {"channel": channel, "context": context, "reply": Reply()},
+        )
+    )
+    return e_context["reply"]
+
+
+def _shared_reply(channel, context, event, custom_command):
+    """
+    同一个改写后的事件在缓存有效期内只调用一次其他插件, 各任务拿到各自的 Reply 副本
+    @ 前缀等按接收人区分的格式在之后逐个任务添加
+    """
+    own = []
+
+    def compute():
+        reply = _invoke_plugins(channel, context)
+        own.append(reply)
+        # 图片等文件对象不能被多个任务重复读取, 只共享字符串内容
+        if reply and isinstance(reply.content, str) and reply.content:
+            return reply.type, reply.content
+        return None
+
+    shared = result_cache.get_or_compute(event, compute, custom_command.get('cache_ttl'))
+    if own:
+        return own[0]
+    return Reply(*shared)
+
+
+async def admit(delivery: Delivery):
+    """在事件循环里等待限流, 之后 deliver 不再阻塞线程等待"""
+    await send_gate.acquire_async(delivery.recipient_key)
+    delivery.admitted = True
+
+
+def deliver(delivery: Delivery):
+    """执行任务的第二阶段: 限流后发送回复, 主要是网络等待"""
+    if not delivery.admitted:
+        send_gate.acquire(delivery.recipient_key)
+    labels = delivery.labels
+    if delivery.deadline is not None and datetime.now(utc) > delivery.deadline:
+        # 插件调用或限流等待太久, 过时的提醒不再发送
+        if delivery.pool_stats is not None:
+            delivery.pool_stats.give_up(delivery.record.task_id, "send")
+        if labels is not None:
+            metrics.failure(labels, "deadline")
+        return
+    if delivery.lease is not None and not leases.holds(delivery.lease):
+        # 本进程卡住期间租约过期, 这次运行已由其它进程重新执行
+        return
+    try:
+        if labels is None:
+            delivery.channel.send(delivery.reply, delivery.context)
+        else:
+            started = time.perf_counter()
+            delivery.channel.send(delivery.reply, delivery.context)
+            metrics.observe("send_seconds", time.perf_counter() - started, labels)
+    except Exception as e:
+        logger.error(f"执行任务失败: {e}")
+        if labels is not None:
+            metrics.failure(labels, "send")
+        reply = Reply()
+        reply.type = ReplyType.TEXT
+        reply.content = f"执行任务失败: {e}"
+        delivery.channel.send(reply, delivery.context)
+
+
+def execute(payload: bytes):
+    deliveries = prepare(payload)
+    deadline = getattr(_local, "deadline", None)
+    if deadline is not None:
+        for delivery in deliveries:
+            delivery.deadline = deadline
+            delivery.pool_stats = _local.pool_stats
+    lease = getattr(_local, "lease", None)
+    if lease is not None:
+        for delivery in deliveries:
+            delivery.lease = lease
+    if len(deliveries) <= 1:
+        for delivery in deliveries:
+            deliver(delivery)
+        return
+    # 广播任务并行发送, 并发数有上限
+    workers = min(len(deliveries), pconf('TaskScheduler').get('broadcast_concurrency', 8))
+    with concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="TaskScheduler-broadcast") as pool:
+        list(pool.map(functools.partial(profiler.call, deliver), deliveries))
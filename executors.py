@@ -0,0 +1,494 @@
+# encoding:utf-8
+import asyncio
+import concurrent.futures
+import functools
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from traceback import format_tb
+
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_MISSED, JobExecutionEvent
+from apscheduler.executors.base import BaseExecutor
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.schedulers.background import BackgroundScheduler
+from pytz import utc
+
+from common.log import logger
+
+from . import dispatch
+from .commands import command_table
+from .leases import leases
+from .metrics import metrics
+from .profiling import profiler
+from .records import TaskRecord
+from .recipients import registry
+from .runtime import runtime_state
+
+
+class CheckedExecutorMixin:
+    """提交前检查插件开关与机器人 id, 条件不满足时跳过本次执行"""
+
+    def _do_submit_job(self, job, run_times):
+        if not metrics.enabled:
+            ok = profiler.call(self._check_conditions, job)
+        else:
+            started = time.perf_counter()
+            ok = profiler.call(self._check_conditions, job)
+            labels = metrics.job_labels(job)
+            metrics.observe("check_seconds", time.perf_counter() - started, labels)
+            if ok:
+                metrics.job_submitted(job.id, run_times, labels)
+            else:
+                metrics.inc("skips_total", labels)
+        if not ok:
+            logger.debug(f"[TaskScheduler] 任务 {job.id} 条件不满足, 跳过")
+            # submit_job 会在返回后给实例计数 +1, 跳过的任务没有回调来减回去
+            self._instances[job.id] -= 1
+            return
+
+        return super()._do_submit_job(job, run_times)
+
+    def _check_conditions(self, job):
+        state = runtime_state
+        if not state.enabled():
+            return False
+        if not state.is_chat_channel:
+            return True
+
+        # 机器人 id 变化时会在这里触发一次性的发送目标修复(在后台线程执行)
+        if state.bot_user_id() is None:
+            return False
+        record = TaskRecord.decode(job.args[0])
+        found = False
+        for key in record.recipient_keys:
+            if registry.get(key) is None:
+                logger.error(f"任务 {job.id} 的发送目标 {key} 不存在")
+                continue
+            found = True
+        return found
+
+
+class PoolStats:
+    """执行池的饱和度: 容量、排队中、执行中以及因超过截止时间放弃的次数"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.alias = "default"
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.gave_up = 0
+
+    def submitted(self):
+        with self._lock:
+            self.queued += 1
+        return time.perf_counter()
+
+    def cancelled(self):
+        with self._lock:
+            self.queued -= 1
+
+    def started(self, submitted_at):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        if metrics.enabled:
+            metrics.observe("queue_wait_seconds", time.perf_counter() - submitted_at, (("pool", self.alias),))
+
+    def finished(self):
+        with self._lock:
+            self.running -= 1
+
+    def give_up(self, job_id, stage):
+        with self._lock:
+            self.gave_up += 1
+        logger.warning(f"[TaskScheduler] 任务 {job_id} 超过执行池 {self.alias} 的截止时间, 放弃执行({stage})")
+        if metrics.enabled:
+            metrics.inc("deadline_drops_total", (("pool", self.alias), ("stage", stage)))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "capacity": self.capacity,
+                "queued": self.queued,
+                "running": self.running,
+                "gave_up": self.gave_up,
+            }
+
+
+def misfired(job, run_time, admitted_at, log):
+    """
+    与 apscheduler.executors.base.run_job 相同的错过执行判断, 但从调度器把任务交给执行器的时刻(admitted_at)算起:
+    在执行池里排队(比如限流等待占满了线程)只是推迟, 不算错过; 执行池内的等待由 deadline 控制
+    """
+    if job.misfire_grace_time is None:
+        return False
+    difference = admitted_at - run_time
+    if difference > timedelta(seconds=job.misfire_grace_time):
+        log.warning('Run time of job "%s" was missed by %s', job, difference)
+        return True
+    return False
+
+
+def deadline_of(run_time, deadline):
+    """本次执行的截止时间: 计划运行时间 + deadline 秒, 未配置时为 None"""
+    if not deadline:
+        return None
+    return run_time + timedelta(seconds=deadline)
+
+
+class _BaseThreadExecutor(ThreadPoolExecutor):
+    """线程池执行器, 额外统计饱和度并在截止时间后放弃执行与发送"""
+
+    def __init__(self, max_workers=10, deadline=None):
+        super().__init__(max_workers)
+        self.deadline = deadline
+        self.stats = PoolStats(int(max_workers))
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        self.stats.alias = alias
+
+    def _do_submit_job(self, job, run_times):
+        # 与 BasePoolExecutor._do_submit_job 相同, 只是在线程里运行 self._run
+        def callback(f):
+            exc, tb = (f.exception_info() if hasattr(f, 'exception_info') else
+                       (f.exception(), getattr(f.exception(), '__traceback__', None)))
+            if exc:
+                self._run_job_error(job.id, exc, tb)
+            else:
+                self._run_job_success(job.id, f.result())
+
+        admitted_at = datetime.now(utc)
+        submitted_at = self.stats.submitted()
+        try:
+            f = self._pool.submit(self._run, job, run_times, admitted_at, submitted_at)
+        except BaseException:
+            self.stats.cancelled()
+            raise
+        f.add_done_callback(callback)
+
+    def _run(self, job, run_times, admitted_at, submitted_at):
+        self.stats.started(submitted_at)
+        try:
+            deadline = deadline_of(run_times[-1], self.deadline)
+            if deadline is not None and datetime.now(utc) > deadline:
+                # 在池里排队时已经超过截止时间, 按错过执行处理
+                self.stats.give_up(job.id, "start")
+                return [JobExecutionEvent(EVENT_JOB_MISSED, job.id, job._jobstore_alias, run_time) for run_time in run_times]
+            lease = None
+            if leases.enabled:
+                # coalesce 的任务一次只执行最后一个运行时间, 以它认领
+                lease = leases.claim(job, run_times[-1])
+                if lease is None:
+                    # 其它进程已经执行了这次运行
+                    if metrics.enabled:
+                        metrics.job_forgotten(job.id, run_times[-1])
+                    return []
+            try:
+                # 线程里的插件调用无法取消, 只能在发送前检查截止时间
+                with dispatch.deadline_scope(deadline, self.stats, lease):
+                    return profiler.call(self._run_times, job, run_times, admitted_at)
+            finally:
+                if lease is not None:
+                    leases.release(lease)
+        finally:
+            self.stats.finished()
+
+    def _run_times(self, job, run_times, admitted_at):
+        # 与 apscheduler.executors.base.run_job 相同, 只是错过执行的判断见 misfired
+        events = []
+        for run_time in run_times:
+            if misfired(job, run_time, admitted_at, self._logger):
+                events.append(JobExecutionEvent(EVENT_JOB_MISSED, job.id, job._jobstore_alias, run_time))
+                continue
+            self._logger.info('Running job "%s" (scheduled at %s)', job, run_time)
+            try:
+                retval = job.func(*job.args, **job.kwargs)
+            except BaseException:
+                events.append(_error_event(job, run_time))
+                self._logger.exception('Job "%s" raised an exception', job)
+            else:
+                events.append(JobExecutionEvent(
+                    EVENT_JOB_EXECUTED, job.id, job._jobstore_alias, run_time, retval=retval
+                ))
+                self._logger.info('Job "%s" executed successfully', job)
+        return events
+
+
+class CheckedThreadPoolExecutor(CheckedExecutorMixin, _BaseThreadExecutor):
+    """
+    线程池执行器
+    - max_workers: 线程数
+    - deadline: 计划运行时间之后多少秒仍未发送就放弃, 未配置时不限制
+    """
+
+
+class _BaseAsyncExecutor(BaseExecutor):
+    """在一个独立线程的事件循环里运行任务协程"""
+
+    def __init__(self, max_concurrency=1000, plugin_workers=8, send_workers=32, drain_timeout=30, deadline=None):
+        super().__init__()
+        self.drain_timeout = drain_timeout
+        self.max_concurrency = int(max_concurrency)
+        self.plugin_workers = int(plugin_workers)
+        self.send_workers = int(send_workers)
+        self.deadline = deadline
+        self.stats = PoolStats(self.max_concurrency)
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+        self._plugin_pool = None
+        self._send_pool = None
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        self.stats.alias = alias
+        # 阻塞的插件调用与发送分别放在有界的线程池里, 事件循环只负责编排
+        self._plugin_pool = concurrent.futures.ThreadPoolExecutor(
+            self.plugin_workers, thread_name_prefix=f"TaskScheduler-{alias}-plugin"
+        )
+        self._send_pool = concurrent.futures.ThreadPoolExecutor(
+            self.send_workers, thread_name_prefix=f"TaskScheduler-{alias}-send"
+        )
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name=f"TaskScheduler-{alias}-loop", daemon=True
+        )
+        self._thread.start()
+
+    def shutdown(self, wait=True):
+        loop = self._loop
+        if loop is None:
+            return
+        # 解释器退出时 daemon 线程已被冻结, 不能再等待事件循环
+        if wait and self._thread.is_alive() and not sys.is_finalizing():
+            pending = asyncio.run_coroutine_threadsafe(self._drain(), loop)
+            try:
+                pending.result(self.drain_timeout)
+            except concurrent.futures.TimeoutError:
+                self._logger.warning("等待执行中的任务超时, 放弃等待")
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(self.drain_timeout)
+        self._plugin_pool.shutdown(wait=False)
+        self._send_pool.shutdown(wait=False)
+        if not loop.is_running():
+            loop.close()
+        self._loop = None
+        self._semaphore = None
+
+    async def _drain(self):
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _do_submit_job(self, job, run_times):
+        admitted_at = datetime.now(utc)
+        submitted_at = self.stats.submitted()
+        try:
+            asyncio.run_coroutine_threadsafe(self._run_job(job, run_times, admitted_at, submitted_at), self._loop)
+        except BaseException:
+            self.stats.cancelled()
+            raise
+
+    async def _run_job(self, job, run_times, admitted_at, submitted_at):
+        events = []
+        error = None
+        try:
+            if self._semaphore is None:
+                # 在事件循环线程里创建, 旧版本 Python 的 Semaphore 会绑定创建时的事件循环
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            async with self._semaphore:
+                self.stats.started(submitted_at)
+                try:
+                    events = await self._run_times(job, run_times, admitted_at)
+                finally:
+                    self.stats.finished()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # 无论如何都要通知调度器, 否则 _instances 不会减少, 之后的每次运行都会因为 max_instances 被跳过
+            if error is None:
+                self._run_job_success(job.id, events)
+            else:
+                self._run_job_error(job.id, error, error.__traceback__)
+
+    async def _run_times(self, job, run_times, admitted_at):
+        loop = asyncio.get_running_loop()
+        events = []
+        for run_time in run_times:
+            # 等待并发名额与限流不算错过, 见 misfired
+            if misfired(job, run_time, admitted_at, self._logger):
+                events.append(JobExecutionEvent(EVENT_JOB_MISSED, job.id, job._jobstore_alias, run_time))
+                continue
+
+            deadline = deadline_of(run_time, self.deadline)
+            if deadline is not None:
+                remaining = (deadline - datetime.now(utc)).total_seconds()
+                if remaining <= 0:
+                    self.stats.give_up(job.id, "start")
+                    events.append(JobExecutionEvent(EVENT_JOB_MISSED, job.id, job._jobstore_alias, run_time))
+                    continue
+
+            lease = None
+            if leases.enabled:
+                try:
+                    lease = await loop.run_in_executor(self._plugin_pool, leases.claim, job, run_time)
+                except Exception:
+                    # 比如 database is locked, 与线程执行器一样这次运行按出错处理
+                    events.append(_error_event(job, run_time))
+                    self._logger.exception('认领任务 "%s" 的租约失败', job)
+                    continue
+                if lease is None:
+                    if metrics.enabled:
+                        metrics.job_forgotten(job.id, run_time)
+                    continue
+
+            self._logger.info('Running job "%s" (scheduled at %s)', job, run_time)
+            try:
+                if deadline is None:
+                    retval = await self._call(job, None, lease)
+                else:
+                    # 超时后取消协程, 释放并发名额; 已经在线程里的插件调用会跑完, 但结果不再发送
+                    retval = await asyncio.wait_for(self._call(job, deadline, lease), remaining)
+            except asyncio.TimeoutError as exc:
+                self.stats.give_up(job.id, "cancel")
+                events.append(JobExecutionEvent(
+                    EVENT_JOB_ERROR, job.id, job._jobstore_alias, run_time, exception=exc, traceback=""
+                ))
+            except BaseException:
+                events.append(_error_event(job, run_time))
+                self._logger.exception('Job "%s" raised an exception', job)
+            else:
+                events.append(JobExecutionEvent(
+                    EVENT_JOB_EXECUTED, job.id, job._jobstore_alias, run_time, retval=retval
+                ))
+            finally:
+                if lease is not None:
+                    try:
+                        await loop.run_in_executor(self._plugin_pool, leases.release, lease)
+                    except Exception:
+                        # 与线程执行器一样, 释放失败时这次运行按出错处理
+                        events[-1] = _error_event(job, run_time)
+                        self._logger.exception('释放任务 "%s" 的租约失败', job)
+        return events
+
+    async def _call(self, job, deadline, lease=None):
+        loop = asyncio.get_running_loop()
+        # task_execute 声明了分阶段的实现时, 插件调用和发送分开调度
+        stages = getattr(job.func, "dispatch_stages", None)
+        if stages is None:
+            return await loop.run_in_executor(
+                self._plugin_pool, functools.partial(profiler.call, job.func, *job.args, **job.kwargs)
+            )
+        prepare, admit, deliver = stages
+        deliveries = await loop.run_in_executor(self._plugin_pool, profiler.call, prepare, *job.args)
+        for delivery in deliveries:
+            delivery.deadline = deadline
+            delivery.pool_stats = self.stats
+            delivery.lease = lease
+
+        async def send(delivery):
+            # 限流等待发生在事件循环里, 不占用发送线程
+            await admit(delivery)
+            await loop.run_in_executor(self._send_pool, profiler.call, deliver, delivery)
+
+        # 广播任务的各个目标并行发送, 并发数受 send_workers 限制
+        await asyncio.gather(*(send(delivery) for delivery in deliveries))
+
+
+def _error_event(job, run_time):
+    """当前正在处理的异常对应的 EVENT_JOB_ERROR"""
+    exc, tb = sys.exc_info()[1:]
+    return JobExecutionEvent(
+        EVENT_JOB_ERROR, job.id, job._jobstore_alias, run_time, exception=exc, traceback="".join(format_tb(tb))
+    )
+
+
+class AsyncDispatchExecutor(CheckedExecutorMixin, _BaseAsyncExecutor):
+    """
+    基于 asyncio 的执行器: 到期的任务只是事件循环里的协程, 不占用线程
+    - max_concurrency: 同时执行的任务数上限, 其余在循环里排队
+    - plugin_workers: 调用其他插件(阻塞)的线程数
+    - send_workers: channel.send 的线程数
+    - deadline: 计划运行时间之后多少秒仍未完成就取消, 未配置时不限制
+    """
+
+
+class PooledBackgroundScheduler(BackgroundScheduler):
+    """任务按 add_job 的 executor 参数路由到命名的执行池"""
+
+    def __init__(self, *args, **kwargs):
+        self._missing_pools = set()
+        super().__init__(*args, **kwargs)
+
+    def _lookup_executor(self, alias):
+        try:
+            return super()._lookup_executor(alias)
+        except KeyError:
+            # 从配置中删掉的执行池, 其任务改由 default 执行, 否则调度器会直接删除任务
+            if alias not in self._missing_pools:
+                self._missing_pools.add(alias)
+                self._logger.warning('执行池 "%s" 不存在, 使用 default', alias)
+            return super()._lookup_executor("default")
+
+    def remove_job(self, job_id, jobstore=None):
+        try:
+            super().remove_job(job_id, jobstore)
+        except JobLookupError:
+            # 多个进程共用 tasks.db 时, 一次性任务执行后可能已被其它进程删除
+            # 调度线程里的删除不能抛出, 否则本轮其余到期的任务不会被处理
+            if not (leases.enabled and threading.current_thread() is self._thread):
+                raise
+
+
+def create_executor(options, max_workers=30):
+    """按一个执行池的配置创建执行器, 未配置 mode 时为线程池"""
+    options = dict(options or {})
+    mode = options.pop("mode", "thread")
+    if mode == "async":
+        # max_workers 只对线程池有效
+        options.pop("max_workers", None)
+        return AsyncDispatchExecutor(**options)
+    if mode != "thread":
+        raise ValueError(f"不支持的 executor mode: {mode}")
+    return CheckedThreadPoolExecutor(max_workers=options.get("max_workers", max_workers), deadline=options.get("deadline"))
+
+
+def create_executors(config):
+    """
+    按 config.json 创建所有执行池: executor 为 default 池, 未配置时沿用 max_workers 的线程池
+    executor_pools 中的每一项是一个命名的执行池, 配置项与 executor 相同
+    """
+    executors = {"default": create_executor(config.get("executor"), config.get("max_workers", 30))}
+    for name, options in (config.get("executor_pools") or {}).items():
+        if name == "default":
+            raise ValueError("executor_pools 中不能使用 default, 请配置 executor")
+        executors[name] = create_executor(options, 10)
+    return executors
+
+
+def route_pool(config, record: TaskRecord):
+    """
+    add_task 时为任务选择执行池
+    依次使用: 命中的 custom_commands 的 pool, pool_routes 中 broadcast(多个发送目标)、command(命中 custom_commands)或 text(其余任务)对应的池
+    """
+    pools = config.get("executor_pools") or {}
+    routes = config.get("pool_routes") or {}
+    command = command_table(config).match(record.event)
+    candidates = []
+    if command is not None:
+        candidates.append(command.get("pool"))
+    if record.recipients:
+        candidates.append(routes.get("broadcast"))
+    candidates.append(routes.get("command" if command is not None else "text"))
+    for name in candidates:
+        if not name:
+            continue
+        if name == "default" or name in pools:
+            return name
+        logger.warning(f"[TaskScheduler] 执行池 {name} 未在 executor_pools 中配置, 忽略")
+    return "default"
@@ -0,0 +1,253 @@
+# encoding:utf-8
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from apscheduler.executors.base import MaxInstancesReachedError
+from apscheduler.job import Job
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
+from sqlalchemy import Column, Float, Index, Integer, LargeBinary, Table, Unicode, select
+from sqlalchemy.exc import IntegrityError
+
+from common.log import logger
+
+from .metrics import metrics
+from .storage import metadata
+
+# 每次运行(job id + 计划运行时间)一行, 多个进程共用 tasks.db 时谁插入成功谁执行
+leases_t = Table(
+    "task_leases",
+    metadata,
+    Column("job_id", Unicode(191), primary_key=True),
+    Column("run_time", Float, primary_key=True),
+    Column("owner", Unicode(191), nullable=False),
+    # fencing token, 每次被接管加一; 持有者发送前比较, 已经被接管的运行不再发送
+    Column("token", Integer, nullable=False),
+    Column("expires_at", Float, nullable=False),
+    # running / done
+    Column("state", Unicode(16), nullable=False),
+    # 接管后重新执行用的任务内容与执行池, 一次性任务的 job 此时已经被删除
+    Column("payload", LargeBinary),
+    Column("executor", Unicode(191)),
+    Index("ix_task_leases_state_expires_at", "state", "expires_at"),
+)
+
+
+class Lease:
+    __slots__ = ("job_id", "run_time", "token")
+
+    def __init__(self, job_id, run_time, token):
+        self.job_id = job_id
+        self.run_time = run_time
+        self.token = token
+
+
+class LeaseManager:
+    """
+    多个进程共用同一个 tasks.db 时, 每次运行只由一个进程执行(coordination.enabled)
+    - 执行器开始执行前插入租约行, 插入成功的进程执行, 其它进程跳过
+    - 持有者定期续约; 进程退出后租约在 lease_ttl 秒内过期, 由其它进程接管并重新执行
+    - 接管会让 token 加一, 原持有者(比如卡住后又恢复的进程)发送前发现 token 变了就不再发送
+    - 每个进程每 poll_interval 秒唤醒一次调度器, 其它进程添加的任务也能按时触发
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._lock = threading.Lock()
+        self._engine = None
+        self._scheduler = None
+        self._generation = 0
+        self.counts = {"claimed": 0, "skipped": 0, "taken_over": 0, "fenced": 0}
+
+    def configure(
+        self, scheduler, engine, enabled=False, lease_ttl=30, poll_interval=2, takeover_max_age=600, retention=86400
+    ):
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            self.enabled = bool(enabled)
+            self._scheduler = scheduler
+            self._engine = engine
+            self.lease_ttl = lease_ttl
+            self.poll_interval = poll_interval
+            self.takeover_max_age = takeover_max_age
+            self.retention = retention
+        if self.enabled:
+            # 插件重载后旧线程发现 generation 变化就退出
+            threading.Thread(
+                target=self._run, args=(generation,), name="TaskScheduler-leases", daemon=True
+            ).start()
+            logger.info(f"[TaskScheduler] 多进程协调已开启, 本进程: {self.worker_id}")
+
+    def claim(self, job, run_time):
+        """认领 job 在 run_time 的这次运行, 已经被其它进程认领时返回 None"""
+        key = datetime_to_utc_timestamp(run_time)
+        try:
+            with self._engine.begin() as connection:
+                connection.execute(
+                    leases_t.insert().values(
+                        job_id=job.id,
+                        run_time=key,
+                        owner=self.worker_id,
+                        token=1,
+                        expires_at=time.time() + self.lease_ttl,
+                        state="running",
+                        payload=job.args[0] if job.args else None,
+                        executor=job.executor,
+                    )
+                )
+        except IntegrityError:
+            self._count("skipped")
+            return None
+        self._count("claimed")
+        return Lease(job.id, key, 1)
+
+    def claim_once(self, job_id, run_time):
+        """只占位不执行, 比如补发时让多个进程中只有一个补发同一次错过的运行"""
+        try:
+            with self._engine.begin() as connection:
+                connection.execute(
+                    leases_t.insert().values(
+                        job_id=job_id,
+                        run_time=datetime_to_utc_timestamp(run_time),
+                        owner=self.worker_id,
+                        token=1,
+                        expires_at=time.time(),
+                        state="done",
+                    )
+                )
+        except IntegrityError:
+            return False
+        return True
+
+    def holds(self, lease):
+        """fencing: 租约仍由本次执行持有时才允许发送"""
+        with self._engine.begin() as connection:
+            row = connection.execute(
+                select(leases_t.c.token, leases_t.c.state).where(
+                    leases_t.c.job_id == lease.job_id, leases_t.c.run_time == lease.run_time
+                )
+            ).first()
+        if row is not None and row.token == lease.token and row.state == "running":
+            return True
+        self._count("fenced")
+        logger.warning(f"[TaskScheduler] 任务 {lease.job_id} 的这次运行已被其它进程接管, 不再发送")
+        return False
+
+    def release(self, lease):
+        with self._engine.begin() as connection:
+            connection.execute(
+                leases_t.update()
+                .where(
+                    leases_t.c.job_id == lease.job_id,
+                    leases_t.c.run_time == lease.run_time,
+                    leases_t.c.token == lease.token,
+                )
+                .values(state="done", expires_at=time.time())
+            )
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def _count(self, result):
+        with self._lock:
+            self.counts[result] += 1
+        if metrics.enabled:
+            metrics.inc("leases_total", (("result", result),))
+
+    def _run(self, generation):
+        scheduler = self._scheduler
+        last_renew = last_cleanup = 0.0
+        while self._generation == generation and scheduler.running:
+            now = time.time()
+            try:
+                if now - last_renew >= self.lease_ttl / 3:
+                    self._renew(now)
+                    last_renew = now
+                self._take_over(scheduler, now)
+                if now - last_cleanup >= 60:
+                    self._cleanup(now)
+                    last_cleanup = now
+                # 其它进程添加或提前的任务不会唤醒本进程的调度器
+                scheduler.wakeup()
+            except Exception as e:
+                logger.error(f"[TaskScheduler] 维护任务租约失败: {e}")
+            time.sleep(self.poll_interval)
+
+    def _renew(self, now):
+        with self._engine.begin() as connection:
+            connection.execute(
+                leases_t.update()
+                .where(leases_t.c.owner == self.worker_id, leases_t.c.state == "running")
+                .values(expires_at=now + self.lease_ttl)
+            )
+
+    def _take_over(self, scheduler, now):
+        with self._engine.begin() as connection:
+            expired = connection.execute(
+                select(
+                    leases_t.c.job_id, leases_t.c.run_time, leases_t.c.token, leases_t.c.owner,
+                    leases_t.c.payload, leases_t.c.executor,
+                )
+                .where(leases_t.c.state == "running", leases_t.c.expires_at < now)
+                .limit(100)
+            ).all()
+        for row in expired:
+            # 条件更新, 多个进程同时接管时只有一个成功
+            with self._engine.begin() as connection:
+                taken = connection.execute(
+                    leases_t.update()
+                    .where(
+                        leases_t.c.job_id == row.job_id,
+                        leases_t.c.run_time == row.run_time,
+                        leases_t.c.token == row.token,
+                        leases_t.c.state == "running",
+                    )
+                    .values(owner=self.worker_id, token=row.token + 1, state="done", expires_at=now)
+                ).rowcount
+            if taken != 1:
+                continue
+            self._count("taken_over")
+            if now - row.run_time > self.takeover_max_age or row.payload is None:
+                logger.warning(f"[TaskScheduler] 接管了 {row.owner} 的任务 {row.job_id}, 但已超过 {self.takeover_max_age} 秒, 不再执行")
+                continue
+            logger.warning(f"[TaskScheduler] 接管 {row.owner} 未完成的任务 {row.job_id}, 重新执行")
+            self._rerun(scheduler, row)
+
+    def _rerun(self, scheduler, row):
+        """以接管时刻作为运行时间重新提交, 执行器会为它认领一个新的租约"""
+        from .task_scheduler import task_execute
+
+        job = Job(
+            scheduler,
+            id=row.job_id,
+            func=task_execute,
+            trigger=DateTrigger(utc_timestamp_to_datetime(row.run_time)),
+            executor=row.executor or "default",
+            args=(row.payload,),
+            kwargs={},
+            misfire_grace_time=None,
+            coalesce=True,
+            max_instances=1,
+            next_run_time=None,
+        )
+        try:
+            scheduler._lookup_executor(job.executor).submit_job(job, [datetime.now(scheduler.timezone)])
+        except MaxInstancesReachedError:
+            logger.warning(f"[TaskScheduler] 任务 {job.id} 正在本进程执行, 跳过接管的运行")
+
+    def _cleanup(self, now):
+        with self._engine.begin() as connection:
+            connection.execute(
+                leases_t.delete().where(leases_t.c.state == "done", leases_t.c.expires_at < now - self.retention)
+            )
+
+
+if "leases" not in globals():
+    leases = LeaseManager()
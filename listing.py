@@ -0,0 +1,147 @@
+# encoding:utf-8
+from typing import Optional
+
+from apscheduler.util import utc_timestamp_to_datetime
+from sqlalchemy import Column, Index, Table, Unicode, UnicodeText, func, select
+
+from common.log import logger
+
+from .records import TaskRecord
+from .recipients import registry
+from .storage import get_meta, metadata, set_meta_op
+
+# 任务列表用的索引, 与 apscheduler_jobs 按 id 关联
+# 列表只查这张表和 next_run_time 列, 不需要反序列化任何 job
+index_t = Table(
+    "task_index",
+    metadata,
+    Column("job_id", Unicode(191), primary_key=True),
+    # 创建者昵称; itchat 的用户 id 每次登录都会变化, 与发送目标一样按昵称记录
+    Column("owner", Unicode(255)),
+    # 创建任务所在的会话, 与发送目标的 key 格式相同: group:<群名> / user:<昵称>
+    Column("chat", Unicode(191)),
+    Column("content", UnicodeText),
+    Column("group_name", Unicode(255)),
+    Column("cycle", Unicode(64)),
+    Column("time_str", Unicode(16)),
+    Index("ix_task_index_chat", "chat"),
+    Index("ix_task_index_owner", "owner"),
+)
+
+INDEX_VERSION = "1"
+
+
+def chat_key(is_group, nickname):
+    return f"{'group' if is_group else 'user'}:{nickname}"
+
+
+def index_values(record: TaskRecord, owner: Optional[str], chat: Optional[str]):
+    return {
+        "job_id": record.task_id,
+        "owner": owner,
+        "chat": chat,
+        "content": record.event,
+        "group_name": record.group_name,
+        "cycle": record.cycle,
+        "time_str": record.time_str,
+    }
+
+
+def index_op(record: TaskRecord, owner: Optional[str], chat: Optional[str]):
+    values = index_values(record, owner, chat)
+
+    def op(connection):
+        connection.execute(index_t.insert().prefix_with("OR REPLACE").values(**values))
+
+    return op
+
+
+def index_many_op(rows):
+    """批量写入索引, rows 为 index_values 的列表"""
+
+    def op(connection):
+        if rows:
+            connection.execute(index_t.insert().prefix_with("OR REPLACE"), rows)
+
+    return op
+
+
+def unindex_op(job_id: str):
+    def op(connection):
+        connection.execute(index_t.delete().where(index_t.c.job_id == job_id))
+
+    return op
+
+
+def backfill_index(scheduler, write_behind):
+    """给升级前创建的任务补建索引, 只执行一次"""
+    jobstore = scheduler._lookup_jobstore("default")
+    if get_meta(jobstore.engine, "task_index") == INDEX_VERSION:
+        return 0
+    count = 0
+    for job in scheduler.get_jobs():
+        record = TaskRecord.decode(job.args[0])
+        # 旧任务没有记录创建所在的会话, 用发送目标代替
+        recipient = registry.get(record.recipient_key)
+        chat = owner = None
+        if recipient is not None:
+            chat = chat_key(recipient.is_group, recipient.nickname)
+            # 私聊任务的创建者就是私聊对象
+            owner = recipient.nickname if not recipient.is_group else None
+        write_behind.put(("index", job.id), index_op(record, record.actual_user_nickname or owner, chat))
+        count += 1
+    write_behind.put(("meta", "task_index"), set_meta_op("task_index", INDEX_VERSION))
+    write_behind.flush()
+    logger.info(f"[TaskScheduler] 已为 {count} 个任务建立索引")
+    return count
+
+
+class TaskPage:
+    """任务列表的一页"""
+
+    __slots__ = ("page", "pages", "total", "rows")
+
+    def __init__(self, page, pages, total, rows):
+        self.page = page
+        self.pages = pages
+        self.total = total
+        self.rows = rows
+
+
+def query_tasks(jobstore, chat=None, owner=None, keyword=None, page=1, page_size=10, timezone=None):
+    """
+    按会话/创建者/关键词分页查询任务, 按下次运行时间排序, 暂停的任务排在最后
+    rows 为 (job_id, next_run_time, content, group_name) 列表
+    """
+    jobs_t = jobstore.jobs_t
+    conditions = []
+    if chat is not None:
+        conditions.append(index_t.c.chat == chat)
+    if owner is not None:
+        conditions.append(index_t.c.owner == owner)
+    if keyword:
+        conditions.append(index_t.c.content.contains(keyword, autoescape=True))
+
+    joined = index_t.join(jobs_t, jobs_t.c.id == index_t.c.job_id)
+    with jobstore.engine.begin() as connection:
+        total = connection.execute(
+            select(func.count()).select_from(joined).where(*conditions)
+        ).scalar()
+        pages = max((total + page_size - 1) // page_size, 1)
+        page = min(max(page, 1), pages)
+        result = connection.execute(
+            select(index_t.c.job_id, jobs_t.c.next_run_time, index_t.c.content, index_t.c.group_name)
+            .select_from(joined)
+            .where(*conditions)
+            .order_by(jobs_t.c.next_run_time.is_(None), jobs_t.c.next_run_time, index_t.c.job_id)
+            .limit(page_size)
+            .offset((page - 1) * page_size)
+        )
+        rows = []
+        for job_id, next_run_time, content, group_name in result:
+            if next_run_time is not None:
+                next_run_time = utc_timestamp_to_datetime(next_run_time)
+                if timezone is not None:
+                    next_run_time = next_run_time.astimezone(timezone)
+            rows.append((job_id, next_run_time, content, group_name))
+    return TaskPage(page, pages, total, rows)
@@ -0,0 +1,308 @@
+# encoding:utf-8
+import re
+import threading
+from bisect import bisect_left
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MISSED
+from pytz import utc
+
+from common.log import logger
+
+from .commands import command_table
+from .records import TaskRecord
+
+# 直方图的桶上限(秒), 最后一个桶为 +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+HISTOGRAMS = {
+    "fire_lag_seconds": "计划运行时间到开始执行的延迟",
+    "check_seconds": "提交前条件检查耗时",
+    "plugin_seconds": "调用其他插件耗时",
+    "send_seconds": "channel.send 耗时",
+    "queue_wait_seconds": "在执行池中排队等待的时间",
+}
+
+COUNTERS = {
+    "fires_total": "开始执行的次数",
+    "misfires_total": "错过执行的次数",
+    "skips_total": "条件不满足跳过的次数",
+    "failures_total": "执行失败的次数",
+    "deadline_drops_total": "超过执行池截止时间而放弃的次数",
+    "catchup_total": "重启后补发(replayed)或放弃补发(dropped)错过的任务的次数",
+    "leases_total": "多进程协调中认领(claimed)、由其它进程执行(skipped)、接管(taken_over)与被接管后放弃发送(fenced)的次数",
+}
+
+POOL_GAUGES = {
+    "capacity": "执行池的线程数或并发上限",
+    "queued": "在执行池中排队的任务数",
+    "running": "在执行池中执行的任务数",
+}
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.sum += other.sum
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """按桶内线性插值估算分位数"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+
+def cycle_type(cycle):
+    if not cycle:
+        return "unknown"
+    if cycle.startswith("cron["):
+        return "cron"
+    if cycle in ("今天", "明天", "后天") or re.match(r"\d{4}-\d{2}-\d{2}", cycle):
+        return "date"
+    if cycle.startswith("每周"):
+        return "weekly"
+    if cycle == "每天":
+        return "daily"
+    if cycle == "工作日":
+        return "workday"
+    return "other"
+
+
+def task_labels(record: TaskRecord):
+    """按周期类型与命中的 custom_commands 关键词分组"""
+    custom_command = command_table().match(record.event)
+    command = custom_command["key_word"] if custom_command is not None else ""
+    return (("cycle", cycle_type(record.cycle)), ("command", command))
+
+
+class Metrics:
+    """
+    调度延迟与吞吐的指标, 只在内存里聚合
+    关闭时所有埋点都在调用方以 metrics.enabled 判断后直接跳过
+    每次触发的生命周期: job_submitted -> job_started -> 调度器的执行/错过/出错事件
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        # job_id -> [计划运行时间, labels, 是否已开始]
+        self._fires = {}
+        self._server = None
+        self._port = 0
+        self._pools = {}
+
+    def configure(self, enabled=False, prometheus_port=0):
+        self.enabled = bool(enabled)
+        if not self.enabled:
+            with self._lock:
+                self._fires.clear()
+        self._serve(int(prometheus_port) if self.enabled else 0)
+
+    def observe(self, name, value, labels=()):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, labels=(), n=1):
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + n
+
+    def failure(self, labels, stage):
+        self.inc("failures_total", labels + (("stage", stage),))
+
+    def job_labels(self, job):
+        try:
+            return task_labels(TaskRecord.decode(job.args[0]))
+        except Exception:
+            return (("cycle", "unknown"), ("command", ""))
+
+    def job_submitted(self, job_id, run_times, labels):
+        with self._lock:
+            self._fires[job_id] = [run_times[-1], labels, False]
+
+    def job_forgotten(self, job_id, run_time):
+        """提交后没有执行也不会产生调度器事件的运行, 比如已由其它进程认领"""
+        with self._lock:
+            fire = self._fires.get(job_id)
+            if fire is not None and fire[0] == run_time:
+                del self._fires[job_id]
+
+    def job_started(self, record: TaskRecord):
+        """任务开始执行时调用, 记录触发延迟, 返回该任务的 labels"""
+        with self._lock:
+            fire = self._fires.get(record.task_id)
+            if fire is not None:
+                fire[2] = True
+        if fire is None:
+            # 不是由调度器提交的执行(或者开启指标前提交的)
+            labels = task_labels(record)
+        else:
+            run_time, labels, _ = fire
+            self.observe("fire_lag_seconds", max((datetime.now(utc) - run_time).total_seconds(), 0.0), labels)
+        self.inc("fires_total", labels)
+        return labels
+
+    def on_job_event(self, event):
+        """调度器的执行完成/错过/出错事件"""
+        if not self.enabled:
+            return
+        with self._lock:
+            fire = self._fires.get(event.job_id)
+            if fire is not None and fire[0] == event.scheduled_run_time:
+                del self._fires[event.job_id]
+        labels = fire[1] if fire is not None else (("cycle", "unknown"), ("command", ""))
+        if event.code == EVENT_JOB_MISSED:
+            self.inc("misfires_total", labels)
+        elif event.code == EVENT_JOB_ERROR:
+            self.failure(labels, "job")
+
+    def register_pools(self, executors):
+        """执行池的饱和度不依赖 enabled, 插件重载后替换为新的执行器"""
+        self._pools = {alias: executor.stats for alias, executor in executors.items() if hasattr(executor, "stats")}
+
+    def pool_gauges(self):
+        return {alias: stats.snapshot() for alias, stats in sorted(self._pools.items())}
+
+    def gauges(self):
+        with self._lock:
+            started = sum(1 for fire in self._fires.values() if fire[2])
+            return {
+                "queue_depth": len(self._fires) - started,
+                "running": started,
+                "active_threads": threading.active_count(),
+            }
+
+    def summary(self):
+        """按指标名合并各个 labels, 返回 (直方图, 计数器, 按周期类型的触发延迟)"""
+        histograms = {}
+        counters = {}
+        lag_by_cycle = {}
+        with self._lock:
+            for (name, labels), histogram in self._histograms.items():
+                histograms.setdefault(name, Histogram()).merge(histogram)
+                if name == "fire_lag_seconds":
+                    lag_by_cycle.setdefault(dict(labels)["cycle"], Histogram()).merge(histogram)
+            for (name, labels), value in self._counters.items():
+                counters[name] = counters.get(name, 0) + value
+        return histograms, counters, lag_by_cycle
+
+    def render_prometheus(self):
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        for name, help_text in HISTOGRAMS.items():
+            metric = f"taskscheduler_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for (hname, labels), histogram in histograms:
+                if hname != name:
+                    continue
+                cumulative = 0
+                for i, n in enumerate(histogram.counts):
+                    cumulative += n
+                    le = str(BUCKETS[i]) if i < len(BUCKETS) else "+Inf"
+                    lines.append(f"{metric}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{metric}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{metric}_count{_format_labels(labels)} {histogram.count}")
+        for name, help_text in COUNTERS.items():
+            metric = f"taskscheduler_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for (cname, labels), value in counters:
+                if cname == name:
+                    lines.append(f"{metric}{_format_labels(labels)} {value}")
+        for name, value in self.gauges().items():
+            metric = f"taskscheduler_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        pools = self.pool_gauges()
+        for name, help_text in POOL_GAUGES.items():
+            metric = f"taskscheduler_pool_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            for alias, snapshot in pools.items():
+                lines.append(f"{metric}{_format_labels((('pool', alias),))} {snapshot[name]}")
+        return "\n".join(lines) + "\n"
+
+    def _serve(self, port):
+        """在 127.0.0.1:port 提供 Prometheus 文本格式的 /metrics, 插件重载时端口不变则保留"""
+        if port == self._port:
+            return
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self._port = 0
+        if not port:
+            return
+        try:
+            self._server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+        except OSError as e:
+            logger.error(f"[TaskScheduler] 指标端口 {port} 启动失败: {e}")
+            return
+        self._server.daemon_threads = True
+        self._port = port
+        threading.Thread(target=self._server.serve_forever, name="TaskScheduler-metrics", daemon=True).start()
+        logger.info(f"[TaskScheduler] 指标地址: http://127.0.0.1:{port}/metrics")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if "metrics" not in globals():
+    metrics = Metrics()
@@ -0,0 +1,245 @@
+# encoding:utf-8
+import threading
+import time
+from datetime import datetime
+
+from apscheduler.events import EVENT_JOB_ADDED, EVENT_JOB_MODIFIED, EVENT_JOB_REMOVED
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
+
+from common.log import logger
+
+from .records import TaskRecord
+from .storage import jobs_before, lookup_jobs
+
+# 单个任务在预览范围内最多展开的运行次数, 每秒运行的 cron 也不会占满内存
+MAX_FIRES_PER_JOB = 5000
+# 添加任务提示高峰时, 在前后多少分钟内寻找更空闲的时间
+QUIET_SEARCH_MINUTES = 10
+
+
+class FirePreview:
+    """
+    未来 horizon 内所有任务的运行时间, 按分钟聚合为 [运行次数, 发送条数], 用于查看某段时间的负载
+    - 第一次查询时只读取 horizon 内会运行的任务, 逐个展开 Trigger; 之后的查询只读内存
+    - 添加、修改与取消任务只把任务记为待更新, 下一次查询时只重新展开这些任务
+    - 查询超出已展开的范围, 或者配置了 ttl 且已经过期(多进程部署时其它进程添加的任务)时, 在查询时整体重建
+    - 同一个 Trigger 定义与下次运行时间的任务(比如大量的 每天 08:00)只展开一次
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+        self._scheduler = None
+        self.horizon = 48 * 3600
+        self.ttl = 0
+        self.hot_threshold = 0
+        self._reset()
+
+    def _reset(self):
+        # 分钟(UTC 时间戳 // 60) -> [运行次数, 发送条数], 未建立时为 None
+        self._minutes = None
+        # job id -> (运行所在的分钟, 每次运行的发送条数)
+        self._jobs = {}
+        self._dirty = set()
+        self._tracking = False
+        self._building = False
+        self._end = 0
+        self._built_at = 0.0
+
+    def configure(self, horizon_hours=48, ttl=0, hot_threshold=0):
+        self.horizon = int(horizon_hours * 3600)
+        self.ttl = ttl
+        self.hot_threshold = int(hot_threshold)
+
+    def bind(self, scheduler):
+        with self._lock:
+            self._scheduler = scheduler
+            self._reset()
+        scheduler.add_listener(self._on_job_event, EVENT_JOB_ADDED | EVENT_JOB_MODIFIED | EVENT_JOB_REMOVED)
+
+    def touch(self, job_ids):
+        """不经过调度器事件修改的任务(比如批量导入), 记为待更新"""
+        with self._lock:
+            if self._tracking:
+                self._dirty.update(job_ids)
+
+    def histogram(self, start: datetime, end: datetime):
+        """[start, end) 内有任务运行的每一分钟, 返回 [(分钟开始时间, 运行次数, 发送条数)]"""
+        first = int(datetime_to_utc_timestamp(start) // 60)
+        last = -int(-datetime_to_utc_timestamp(end) // 60)
+        self._ensure(last * 60)
+        with self._lock:
+            minutes = self._minutes
+            rows = []
+            for minute in range(first, last):
+                load = minutes.get(minute)
+                if load is not None and load[0]:
+                    rows.append((utc_timestamp_to_datetime(minute * 60).astimezone(start.tzinfo), load[0], load[1]))
+        return rows
+
+    def hot_minutes(self, trigger, sends=1):
+        """
+        添加任务前检查它在 horizon 内的运行时间是否落在高峰分钟, 返回 [(分钟开始时间, 已有的发送条数)]
+        只使用已经建立的预览, 尚未建立时在后台建立, 本次不提示
+        """
+        if self.hot_threshold <= 0:
+            return []
+        with self._lock:
+            minutes = self._minutes
+            end = self._end
+            stale = (minutes is None or self._expired(time.time())) and not self._building
+            if stale:
+                self._building = True
+        if stale:
+            threading.Thread(target=self._build_in_background, name="TaskScheduler-preview", daemon=True).start()
+        if minutes is None:
+            return []
+        now = datetime.now(self._scheduler.timezone)
+        # 展开触发器可能要算上千次, 不持有锁; 锁只用来读取计数
+        job_minutes = self._expand(trigger, None, now, end)
+        hot = []
+        with self._lock:
+            for minute in job_minutes:
+                load = minutes.get(minute)
+                if load is not None and load[1] + sends >= self.hot_threshold:
+                    hot.append((minute, load[1]))
+        return [(utc_timestamp_to_datetime(minute * 60).astimezone(now.tzinfo), load) for minute, load in hot]
+
+    def quiet_minute(self, when: datetime):
+        """when 前后 QUIET_SEARCH_MINUTES 分钟内发送最少的一分钟, 返回 (分钟开始时间, 发送条数)"""
+        center = int(datetime_to_utc_timestamp(when) // 60)
+        floor = int(time.time() // 60) + 1
+        with self._lock:
+            minutes = self._minutes or {}
+            candidates = [
+                (minutes.get(minute, (0, 0))[1], abs(minute - center), minute)
+                for minute in range(max(center - QUIET_SEARCH_MINUTES, floor), center + QUIET_SEARCH_MINUTES + 1)
+                if minute != center
+            ]
+        if not candidates:
+            return None
+        sends, _, minute = min(candidates)
+        return utc_timestamp_to_datetime(minute * 60).astimezone(when.tzinfo), sends
+
+    def _build_in_background(self):
+        try:
+            self._build(time.time() + self.horizon)
+        except Exception as e:
+            logger.error(f"[TaskScheduler] 建立运行时间预览失败: {e}")
+        finally:
+            with self._lock:
+                self._building = False
+
+    def _on_job_event(self, event):
+        with self._lock:
+            if self._tracking:
+                self._dirty.add(event.job_id)
+
+    def _ensure(self, until):
+        now = time.time()
+        with self._lock:
+            fresh = self._minutes is not None and not self._expired(now) and until <= self._end
+        if fresh:
+            self._refresh()
+        else:
+            self._build(max(until, now + self.horizon))
+
+    def _build(self, until):
+        with self._build_lock:
+            now = time.time()
+            with self._lock:
+                if self._minutes is not None and not self._expired(now) and until <= self._end:
+                    # 等待期间其它线程已经建好
+                    return
+                # 从这里开始记录变化的任务, 建立期间的修改在建好后补上
+                self._tracking = True
+                self._dirty.clear()
+            started = time.perf_counter()
+            scheduler = self._scheduler
+            jobstore = scheduler._lookup_jobstore("default")
+            start = datetime.now(scheduler.timezone)
+            jobs = {}
+            minutes = {}
+            expansions = {}
+            for job in jobs_before(jobstore, until):
+                entry = self._job_entry(job, start, until, expansions)
+                if entry is not None:
+                    jobs[job.id] = entry
+                    _apply(minutes, entry, 1)
+            with self._lock:
+                self._jobs = jobs
+                self._minutes = minutes
+                self._end = int(until)
+                self._built_at = now
+            self._refresh()
+        logger.info(f"[TaskScheduler] 运行时间预览已建立: {len(jobs)} 个任务, 用时 {time.perf_counter() - started:.2f}s")
+
+    def _refresh(self):
+        """重新展开待更新的任务, 读取 job 时不持有锁"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            until = self._end
+        if not dirty:
+            return
+        start = datetime.now(self._scheduler.timezone)
+        jobs = {job.id: job for job in lookup_jobs(self._scheduler._lookup_jobstore("default"), list(dirty))}
+        entries = {job_id: self._job_entry(jobs[job_id], start, until) if job_id in jobs else None for job_id in dirty}
+        with self._lock:
+            for job_id, entry in entries.items():
+                old = self._jobs.pop(job_id, None)
+                if old is not None:
+                    _apply(self._minutes, old, -1)
+                if entry is not None:
+                    self._jobs[job_id] = entry
+                    _apply(self._minutes, entry, 1)
+
+    def _expired(self, now):
+        return bool(self.ttl) and now - self._built_at >= self.ttl
+
+    def _job_entry(self, job, start, until, expansions=None):
+        if job.next_run_time is None:
+            # 暂停的任务
+            return None
+        if expansions is None:
+            minutes = self._expand(job.trigger, job.next_run_time, start, until)
+        else:
+            # 展开 CronTrigger 是建立预览的主要耗时, 相同的定义只展开一次
+            key = (repr(job.trigger), job.next_run_time)
+            minutes = expansions.get(key)
+            if minutes is None:
+                minutes = expansions[key] = tuple(self._expand(job.trigger, job.next_run_time, start, until))
+        if not minutes:
+            return None
+        return tuple(minutes), len(TaskRecord.decode(job.args[0]).recipient_keys)
+
+    @staticmethod
+    def _expand(trigger, next_run_time, start, until):
+        """trigger 在 [start, until) 内的每次运行所在的分钟; next_run_time 为空时从 start 开始计算"""
+        if next_run_time is None:
+            next_run_time = trigger.get_next_fire_time(None, start)
+        minutes = []
+        fire = next_run_time
+        while fire is not None and len(minutes) < MAX_FIRES_PER_JOB:
+            timestamp = datetime_to_utc_timestamp(fire)
+            if timestamp >= until:
+                break
+            if fire >= start:
+                minutes.append(int(timestamp // 60))
+            fire = trigger.get_next_fire_time(fire, fire)
+        return minutes
+
+
+def _apply(minutes, entry, sign):
+    job_minutes, sends = entry
+    for minute in job_minutes:
+        load = minutes.get(minute)
+        if load is None:
+            load = minutes[minute] = [0, 0]
+        load[0] += sign
+        load[1] += sign * sends
+        if not load[0]:
+            del minutes[minute]
+
+
+if "fire_preview" not in globals():
+    fire_preview = FirePreview()
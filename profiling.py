@@ -0,0 +1,259 @@
+# encoding:utf-8
+import cProfile
+import glob
+import os
+import pstats
+import sys
+import sysconfig
+import threading
+import time
+from collections import Counter
+
+from common.log import logger
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+STDLIB_DIR = sysconfig.get_paths()["stdlib"]
+MODES = ("sample", "cprofile")
+# Python 3.12 起 cProfile 通过进程级的 sys.monitoring 注册: 同一时间只能开启一个, 开启后统计所有线程
+PROCESS_WIDE_CPROFILE = sys.version_info >= (3, 12)
+# 插件自己的后台线程大部分时间在等待, 不计入采样
+BACKGROUND_THREADS = (
+    "TaskScheduler-leases",
+    "TaskScheduler-write-behind",
+    "TaskScheduler-catchup",
+    "TaskScheduler-drain",
+    "TaskScheduler-metrics",
+    "TaskScheduler-profile",
+    "TaskScheduler-relogin",
+)
+
+
+class ProfileResult:
+    __slots__ = ("mode", "seconds", "path", "samples", "top", "skipped")
+
+    def __init__(self, mode, seconds, path, samples, top, skipped=0):
+        self.mode = mode
+        self.seconds = seconds
+        self.path = path
+        # 采样数或被统计的调用次数
+        self.samples = samples
+        # [(名称, 说明)], 按耗时从高到低
+        self.top = top
+        # 因为无法开启 cProfile 而没有统计的调用次数
+        self.skipped = skipped
+
+
+class Profiler:
+    """
+    按需的性能分析, 同一时间只有一次, 结束后写入插件目录并返回耗时最多的函数
+    - sample: 后台线程定时读取各线程的调用栈, 只统计正在执行插件代码的线程(执行器、调度器与消息处理),
+      结果为 collapsed stack(.folded), 可以直接用 flamegraph.pl 或 speedscope 查看
+    - cprofile: 条件检查、插件调用与发送期间逐次开启 cProfile, 结果为 pstats(.pstats);
+      Python 3.12 起整个分析期间只开启一个 cProfile, 统计所有线程, 回复中只列出插件与第三方库的函数
+    没有进行中的分析时, 执行器只多一次属性判断; 无法开启 cProfile 时照常执行, 只是不统计
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.busy = False
+        # cprofile 模式进行中时为已完成的 cProfile.Profile 列表
+        self._profiles = None
+        self._skipped = 0
+
+    def call(self, func, *args, **kwargs):
+        profiles = self._profiles
+        if profiles is None:
+            return func(*args, **kwargs)
+        # cProfile 只能统计开启它的线程, 每次调用各用一个, 结束时合并
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # 其它分析工具(比如调试器)正在使用, 不能因为分析让任务失败
+            with self._lock:
+                self._skipped += 1
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                profiles.append(profile)
+
+    def run(self, seconds, mode="sample", directory=PLUGIN_DIR, top=10, interval=0.01, keep=10):
+        """分析 seconds 秒, 阻塞到结束, 返回 ProfileResult; 已有分析在进行时抛出 RuntimeError"""
+        if mode not in MODES:
+            raise ValueError(f"不支持的分析模式: {mode}, 可选 {', '.join(MODES)}")
+        with self._lock:
+            if self.busy:
+                raise RuntimeError("已有一个性能分析正在进行")
+            self.busy = True
+            self._skipped = 0
+        logger.info(f"[TaskScheduler] 开始性能分析({mode}), {seconds} 秒")
+        try:
+            name = os.path.join(directory, f"profile-{time.strftime('%Y%m%d-%H%M%S')}")
+            if mode == "sample":
+                result = self._sample(seconds, interval, name + ".folded", top)
+            else:
+                result = self._cprofile(seconds, name + ".pstats", top)
+            _prune(directory, keep)
+        finally:
+            with self._lock:
+                self.busy = False
+                self._profiles = None
+        logger.info(f"[TaskScheduler] 性能分析结束, 结果: {result.path}")
+        return result
+
+    def _sample(self, seconds, interval, path, top):
+        stacks = Counter()
+        stdlib = set()
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me or names.get(ident, "").startswith(BACKGROUND_THREADS):
+                    continue
+                stack = _stack(frame, stdlib)
+                if stack is not None:
+                    stacks[stack] += 1
+            time.sleep(interval)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+        return ProfileResult("sample", seconds, path, sum(stacks.values()), _summarize_stacks(stacks, stdlib, top))
+
+    def _cprofile(self, seconds, path, top):
+        if PROCESS_WIDE_CPROFILE:
+            profiles = [self._profile_process(seconds)]
+        else:
+            profiles = []
+            self._profiles = profiles
+            time.sleep(seconds)
+            self._profiles = None
+        with self._lock:
+            profiles = list(profiles)
+            skipped = self._skipped
+        stats = pstats.Stats()
+        for profile in profiles:
+            stats.add(profile)
+        if not stats.stats:
+            # 期间没有任务执行, 仍然写入空结果, 便于与其它时段比较
+            open(path, "wb").close()
+            return ProfileResult("cprofile", seconds, path, 0, [], skipped)
+        stats.dump_stats(path)
+        calls = sum(nc for _, nc, _, _, _ in stats.stats.values())
+        rows = sorted(
+            (row for row in stats.stats.items() if not _is_profiler(row[0])), key=lambda item: item[1][3], reverse=True
+        )
+        if PROCESS_WIDE_CPROFILE:
+            # 所有线程都被统计, 线程入口与空闲等待(锁、sleep)的累计耗时会排在最前面
+            rows = [row for row in rows if not _is_stdlib(row[0][0])]
+        return ProfileResult(
+            "cprofile",
+            seconds,
+            path,
+            calls,
+            [
+                (_pstats_name(key), f"累计 {ct:.3f}s, 自身 {tt:.3f}s, {nc} 次")
+                for key, (_, nc, tt, ct, _) in rows[:top]
+            ],
+            skipped,
+        )
+
+    def _profile_process(self, seconds):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            raise RuntimeError(f"无法开启 cProfile, 可能有其它分析工具正在运行: {e}")
+        try:
+            time.sleep(seconds)
+        finally:
+            profile.disable()
+        return profile
+
+
+def _frame_name(code):
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def _stack(frame, stdlib):
+    """从外到内的调用栈, 不包含插件代码的栈(空闲的线程)返回 None; 标准库的函数名记录到 stdlib"""
+    names = []
+    in_plugin = False
+    while frame is not None:
+        code = frame.f_code
+        if code is _CALL_CODE:
+            # cprofile 模式的包装, 不属于被分析的代码
+            frame = frame.f_back
+            continue
+        name = _frame_name(code)
+        filename = code.co_filename
+        if filename.startswith(PLUGIN_DIR):
+            in_plugin = True
+        elif _is_stdlib(filename):
+            stdlib.add(name)
+        names.append(name)
+        frame = frame.f_back
+    if not in_plugin:
+        return None
+    names.reverse()
+    return tuple(names)
+
+
+def _is_stdlib(filename):
+    # pstats 里的内置函数的文件名为 ~
+    return filename == "~" or (filename.startswith(STDLIB_DIR) and "site-packages" not in filename)
+
+
+def _is_profiler(key):
+    # 包装函数与 cProfile 自身的 enable/disable
+    return key[:2] == _CALL_KEY or "_lsprof.Profiler" in key[2]
+
+
+def _summarize_stacks(stacks, stdlib, top):
+    total = sum(stacks.values())
+    if not total:
+        return []
+    inclusive = Counter()
+    for stack, count in stacks.items():
+        # 递归的函数在一个栈里只算一次
+        for name in set(stack):
+            inclusive[name] += count
+    rows = []
+    for name, count in inclusive.most_common():
+        if name in stdlib:
+            # 线程、线程池与事件循环的入口在每个栈里都有, 不列出
+            continue
+        rows.append((name, f"{count / total:.0%}"))
+        if len(rows) >= top:
+            break
+    return rows
+
+
+def _pstats_name(key):
+    filename, line, func = key
+    if filename == "~":
+        # 内置函数, 例如 <method 'acquire' of '_thread.lock' objects>
+        return func
+    return f"{os.path.splitext(os.path.basename(filename))[0]}:{func}:{line}"
+
+
+def _prune(directory, keep):
+    """只保留最近 keep 次的结果"""
+    files = glob.glob(os.path.join(directory, "profile-*.folded")) + glob.glob(os.path.join(directory, "profile-*.pstats"))
+    files.sort(key=os.path.getmtime)
+    for path in files[:-max(keep, 1)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+if "profiler" not in globals():
+    profiler = Profiler()
+# 重载后沿用的是旧的 Profiler 类
+_CALL_CODE = type(profiler).call.__code__
+_CALL_KEY = (_CALL_CODE.co_filename, _CALL_CODE.co_firstlineno)
@@ -0,0 +1,150 @@
+# encoding:utf-8
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Bucket:
+    """
+    以 GCRA 实现的令牌桶: rate 为每秒允许的条数, burst 为允许的突发条数
+    只记录理论到达时间(tat), 不需要定时补充令牌
+    """
+
+    __slots__ = ("interval", "tolerance", "tat")
+
+    def __init__(self, rate, burst):
+        self.interval = 1.0 / rate
+        self.tolerance = self.interval * (max(int(burst), 1) - 1)
+        self.tat = 0.0
+
+    def earliest(self, now):
+        return max(now, self.tat - self.tolerance)
+
+    def commit(self, at):
+        self.tat = max(self.tat, at) + self.interval
+
+
+class SendGate:
+    """
+    channel.send 之前的限流: 全局一个令牌桶, 每个会话各一个令牌桶
+    只会推迟发送, 不会丢弃消息; 排队数量和等待时间可以通过 stats() 读取
+    rate 为 0 表示不限制
+    """
+
+    def __init__(self, global_rate=0, global_burst=1, per_chat_rate=0, per_chat_burst=1, max_chats=4096):
+        self._lock = threading.Lock()
+        self._chats = OrderedDict()
+        self.configure(global_rate, global_burst, per_chat_rate, per_chat_burst, max_chats)
+
+        self.waiting = 0
+        self.admitted = 0
+        self.delayed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def configure(self, global_rate=0, global_burst=1, per_chat_rate=0, per_chat_burst=1, max_chats=4096):
+        with self._lock:
+            self._global = _Bucket(global_rate, global_burst) if global_rate else None
+            self.per_chat_rate = per_chat_rate
+            self.per_chat_burst = per_chat_burst
+            self.max_chats = max_chats
+            self._chats.clear()
+
+    @property
+    def enabled(self):
+        return self._global is not None or bool(self.per_chat_rate)
+
+    def reserve_chat(self, chat_key):
+        """预约会话的发送时间, 返回还需要等待的秒数"""
+        if not self.per_chat_rate:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._chats.get(chat_key)
+            if bucket is None:
+                bucket = self._chats[chat_key] = _Bucket(self.per_chat_rate, self.per_chat_burst)
+                while len(self._chats) > self.max_chats:
+                    self._chats.popitem(last=False)
+            else:
+                self._chats.move_to_end(chat_key)
+            start = bucket.earliest(now)
+            bucket.commit(start)
+        return start - now
+
+    def reserve_global(self):
+        """预约全局的发送时间, 返回还需要等待的秒数"""
+        if self._global is None:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            start = self._global.earliest(now)
+            self._global.commit(start)
+        return start - now
+
+    def acquire(self, chat_key):
+        """阻塞直到允许发送, 供线程池执行器使用"""
+        if not self.enabled:
+            return 0.0
+        self._add_waiting(1)
+        try:
+            # 先等会话自己的配额, 再占全局配额, 被单个会话限住的消息不会占着全局的名额
+            waited = self._sleep(self.reserve_chat(chat_key))
+            waited += self._sleep(self.reserve_global())
+        finally:
+            self._add_waiting(-1)
+        self._record(waited)
+        return waited
+
+    async def acquire_async(self, chat_key):
+        """在事件循环里等待, 不占用线程"""
+        if not self.enabled:
+            return 0.0
+        self._add_waiting(1)
+        try:
+            waited = 0.0
+            delay = self.reserve_chat(chat_key)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                waited += delay
+            delay = self.reserve_global()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                waited += delay
+        finally:
+            self._add_waiting(-1)
+        self._record(waited)
+        return waited
+
+    def stats(self):
+        with self._lock:
+            return {
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "delayed": self.delayed,
+                "avg_wait": self.total_wait / self.delayed if self.delayed else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+    def _add_waiting(self, n):
+        with self._lock:
+            self.waiting += n
+
+    def _record(self, waited):
+        with self._lock:
+            self.admitted += 1
+            if waited > 0:
+                self.delayed += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+
+    @staticmethod
+    def _sleep(delay):
+        if delay > 0:
+            time.sleep(delay)
+            return delay
+        return 0.0
+
+
+if "send_gate" not in globals():
+    send_gate = SendGate()
@@ -0,0 +1,187 @@
+# encoding:utf-8
+import threading
+import time
+
+from sqlalchemy import Boolean, Column, Float, Table, Unicode, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from bridge.context import ContextType
+from channel.chat_message import ChatMessage
+from common.log import logger
+
+from .runtime import runtime_state
+from .storage import metadata
+from .tools import get_channel_tools
+
+recipients_t = Table(
+    "task_recipients",
+    metadata,
+    Column("key", Unicode(191), primary_key=True),
+    Column("is_group", Boolean, nullable=False),
+    Column("nickname", Unicode(255)),
+    Column("chat_id", Unicode(191)),
+    Column("bot_user_id", Unicode(191)),
+    Column("bot_nickname", Unicode(255)),
+    Column("updated_at", Float),
+)
+
+
+class Recipient:
+    """任务的发送目标(群聊或私聊), 多个任务共享同一行"""
+
+    __slots__ = ("key", "is_group", "nickname", "chat_id", "bot_user_id", "bot_nickname")
+
+    def __init__(self, key, is_group, nickname, chat_id, bot_user_id, bot_nickname):
+        self.key = key
+        self.is_group = is_group
+        self.nickname = nickname
+        self.chat_id = chat_id
+        self.bot_user_id = bot_user_id
+        self.bot_nickname = bot_nickname
+
+
+class RecipientRegistry:
+    """
+    tasks.db 里的 task_recipients 表的内存镜像
+    任务只保存 recipient key, 机器人重新登录后只需要按会话修复, 而不是逐个任务修复
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._recipients = {}
+        self._engine = None
+        self._write_behind = None
+        self._shared = False
+
+    def bind(self, engine, write_behind, shared=False):
+        rows = {}
+        with engine.begin() as connection:
+            for row in connection.execute(select(recipients_t)):
+                rows[row.key] = Recipient(
+                    row.key, row.is_group, row.nickname, row.chat_id, row.bot_user_id, row.bot_nickname
+                )
+        with self._lock:
+            self._engine = engine
+            self._write_behind = write_behind
+            self._shared = shared
+            self._recipients = rows
+        logger.info(f"[TaskScheduler] 已加载 {len(rows)} 个发送目标")
+
+    def get(self, key):
+        recipient = self._recipients.get(key)
+        if recipient is None and self._shared:
+            # tasks.db 由多个进程共用时, 其它进程添加任务时登记的发送目标不在内存里
+            recipient = self._load(key)
+        return recipient
+
+    def _load(self, key):
+        with self._engine.begin() as connection:
+            row = connection.execute(select(recipients_t).where(recipients_t.c.key == key)).first()
+        if row is None:
+            return None
+        with self._lock:
+            return self._recipients.setdefault(
+                key, Recipient(row.key, row.is_group, row.nickname, row.chat_id, row.bot_user_id, row.bot_nickname)
+            )
+
+    def __len__(self):
+        return len(self._recipients)
+
+    def register(self, is_group, chat_id, nickname, bot_user_id, bot_nickname):
+        """登记一个发送目标, 返回它的 key; 同一个会话的多个任务会得到同一个 key"""
+        key = f"{'group' if is_group else 'user'}:{nickname}"
+        with self._lock:
+            existing = self._recipients.get(key)
+            if existing is not None and existing.bot_user_id == bot_user_id and existing.chat_id != chat_id:
+                # 同一次登录里确实存在两个同名会话, 用 id 区分
+                key = f"{key}#{chat_id}"
+                existing = self._recipients.get(key)
+            if existing is not None and (existing.chat_id, existing.bot_user_id) == (chat_id, bot_user_id):
+                return key
+            recipient = Recipient(key, is_group, nickname, chat_id, bot_user_id, bot_nickname)
+            self._recipients[key] = recipient
+            self._save(recipient)
+        return key
+
+    def repair(self, recipient: Recipient, bot_user_id):
+        """根据昵称重新解析一个发送目标的 id(当然这是不可靠的, 因为昵称可以相同)"""
+        channel_tools = get_channel_tools()
+        with self._lock:
+            if recipient.bot_user_id == bot_user_id:
+                return True
+            try:
+                if recipient.is_group:
+                    chat_id = channel_tools.get_group_id_by_name(recipient.nickname)
+                else:
+                    chat_id = channel_tools.get_user_id_by_name(recipient.nickname)
+            except Exception as e:
+                logger.error(f"[TaskScheduler] 更新发送目标 {recipient.key} 失败: {e}")
+                return False
+            if chat_id is None:
+                logger.error(f"[TaskScheduler] 更新发送目标 {recipient.key} 失败: 没有找到 {recipient.nickname}")
+                return False
+            recipient.chat_id = chat_id
+            recipient.bot_user_id = bot_user_id
+            self._save(recipient)
+            return True
+
+    def reconcile(self, bot_user_id):
+        """
+        重新登录后一次性修复所有发送目标, 在一个事务里提交
+        逐个加锁修复, 期间触发的任务只会等它自己的发送目标, 不会等整个通讯录查完
+        """
+        write_behind = self._write_behind
+        if write_behind is None:
+            return 0
+        with self._lock:
+            stale = [r for r in self._recipients.values() if r.bot_user_id != bot_user_id]
+        if not stale:
+            return 0
+        repaired = sum(1 for r in stale if self.repair(r, bot_user_id))
+        write_behind.flush()
+        logger.info(f"[TaskScheduler] 已修复 {repaired}/{len(stale)} 个发送目标")
+        return repaired
+
+    def to_message(self, recipient: Recipient, event, actual_user_id=None, actual_user_nickname=None):
+        msg = ChatMessage({})
+        msg.ctype = ContextType.TEXT
+        msg.content = event
+        msg.from_user_id = recipient.chat_id
+        msg.from_user_nickname = recipient.nickname
+        msg.other_user_id = recipient.chat_id
+        msg.other_user_nickname = recipient.nickname
+        msg.to_user_id = recipient.bot_user_id
+        msg.to_user_nickname = recipient.bot_nickname
+        msg.is_group = recipient.is_group
+        msg.is_at = recipient.is_group
+        msg.actual_user_id = actual_user_id
+        msg.actual_user_nickname = actual_user_nickname
+        return msg
+
+    def _save(self, recipient: Recipient):
+        values = {
+            "key": recipient.key,
+            "is_group": recipient.is_group,
+            "nickname": recipient.nickname,
+            "chat_id": recipient.chat_id,
+            "bot_user_id": recipient.bot_user_id,
+            "bot_nickname": recipient.bot_nickname,
+            "updated_at": time.time(),
+        }
+
+        def op(connection):
+            stmt = sqlite_insert(recipients_t).values(**values)
+            connection.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[recipients_t.c.key],
+                    set_={k: stmt.excluded[k] for k in values if k != "key"},
+                )
+            )
+
+        self._write_behind.put(("recipient", recipient.key), op)
+
+
+if "registry" not in globals():
+    registry = RecipientRegistry()
+    runtime_state.on_relogin(lambda old_bot_user_id, new_bot_user_id: registry.reconcile(new_bot_user_id))
+
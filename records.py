@@ -0,0 +1,158 @@
+# encoding:utf-8
+import json
+from typing import List, Optional
+
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+
+from channel.chat_message import ChatMessage
+from common.log import logger
+
+from .recipients import registry
+from .storage import get_meta, job_update_op, set_meta_op
+
+# 序列化格式: [版本号, 字段...] 的 JSON 数组, 末尾为 None 的字段省略
+# 新增字段只能追加在末尾并提升版本号, 旧版本的解码器保留以便读取历史数据
+RECORD_VERSION = 2
+
+
+class TaskRecord:
+    """任务的参数, 作为 APScheduler job 的唯一参数以紧凑的字节串保存"""
+
+    __slots__ = (
+        "task_id",
+        "event",
+        "group_name",
+        "recipient_key",
+        "no_need_at",
+        "actual_user_id",
+        "actual_user_nickname",
+        "cycle",
+        "time_str",
+        "recipients",
+    )
+
+    def __init__(
+        self,
+        task_id: str,
+        event: str,
+        group_name: Optional[str],
+        recipient_key: str,
+        no_need_at: bool = False,
+        actual_user_id: Optional[str] = None,
+        actual_user_nickname: Optional[str] = None,
+        cycle: Optional[str] = None,
+        time_str: Optional[str] = None,
+        recipients: Optional[List[str]] = None,
+    ):
+        self.task_id = task_id
+        self.event = event
+        self.group_name = group_name
+        self.recipient_key = recipient_key
+        self.no_need_at = no_need_at
+        self.actual_user_id = actual_user_id
+        self.actual_user_nickname = actual_user_nickname
+        self.cycle = cycle
+        self.time_str = time_str
+        # 广播任务的全部发送目标, 单个目标的任务为 None, 只使用 recipient_key
+        self.recipients = recipients
+
+    def encode(self) -> bytes:
+        fields = [
+            RECORD_VERSION,
+            self.task_id,
+            self.event,
+            self.group_name,
+            self.recipient_key,
+            1 if self.no_need_at else 0,
+            self.actual_user_id,
+            self.actual_user_nickname,
+            self.cycle,
+            self.time_str,
+            self.recipients,
+        ]
+        while fields[-1] is None:
+            fields.pop()
+        return json.dumps(fields, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    @classmethod
+    def decode(cls, data: bytes) -> "TaskRecord":
+        fields = json.loads(data)
+        decoder = _DECODERS.get(fields[0])
+        if decoder is None:
+            raise ValueError(f"不支持的任务数据版本: {fields[0]}")
+        return decoder(fields)
+
+    @property
+    def recipient_keys(self) -> List[str]:
+        return self.recipients or [self.recipient_key]
+
+    def __repr__(self):
+        return f"TaskRecord({self.task_id}, {self.event!r}, group={self.group_name!r})"
+
+
+def _decode_v1(fields):
+    fields = fields[1:] + [None] * (9 - len(fields) + 1)
+    record = TaskRecord(*fields[:9])
+    record.no_need_at = bool(record.no_need_at)
+    return record
+
+
+def _decode_v2(fields):
+    fields = fields[1:] + [None] * (10 - len(fields) + 1)
+    record = TaskRecord(*fields[:10])
+    record.no_need_at = bool(record.no_need_at)
+    return record
+
+
+_DECODERS = {1: _decode_v1, 2: _decode_v2}
+
+
+def describe_trigger(trigger):
+    """尽量把 Trigger 还原成 (cycle, time_str), 用于迁移没有记录原始命令的旧任务"""
+    if isinstance(trigger, DateTrigger):
+        run_date = trigger.run_date
+        return run_date.strftime("%Y-%m-%d"), run_date.strftime("%H:%M")
+    if isinstance(trigger, CronTrigger):
+        fields = {field.name: str(field) for field in trigger.fields}
+        if fields["year"] == "*" and fields["week"] == "*" and fields["second"] == "0":
+            expr = " ".join(fields[name] for name in ("minute", "hour", "day", "month", "day_of_week"))
+            return f"cron[{expr}]", None
+    return None, None
+
+
+def migrate_jobs(scheduler, write_behind):
+    """
+    把旧格式的任务参数迁移为 TaskRecord, 只在升级后执行一次
+    - 最早的版本: (task_id, event, group_name, ChatMessage, no_need_at)
+    - 引用发送目标的版本: (task_id, event, group_name, recipient_key, no_need_at, actual_user_id, actual_user_nickname)
+    """
+    jobstore = scheduler._lookup_jobstore("default")
+    # 各版本的 TaskRecord 都能直接解码, 提升版本号不需要重新迁移
+    if (get_meta(jobstore.engine, "job_args") or "").startswith("record:"):
+        return 0
+    migrated = 0
+    for job in scheduler.get_jobs():
+        args = job.args
+        if len(args) == 5 and isinstance(args[3], ChatMessage):
+            task_id, event, group_name, msg, no_need_at = args
+            recipient_key = registry.register(
+                msg.is_group, msg.other_user_id, msg.other_user_nickname, msg.to_user_id, msg.to_user_nickname
+            )
+            actual_user_id, actual_user_nickname = msg.actual_user_id, msg.actual_user_nickname
+        elif len(args) == 7:
+            task_id, event, group_name, recipient_key, no_need_at, actual_user_id, actual_user_nickname = args
+        else:
+            continue
+        cycle, time_str = describe_trigger(job.trigger)
+        record = TaskRecord(
+            task_id, event, group_name, recipient_key, no_need_at,
+            actual_user_id, actual_user_nickname, cycle, time_str,
+        )
+        job.args = (record.encode(),)
+        write_behind.put(("job", job.id), job_update_op(jobstore, job))
+        migrated += 1
+    write_behind.put(("meta", "job_args"), set_meta_op("job_args", f"record:{RECORD_VERSION}"))
+    write_behind.flush()
+    logger.info(f"[TaskScheduler] 已迁移 {migrated} 个旧任务")
+    return migrated
@@ -0,0 +1,102 @@
+# encoding:utf-8
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Flight:
+    """正在计算中的一个 key, 同一时刻的其他请求等待它的结果"""
+
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache:
+    """
+    其他插件结果的共享缓存: key -> (value, expires_at), 按最近使用淘汰
+    同一个 key 同时只计算一次, 其余调用方等待并共享结果
+    compute 返回 None 表示结果不可共享, 不写入缓存, 等待的调用方各自重新计算
+    """
+
+    def __init__(self, ttl=300, max_entries=256):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.configure(ttl, max_entries)
+
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def configure(self, ttl=300, max_entries=256):
+        with self._lock:
+            self.ttl = ttl
+            self.max_entries = max_entries
+            self._entries.clear()
+
+    def get_or_compute(self, key, compute, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    value, expires_at = entry
+                    if expires_at > time.monotonic():
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        return value
+                    del self._entries[key]
+                flight = self._inflight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._inflight[key] = _Flight()
+                    self.misses += 1
+            if leader:
+                return self._compute(key, compute, ttl, flight)
+
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            if flight.value is not None:
+                with self._lock:
+                    self.shared += 1
+                return flight.value
+            # 结果不可共享, 自己再算一次
+
+    def _compute(self, key, compute, ttl, flight):
+        try:
+            flight.value = compute()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                if flight.value is not None and ttl > 0:
+                    self._entries[key] = (flight.value, time.monotonic() + ttl)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            flight.done.set()
+        return flight.value
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "shared": self.shared,
+            }
+
+
+if "result_cache" not in globals():
+    result_cache = ResultCache()
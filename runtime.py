@@ -0,0 +1,109 @@
+# encoding:utf-8
+import threading
+import time
+
+from channel.chat_channel import ChatChannel
+from channel.channel_factory import create_channel
+from common.log import logger
+from config import conf
+from plugins import PluginManager
+
+from .tools import get_channel_tools
+
+
+class RuntimeState:
+    """
+    执行器检查任务条件时需要的运行时信息: 插件开关、channel 以及机器人 id
+    常规情况下只是几次属性读取和比较, 只有在过期或被 invalidate 时才重新获取
+    """
+
+    def __init__(self, refresh_interval=5):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._plugin_conf = None
+        self._channel = None
+        self._is_chat_channel = False
+        self._bot_user_id = None
+        self._expires_at = 0
+        self._relogin_listeners = []
+        # 通知监听者的线程按顺序处理, 连续两次重新登录时后一次等前一次处理完
+        self._relogin_lock = threading.Lock()
+
+    def invalidate(self):
+        """插件开关、重载等事件后调用, 下次检查时重新读取"""
+        self._expires_at = 0
+
+    def on_relogin(self, listener):
+        """listener(old_bot_user_id, new_bot_user_id), 检测到机器人 id 变化时在后台线程调用"""
+        self._relogin_listeners.append(listener)
+
+    def enabled(self):
+        if time.monotonic() >= self._expires_at:
+            self._reload()
+        # pconf 里的 dict 会在开关插件时被原地修改, 这里拿到的总是最新值
+        return self._plugin_conf.get("enabled", False)
+
+    @property
+    def channel(self):
+        if time.monotonic() >= self._expires_at:
+            self._reload()
+        return self._channel
+
+    @property
+    def is_chat_channel(self):
+        return self._is_chat_channel
+
+    def bot_user_id(self):
+        """
+        当前机器人 id; 与上次不同说明重新登录了, 通知监听者
+        在调度线程里调用, 这里只做比较和清空目录缓存, 修复发送目标(查通讯录、写库)交给后台线程
+        目录在新 id 返回之前就清空, 拿到新 id 的线程不会再查到上一次登录的会话 id
+        """
+        bot_user_id = self._channel.user_id
+        if bot_user_id != self._bot_user_id:
+            with self._lock:
+                old = self._bot_user_id
+                if bot_user_id != old:
+                    # 启动后第一次拿到 id 也通知, 因为不知道登录前的缓存是否还有效
+                    if bot_user_id is not None:
+                        _invalidate_directory()
+                    self._bot_user_id = bot_user_id
+                    if bot_user_id is not None:
+                        logger.info(f"[TaskScheduler] 机器人 id 变化: {old} -> {bot_user_id}")
+                        threading.Thread(
+                            target=self._notify_relogin,
+                            args=(old, bot_user_id),
+                            name="TaskScheduler-relogin",
+                            daemon=True,
+                        ).start()
+        return bot_user_id
+
+    def _notify_relogin(self, old, bot_user_id):
+        with self._relogin_lock:
+            if bot_user_id != self._bot_user_id:
+                # 等待期间又重新登录了一次, 交给那一次处理
+                return
+            for listener in self._relogin_listeners:
+                try:
+                    listener(old, bot_user_id)
+                except Exception as e:
+                    logger.error(f"[TaskScheduler] 处理重新登录失败: {e}")
+
+    def _reload(self):
+        with self._lock:
+            # 单例的
+            self._plugin_conf = PluginManager().pconf["plugins"]["TaskScheduler"]
+            self._channel = create_channel(conf().get("channel_type"))
+            self._is_chat_channel = isinstance(self._channel, ChatChannel)
+            self._expires_at = time.monotonic() + self.refresh_interval
+
+
+def _invalidate_directory():
+    # 重新登录后 id 全部失效, 共享目录也要跟着重建
+    directory = get_channel_tools().directory
+    if directory is not None:
+        directory.invalidate()
+
+
+if "runtime_state" not in globals():
+    runtime_state = RuntimeState()
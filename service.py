@@ -0,0 +1,145 @@
+# encoding:utf-8
+import atexit
+import json
+import threading
+
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_MISSED, EVENT_JOB_REMOVED
+
+from common.log import logger
+
+from .catchup import catch_up
+from .executors import PooledBackgroundScheduler, create_executors
+from .leases import leases
+from .listing import backfill_index, unindex_op
+from .metrics import metrics
+from .preview import fire_preview
+from .records import migrate_jobs
+from .recipients import registry
+from .storage import create_jobstore, create_tables
+
+# 这些配置变化时需要重新打开 tasks.db, 其余配置在插件重载时原地生效
+STORE_KEYS = ("jobstore", "coordination")
+EXECUTOR_KEYS = ("executor", "executor_pools", "max_workers")
+
+
+def _fingerprint(config, keys):
+    return json.dumps({key: config.get(key) for key in keys}, sort_keys=True, ensure_ascii=False)
+
+
+class SchedulerService:
+    """
+    进程内唯一的调度器, 插件对象重载(reloadp/scanp)时保留
+    - 重载只替换插件对象与消息处理函数, 不重新加载任务, 执行中的任务不受影响, 耗时与任务数量无关
+    - 执行池配置变化时原地替换执行器, 新任务立即交给新的执行器, 旧执行器在后台等执行中的任务完成后关闭
+    - jobstore/coordination 配置变化时才重建: 旧调度器等执行中的任务完成后关闭, 再打开新的
+    - 进程退出时等待执行中的任务并提交未写入的修改, 不依赖插件对象何时被回收
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.scheduler = None
+        self.write_behind = None
+        self._path = None
+        self._store_key = None
+        self._executor_key = None
+        atexit.register(self.shutdown)
+
+    def acquire(self, path, config):
+        """返回运行中的 (scheduler, write_behind), 没有或配置不兼容时按 config 创建"""
+        with self._lock:
+            store_key = _fingerprint(config, STORE_KEYS)
+            scheduler = self.scheduler
+            if scheduler is not None and scheduler.running and (self._path, self._store_key) == (path, store_key):
+                executor_key = _fingerprint(config, EXECUTOR_KEYS)
+                if executor_key != self._executor_key:
+                    self._swap_executors(config)
+                    self._executor_key = executor_key
+                logger.info("[TaskScheduler] 沿用运行中的调度器")
+                return scheduler, self.write_behind
+            self._stop(wait=True)
+            self._start(path, config)
+            self._path = path
+            self._store_key = store_key
+            self._executor_key = _fingerprint(config, EXECUTOR_KEYS)
+            return self.scheduler, self.write_behind
+
+    def shutdown(self, wait=True):
+        """关闭调度器: 等待执行中的任务, 再提交写入队列; 之后的 acquire 会重新创建"""
+        with self._lock:
+            self._stop(wait)
+
+    def _start(self, path, config):
+        # 多个进程共用 tasks.db 时, 每次运行通过租约只由一个进程执行
+        coordination = config.get("coordination", {})
+        shared = coordination.get("enabled", False)
+        if shared and (config.get("jobstore") or {}).get("mode") != "tuned":
+            # default 模式没有写入队列与连接池, indexed 模式的内存索引看不到其它进程的修改
+            raise ValueError("coordination 需要 jobstore.mode 为 tuned")
+
+        # 使用 SQLite 存储任务,位于插件目录
+        jobstore, write_behind = create_jobstore(path, config.get("jobstore"))
+        create_tables(jobstore.engine)
+        registry.bind(jobstore.engine, write_behind, shared)
+        # executor 为 default 池, executor_pools 为按任务类别路由的命名池
+        executors = create_executors(config)
+        scheduler = PooledBackgroundScheduler(jobstores={"default": jobstore}, executors=executors)
+        # 先记下来, 启动到一半失败时下一次 acquire 会关闭它
+        self.scheduler = scheduler
+        self.write_behind = write_behind
+
+        # 先暂停启动, 旧格式的任务迁移完成后再开始调度
+        scheduler.start(paused=True)
+        migrate_jobs(scheduler, write_behind)
+        backfill_index(scheduler, write_behind)
+
+        # 任务被取消或执行完毕后删除列表索引
+        def on_job_removed(event):
+            write_behind.put(("index", event.job_id), unindex_op(event.job_id))
+
+        scheduler.add_listener(on_job_removed, EVENT_JOB_REMOVED)
+        scheduler.add_listener(metrics.on_job_event, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+        fire_preview.bind(scheduler)
+        leases.configure(scheduler, jobstore.engine, **coordination)
+        # 停机期间错过的任务在恢复调度前按 catch_up 策略合并、放弃或限速补发
+        catch_up.configure(**config.get("catch_up", {}))
+        catch_up.scan(scheduler)
+        scheduler.resume()
+        metrics.register_pools(executors)
+        logger.info("[TaskScheduler] 调度器已启动")
+
+    def _swap_executors(self, config):
+        scheduler = self.scheduler
+        executors = create_executors(config)
+        with scheduler._executors_lock:
+            old = scheduler._executors
+            for alias, executor in executors.items():
+                executor.start(scheduler, alias)
+            # 从配置中删掉的池, 其任务由 PooledBackgroundScheduler 改交给 default
+            scheduler._executors = dict(executors)
+        metrics.register_pools(executors)
+        logger.info(f"[TaskScheduler] 执行池已更新: {', '.join(executors)}")
+
+        def drain():
+            for alias, executor in old.items():
+                executor.shutdown(wait=True)
+            logger.info(f"[TaskScheduler] 旧的执行池已关闭: {', '.join(old)}")
+
+        threading.Thread(target=drain, name="TaskScheduler-drain", daemon=True).start()
+
+    def _stop(self, wait):
+        scheduler, write_behind = self.scheduler, self.write_behind
+        if scheduler is None:
+            return
+        self.scheduler = self.write_behind = None
+        logger.info("[TaskScheduler] 关闭 scheduler")
+        try:
+            if scheduler.running:
+                scheduler.shutdown(wait=wait)
+        finally:
+            write_behind.close()
+
+
+# scanp 会 importlib.reload 插件的每个模块, 重新执行到这里时沿用已有的实例,
+# 否则会在同一个 tasks.db 上再启动一个调度器, 每个任务都运行两次
+if "scheduler_service" not in globals():
+    scheduler_service = SchedulerService()
@@ -0,0 +1,527 @@
+# encoding:utf-8
+import atexit
+import heapq
+import pickle
+import threading
+from collections import OrderedDict
+
+from apscheduler.jobstores.base import ConflictingIdError, JobLookupError
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
+from sqlalchemy import Column, MetaData, Table, Unicode, create_engine, event, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.pool import QueuePool
+
+from common.log import logger
+
+# 插件自己的表与 apscheduler_jobs 放在同一个 tasks.db 里
+metadata = MetaData()
+
+meta_t = Table(
+    "task_meta",
+    metadata,
+    Column("key", Unicode(64), primary_key=True),
+    Column("value", Unicode(255)),
+)
+
+
+def create_tables(engine):
+    metadata.create_all(engine, checkfirst=True)
+
+
+def get_meta(engine, key, default=None):
+    with engine.begin() as connection:
+        value = connection.execute(select(meta_t.c.value).where(meta_t.c.key == key)).scalar()
+    return default if value is None else value
+
+
+def set_meta_op(key, value):
+    def op(connection):
+        stmt = sqlite_insert(meta_t).values(key=key, value=str(value))
+        connection.execute(
+            stmt.on_conflict_do_update(index_elements=[meta_t.c.key], set_={"value": stmt.excluded.value})
+        )
+
+    return op
+
+
+class WriteBehindQueue:
+    """
+    把对 tasks.db 的零散写操作攒起来, 由后台线程在一个事务里统一提交
+    - 同一个 key 只保留最后一次写入
+    - flush() 可以同步地把当前积压写完
+    """
+
+    def __init__(self, engine, delay=0.5, max_batch=500):
+        self.engine = engine
+        self.delay = delay
+        self.max_batch = max_batch
+
+        self._pending = OrderedDict()
+        # 正在提交中的写操作, 提交完成前 pending() 仍然能看到
+        self._inflight = {}
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        # 后台线程是 daemon 的, 进程退出前把积压的写入提交掉
+        atexit.register(self.close)
+
+    def put(self, key, op):
+        """op(connection) 在刷盘的事务里执行"""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("WriteBehindQueue 已关闭")
+            self._pending[key] = op
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="TaskScheduler-write-behind", daemon=True
+                )
+                self._thread.start()
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                if not self._pending:
+                    return 0
+                self._inflight = self._pending
+                self._pending = OrderedDict()
+                ops = list(self._inflight.values())
+            try:
+                self._commit(ops)
+            finally:
+                with self._cond:
+                    self._inflight = {}
+            return len(ops)
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def pending(self, key):
+        """尚未提交的写操作, 没有则返回 None"""
+        with self._cond:
+            op = self._pending.get(key)
+            return op if op is not None else self._inflight.get(key)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._pending) < self.max_batch:
+                    self._cond.wait(self.delay)
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"[TaskScheduler] 批量写入失败: {e}")
+            if closed:
+                return
+
+    def _commit(self, ops):
+        try:
+            with self.engine.begin() as connection:
+                for op in ops:
+                    op(connection)
+        except Exception as e:
+            # 整批失败时逐条重试, 避免一条坏数据拖累整批
+            logger.warning(f"[TaskScheduler] 批量写入 {len(ops)} 条失败, 逐条重试: {e}")
+            for op in ops:
+                try:
+                    with self.engine.begin() as connection:
+                        op(connection)
+                except Exception as e:
+                    logger.error(f"[TaskScheduler] 写入失败: {e}")
+
+
+def job_update_op(jobstore, job):
+    """
+    生成一个更新 job 行的写操作, 序列化推迟到真正提交时进行,
+    这样写入的是 job 当时最新的状态(包括调度线程刚更新的 next_run_time)
+    """
+    return _JobWrite("update", jobstore, job=job)
+
+
+class _JobWrite:
+    """TunedSQLiteJobStore 排队的 job 写操作, kind 为 add/update/remove"""
+
+    __slots__ = ("kind", "jobstore", "job", "job_id")
+
+    def __init__(self, kind, jobstore, job=None, job_id=None):
+        self.kind = kind
+        self.jobstore = jobstore
+        self.job = job
+        self.job_id = job_id if job is None else job.id
+
+    def __call__(self, connection):
+        jobs_t = self.jobstore.jobs_t
+        if self.kind == "remove":
+            connection.execute(jobs_t.delete().where(jobs_t.c.id == self.job_id))
+            return
+        values = {
+            "next_run_time": datetime_to_utc_timestamp(self.job.next_run_time),
+            "job_state": pickle.dumps(self.job.__getstate__(), self.jobstore.pickle_protocol),
+        }
+        if self.kind == "add":
+            # 之前排队的 remove 可能还没提交, 用 OR REPLACE 覆盖
+            connection.execute(jobs_t.insert().prefix_with("OR REPLACE").values(id=self.job_id, **values))
+        else:
+            connection.execute(jobs_t.update().values(**values).where(jobs_t.c.id == self.job_id))
+
+
+class TunedSQLiteJobStore(SQLAlchemyJobStore):
+    """
+    针对 SQLite 调优的 job store
+    - WAL 日志与 synchronous/cache pragma, 写入不再阻塞调度线程的到期查询
+    - 使用连接池复用连接
+    - add/update/remove 进入 WriteBehindQueue, 与插件其它写操作合并到同一个事务提交;
+      读之前先 flush, 保证读到自己的写入
+    """
+
+    def __init__(
+        self,
+        path,
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        cache_size_kb=8192,
+        busy_timeout_ms=5000,
+        pool_size=4,
+        flush_interval=0.05,
+        max_batch=500,
+        **kwargs,
+    ):
+        engine = create_engine(
+            f"sqlite:///{path}",
+            poolclass=QueuePool,
+            pool_size=pool_size,
+            max_overflow=pool_size,
+            connect_args={"check_same_thread": False, "timeout": busy_timeout_ms / 1000},
+        )
+        pragmas = [
+            f"PRAGMA journal_mode={journal_mode}",
+            f"PRAGMA synchronous={synchronous}",
+            f"PRAGMA cache_size=-{int(cache_size_kb)}",
+            f"PRAGMA busy_timeout={int(busy_timeout_ms)}",
+            "PRAGMA temp_store=MEMORY",
+        ]
+
+        @event.listens_for(engine, "connect")
+        def _set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+
+        super().__init__(engine=engine, **kwargs)
+        self.flush_interval = flush_interval
+        self.write_behind = WriteBehindQueue(engine, delay=max(flush_interval, 0.001), max_batch=max_batch)
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        # 旧版本建的表不一定有这个索引, 到期查询和唤醒时间都依赖它
+        with self.engine.begin() as connection:
+            connection.execute(
+                text(
+                    f"CREATE INDEX IF NOT EXISTS ix_{self.jobs_t.name}_next_run_time "
+                    f"ON {self.jobs_t.name} (next_run_time)"
+                )
+            )
+
+    def lookup_job(self, job_id):
+        self.write_behind.flush()
+        return super().lookup_job(job_id)
+
+    def get_due_jobs(self, now):
+        self.write_behind.flush()
+        return super().get_due_jobs(now)
+
+    def get_next_run_time(self):
+        self.write_behind.flush()
+        return super().get_next_run_time()
+
+    def get_all_jobs(self):
+        self.write_behind.flush()
+        return super().get_all_jobs()
+
+    def add_job(self, job):
+        pending = self.write_behind.pending(("job", job.id))
+        if pending is not None:
+            if pending.kind != "remove":
+                raise ConflictingIdError(job.id)
+        elif self._exists(job.id):
+            raise ConflictingIdError(job.id)
+        self._put(_JobWrite("add", self, job=job))
+
+    def update_job(self, job):
+        # 调度器只会更新刚从 store 里取出的 job, 不再为了 rowcount 单独查询一次
+        pending = self.write_behind.pending(("job", job.id))
+        if pending is not None and pending.kind == "remove":
+            raise JobLookupError(job.id)
+        self._put(_JobWrite("add" if pending is not None and pending.kind == "add" else "update", self, job=job))
+
+    def remove_job(self, job_id):
+        pending = self.write_behind.pending(("job", job_id))
+        if pending is not None:
+            if pending.kind == "remove":
+                raise JobLookupError(job_id)
+        elif not self._exists(job_id):
+            raise JobLookupError(job_id)
+        self._put(_JobWrite("remove", self, job_id=job_id))
+
+    def remove_all_jobs(self):
+        self.write_behind.flush()
+        super().remove_all_jobs()
+
+    def shutdown(self):
+        self.write_behind.close()
+        super().shutdown()
+
+    def _put(self, write):
+        self.write_behind.put(("job", write.job_id), write)
+        if self.flush_interval <= 0:
+            self.write_behind.flush()
+
+    def _exists(self, job_id):
+        # 调用方已经通过 pending() 检查过排队和提交中的写入, 这里只需要查已提交的数据
+        with self.engine.begin() as connection:
+            return connection.execute(
+                select(self.jobs_t.c.id).where(self.jobs_t.c.id == job_id)
+            ).first() is not None
+
+
+class IndexedJobStore(TunedSQLiteJobStore):
+    """
+    在 TunedSQLiteJobStore 之上, 在内存里维护 job id -> next_run_time 的索引和一个小根堆
+    - 启动时只读取 (id, next_run_time) 两列, 不反序列化任何 job
+    - get_next_run_time 看堆顶, get_due_jobs 只遍历堆中已到期的部分, 只反序列化到期的 job
+    - SQLite 只负责持久化, 因此只能由一个进程使用这个 tasks.db
+    堆采用延迟删除: 更新和删除只改索引, 堆里过期的条目在经过堆顶时丢弃
+    """
+
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+        self._index_lock = threading.RLock()
+        self._next_run_times = {}
+        self._heap = []
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        next_run_times = {}
+        with self.engine.begin() as connection:
+            for job_id, next_run_time in connection.execute(
+                select(self.jobs_t.c.id, self.jobs_t.c.next_run_time)
+            ):
+                next_run_times[job_id] = next_run_time
+        with self._index_lock:
+            self._next_run_times = next_run_times
+            self._heap = [(ts, job_id) for job_id, ts in next_run_times.items() if ts is not None]
+            heapq.heapify(self._heap)
+        logger.info(f"[TaskScheduler] 已加载 {len(next_run_times)} 个任务的运行时间索引")
+
+    def get_due_jobs(self, now):
+        timestamp = datetime_to_utc_timestamp(now)
+        with self._index_lock:
+            self._discard_stale()
+            due = self._due(timestamp)
+        if not due:
+            return []
+        # 到期的 job 可能还在写队列里, 只有这种情况才需要先提交
+        if any(self.write_behind.pending(("job", job_id)) is not None for job_id in due):
+            self.write_behind.flush()
+        jobs = {}
+        failed_job_ids = set()
+        with self.engine.begin() as connection:
+            for start in range(0, len(due), 500):
+                chunk = due[start:start + 500]
+                for job_id, job_state in connection.execute(
+                    select(self.jobs_t.c.id, self.jobs_t.c.job_state).where(self.jobs_t.c.id.in_(chunk))
+                ):
+                    try:
+                        jobs[job_id] = self._reconstitute_job(job_state)
+                    except BaseException:
+                        self._logger.exception('Unable to restore job "%s" -- removing it', job_id)
+                        failed_job_ids.add(job_id)
+            if failed_job_ids:
+                connection.execute(self.jobs_t.delete().where(self.jobs_t.c.id.in_(failed_job_ids)))
+        with self._index_lock:
+            # 索引里有而表里没有的(比如被其它方式删除), 一并从索引里去掉
+            for job_id in due:
+                if job_id not in jobs:
+                    self._next_run_times.pop(job_id, None)
+        return [jobs[job_id] for job_id in due if job_id in jobs]
+
+    def get_next_run_time(self):
+        with self._index_lock:
+            self._discard_stale()
+            if not self._heap:
+                return None
+            return utc_timestamp_to_datetime(self._heap[0][0])
+
+    def add_job(self, job):
+        super().add_job(job)
+        self._set_index(job.id, datetime_to_utc_timestamp(job.next_run_time))
+
+    def update_job(self, job):
+        super().update_job(job)
+        self._set_index(job.id, datetime_to_utc_timestamp(job.next_run_time))
+
+    def remove_job(self, job_id):
+        super().remove_job(job_id)
+        with self._index_lock:
+            self._next_run_times.pop(job_id, None)
+
+    def remove_all_jobs(self):
+        super().remove_all_jobs()
+        with self._index_lock:
+            self._next_run_times.clear()
+            self._heap = []
+
+    def _set_index(self, job_id, timestamp):
+        with self._index_lock:
+            if job_id in self._next_run_times and self._next_run_times[job_id] == timestamp:
+                return
+            self._next_run_times[job_id] = timestamp
+            if timestamp is not None:
+                heapq.heappush(self._heap, (timestamp, job_id))
+            # 过期条目太多时重建, 避免堆无限增长
+            if len(self._heap) > 2 * len(self._next_run_times) + 1024:
+                self._heap = [(ts, jid) for jid, ts in self._next_run_times.items() if ts is not None]
+                heapq.heapify(self._heap)
+
+    def _is_live(self, entry):
+        timestamp, job_id = entry
+        return self._next_run_times.get(job_id, None) == timestamp
+
+    def _discard_stale(self):
+        heap = self._heap
+        while heap and not self._is_live(heap[0]):
+            heapq.heappop(heap)
+
+    def _due(self, timestamp):
+        """按堆的结构只访问 next_run_time <= timestamp 的节点, 返回按时间排序的 job id"""
+        heap = self._heap
+        found = []
+        seen = set()
+        stack = [0] if heap else []
+        while stack:
+            i = stack.pop()
+            entry = heap[i]
+            if entry[0] > timestamp:
+                continue
+            if entry[1] not in seen and self._is_live(entry):
+                seen.add(entry[1])
+                found.append(entry)
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    stack.append(child)
+        found.sort()
+        return [job_id for _, job_id in found]
+
+
+def existing_job_ids(jobstore, job_ids):
+    """job_ids 中已被占用的编号, 包括还在写队列里、尚未提交的 job"""
+    write_behind = getattr(jobstore, "write_behind", None)
+    existing = set()
+    unknown = []
+    for job_id in job_ids:
+        pending = write_behind.pending(("job", job_id)) if write_behind is not None else None
+        if pending is None:
+            unknown.append(job_id)
+        elif pending.kind != "remove":
+            existing.add(job_id)
+    jobs_t = jobstore.jobs_t
+    with jobstore.engine.begin() as connection:
+        for start in range(0, len(unknown), 500):
+            chunk = unknown[start:start + 500]
+            existing.update(connection.execute(select(jobs_t.c.id).where(jobs_t.c.id.in_(chunk))).scalars())
+    return existing
+
+
+def paused_jobs(jobstore):
+    """next_run_time 为空(暂停)的 job, 查询走 next_run_time 索引, 不扫描整张表"""
+    write_behind = getattr(jobstore, "write_behind", None)
+    if write_behind is not None:
+        write_behind.flush()
+    return jobstore._get_jobs(jobstore.jobs_t.c.next_run_time.is_(None))
+
+
+def jobs_before(jobstore, until):
+    """下次运行时间不晚于 until(UTC 时间戳)的 job, 查询走 next_run_time 索引"""
+    write_behind = getattr(jobstore, "write_behind", None)
+    if write_behind is not None:
+        write_behind.flush()
+    return jobstore._get_jobs(jobstore.jobs_t.c.next_run_time <= until)
+
+
+def lookup_jobs(jobstore, job_ids):
+    """按 id 批量读取 job, 不存在的忽略"""
+    write_behind = getattr(jobstore, "write_behind", None)
+    if write_behind is not None:
+        write_behind.flush()
+    jobs = []
+    for start in range(0, len(job_ids), 500):
+        jobs.extend(jobstore._get_jobs(jobstore.jobs_t.c.id.in_(job_ids[start:start + 500])))
+    return jobs
+
+
+def flush_before_job_write(jobstore, write_behind):
+    """
+    default 模式的 job store 直接提交 job, 而发送目标等写入还在写队列里;
+    先提交队列, 否则进程在这之间退出时 job 引用的发送目标不存在, 之后每次触发都会被跳过
+    tuned/indexed 模式的 job 与它们走同一个队列, 按写入顺序在同一批提交, 不需要
+    """
+    if getattr(jobstore, "write_behind", None) is not write_behind:
+        write_behind.flush()
+
+
+def insert_jobs(jobstore, jobs, ops=()):
+    """
+    在一个事务里插入多个新 job 并执行附带的写操作(比如任务列表索引), 任何一条失败则整体回滚
+    先提交写队列里积压的写入, 编号冲突由主键约束检查
+    """
+    write_behind = getattr(jobstore, "write_behind", None)
+    if write_behind is not None:
+        write_behind.flush()
+    rows = [
+        {
+            "id": job.id,
+            "next_run_time": datetime_to_utc_timestamp(job.next_run_time),
+            "job_state": pickle.dumps(job.__getstate__(), jobstore.pickle_protocol),
+        }
+        for job in jobs
+    ]
+    with jobstore.engine.begin() as connection:
+        if rows:
+            connection.execute(jobstore.jobs_t.insert(), rows)
+        for op in ops:
+            op(connection)
+    if isinstance(jobstore, IndexedJobStore):
+        for job in jobs:
+            jobstore._set_index(job.id, datetime_to_utc_timestamp(job.next_run_time))
+    return len(rows)
+
+
+def create_jobstore(path, options=None):
+    """
+    按 config.json 的 jobstore 配置创建 job store, 返回 (jobstore, write_behind)
+    mode 为 tuned/indexed 时插件的其它写操作与 job 写入共用同一个队列
+    """
+    options = dict(options or {})
+    mode = options.pop("mode", "default")
+    if mode in ("tuned", "indexed"):
+        jobstore = (TunedSQLiteJobStore if mode == "tuned" else IndexedJobStore)(path, **options)
+        return jobstore, jobstore.write_behind
+    if mode != "default":
+        raise ValueError(f"不支持的 jobstore mode: {mode}")
+    jobstore = SQLAlchemyJobStore(url=f"sqlite:///{path}")
+    return jobstore, WriteBehindQueue(jobstore.engine)
@@ -3,80 +3,47 @@ import hashlib
 import time
 from typing import Optional
 from apscheduler.jobstores.base import JobLookupError
-from apscheduler.schedulers.background import BackgroundScheduler
 
-from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.triggers.cron import CronTrigger
-from apscheduler.triggers.date import DateTrigger
 
-from channel.chat_channel import ChatChannel
-from channel.chat_message import ChatMessage
 from channel.channel_factory import create_channel
 import datetime
 import re
+import threading
 import uuid
 
 from bridge.reply import Reply, ReplyType
 import plugins
 from common.log import logger
 from bridge.context import ContextType
+from config import global_config
 from plugins import *
 
 
-from .tools import WrappedChannelTools
+from . import bulk, dispatch
+from .catchup import MISFIRE_GRACE_TIME, catch_up
+from .commands import CommandRouter, command_table
+from .executors import route_pool
+from .leases import leases
+from .listing import chat_key, index_op, query_tasks
+from .metrics import metrics
+from .preview import fire_preview
+from .profiling import MODES as PROFILE_MODES, profiler
+from .ratelimit import send_gate
+from .results import result_cache
+from .runtime import runtime_state
+from .records import TaskRecord
+from .recipients import registry
+from .service import scheduler_service
+from .storage import existing_job_ids, flush_before_job_write
+from .tools import get_channel_tools
+from .triggers import RELATIVE_DAYS, OffsetTrigger, build_trigger, jitter_offset
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 db_path = os.path.join(current_dir, "tasks.db")
-
-class CheckedThreadPoolExecutor(ThreadPoolExecutor):
-    def _do_submit_job(self, job, run_times):
-        if not self._check_conditions(job):
-            print(f"Job {job.id} conditions not met, skipping")
-            return
-        
-        return super()._do_submit_job(job, run_times)
-    
-    def _check_conditions(self, job):
-        # 单例的
-        if not plugin_manager.PluginManager().pconf['plugins']['TaskScheduler']['enabled']:
-            return False
-
-        msg:ChatMessage = job.args[3]
-        channel = create_channel(conf().get("channel_type"))
-        channel_tools = WrappedChannelTools()
-
-        if isinstance(channel, ChatChannel):
-            bot_user_id = channel.user_id
-            if bot_user_id is None:
-                return False
-            logger.info("检查 id 是否变化")
-            if msg.to_user_id != bot_user_id:
-                # id 发生变化，尝试根据昵称更新（当然这是不可靠的, 因为昵称可以相同）
-                logger.info("id 改变，尝试更新")
-                try:
-                    if msg.is_group:
-                        group_id = channel_tools.get_group_id_by_name(msg.other_user_nickname)
-                        if group_id is None:
-                            raise ValueError(f"没有找到 {msg.other_user_nickname}")
-                        msg.from_user_id = group_id
-                        msg.other_user_id = group_id
-                        msg.to_user_id = bot_user_id
-                        # actual_user_id 就不更新了，反正也没用到
-                    else:
-                        friend_id = channel_tools.get_user_id_by_name(msg.other_user_nickname)
-                        if friend_id is None:
-                            raise ValueError(f"没有找到 {msg.other_user_nickname}")
-                        msg.from_user_id = friend_id
-                        msg.other_user_id = friend_id
-                        msg.to_user_id = bot_user_id
-                    job.args = (job.args[0], job.args[1], job.args[2], msg, job.args[4])
-                    self._scheduler.modify_job(job.id, args=(job.args[0], job.args[1], job.args[2], msg, job.args[4]))
-                except Exception as e:
-                    logger.error(f"更新任务 {job.id} 失败: {e}")
-            else:
-                logger.info("id 无变化，无需更新")
-        return True
+# 预览一次最多查看的分钟数与回复中最多列出的分钟数
+PREVIEW_MAX_MINUTES = 24 * 60
+PREVIEW_REPLY_LIMIT = 30
 
 @plugins.register(
     name="TaskScheduler",
@@ -87,10 +54,6 @@ class CheckedThreadPoolExecutor(ThreadPoolExecutor):
     author="rikka",
 )
 class TaskScheduler(Plugin):
-    def __del__(self):
-        logger.info("[TaskScheduler] 关闭 scheduler")
-        self.scheduler.shutdown()
-
     def __init__(self):
         super().__init__()
         try:
@@ -100,26 +63,26 @@ class TaskScheduler(Plugin):
                 # 因为 task_excute 只能读取全局配置
                 raise ValueError("TaskScheduler 配置文件不存在")
 
+            # 命令前缀与 custom_commands 在加载配置时编译, 之后每条消息只做一次前缀比较
+            self.router = CommandRouter(conf(), self.config)
+            command_table(self.config)
+
             # self.handlers[Event.ON_HANDLE_CONTEXT] = weakref.WeakMethod(self.on_handle_context)
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
 
-            jobstores = {
-                "default": SQLAlchemyJobStore(
-                    url=f"sqlite:///{db_path}"
-                )  # 使用 SQLite 存储任务,位于当前文件同级目录
-            }
-            executors = {
-                "default": CheckedThreadPoolExecutor(
-                    max_workers=self.config.get("max_workers", 30)
-                )
-            }
-            self.scheduler = BackgroundScheduler(
-                jobstores=jobstores, executors=executors
-            )
-
-            # self.scheduler.add_listener(self.check_and_update_job, EVENT_JOB_SUBMITTED)
-            self.scheduler.start()
-            self.channel_tools = WrappedChannelTools()
+            # 启动时的补发也会计入指标, 需要先开启
+            metrics.configure(**self.config.get("metrics", {}))
+            fire_preview.configure(**self.config.get("preview", {}))
+            # 调度器在进程内只有一个, 插件重载时沿用, 不重新加载任务
+            self.scheduler, self.write_behind = scheduler_service.acquire(db_path, self.config)
+            # 群聊/好友目录在进程内共享, 重载插件不会丢失已建立的索引
+            self.channel_tools = get_channel_tools()
+            if self.channel_tools.directory is not None:
+                self.channel_tools.directory.configure(**self.config.get("directory", {}))
+            send_gate.configure(**self.config.get("rate_limit", {}))
+            result_cache.configure(**self.config.get("result_cache", {}))
+            # 插件重载或重新启用后, 重新读取开关与 channel
+            runtime_state.invalidate()
             logger.info("[TaskScheduler] inited")
         except Exception as e:
             logger.error(f"[TaskScheduler] 初始化异常：{e}")
@@ -130,74 +93,64 @@ class TaskScheduler(Plugin):
         sha1 = hashlib.sha1(seed.encode("utf-8")).hexdigest()
         return sha1[:7]
 
+    # 生成 count 个未被占用的任务编号, 7 位编号在任务很多时会与已有任务重复
+    def new_task_ids(self, count=1):
+        jobstore = self.scheduler._lookup_jobstore("default")
+        task_ids = []
+        while len(task_ids) < count:
+            candidates = {self.generate_short_id() for _ in range(count - len(task_ids))} - set(task_ids)
+            candidates -= existing_job_ids(jobstore, list(candidates))
+            task_ids.extend(candidates)
+        return task_ids
+
     def on_handle_context(self, e_context: EventContext):
-        trigger_prefix = conf().get("plugin_trigger_prefix", "$")
-        command_prefix = self.config.get("command_prefix", "time")
-        channel_tools = WrappedChannelTools()
-
-        if e_context["context"].type == ContextType.TEXT:
-            content = e_context["context"].content
-            if content.startswith(f"{trigger_prefix}{command_prefix}"):
-                # 先拆分出 $time 和剩余部分
-                _, remaining = content.split(f"{trigger_prefix}{command_prefix} ", 1)
-                remaining = remaining.strip()
-
-                operation = remaining.split(" ", 1)[0]
-                if operation == "任务列表":
-                    self.get_task_list(e_context)
-                elif operation == "取消任务":
-                    task_id = remaining.split(" ", 1)[1].strip()
-                    self.cancel_task(e_context, task_id)
-                else:
-                    # 检查是否含有组名称, 必须以 group[组名称] 的形式出现, 且位于尾部
-                    match = re.search(r"group\[(.*?)\]$", remaining)
-                    if match:
-                        group_name = match.group(1)
-                    else:
-                        group_name = None
-                    # 解析剩余的部分
-                    remaining = remaining.replace(f"group[{group_name}]", "").strip()
-
-                    # 如果是 cron, 格式就是 cron[* * * * *] event_str
-                    if remaining.startswith("cron["):
-                        cron_end = remaining.find("]")
-                        if cron_end != -1:
-                            cron_part = remaining[: cron_end + 1]
-                            event_part = remaining[cron_end + 1 :].strip()
-                            parts = [cron_part, event_part]
-                        else:
-                            reply = Reply()
-                            reply.type = ReplyType.TEXT
-                            reply.content = "指令格式错误，cron 表达式不完整"
-                            e_context["reply"] = reply
-                            e_context.action = EventAction.BREAK_PASS
-                            logger.error("指令格式错误，cron 表达式不完整")
-                            return
-                        self.add_task(
-                            e_context,
-                            cycle=parts[0],
-                            event=parts[1],
-                            group_name=group_name,
-                        )
-                    else:
-                        # 否则就是普通周期和时间, 格式就是 cycle time_str event_str
-                        parts = remaining.split(" ", 2)
-                        if len(parts) != 3:
-                            reply = Reply()
-                            reply.type = ReplyType.TEXT
-                            reply.content = "指令格式错误"
-                            e_context["reply"] = reply
-                            e_context.action = EventAction.BREAK_PASS
-                            logger.error("指令格式错误")
-                            return
-
-                        self.add_task(
-                            e_context,
-                            cycle=parts[0],
-                            time_str=parts[1],
-                            event=parts[2],
-                            group_name=group_name,
-                        )
+        context = e_context["context"]
+        if context.type != ContextType.TEXT:
+            return
+        router = self.router
+        global_conf = conf()
+        if router.conf is not global_conf:
+            # 全局配置重新加载过, plugin_trigger_prefix 可能变了
+            router = self.router = CommandRouter(global_conf, self.config)
+        route = router.route(context.content)
+        if route is None:
+            return
+        operation, remaining = route
+        if operation == "任务列表":
+            self.get_task_list(e_context, remaining.split()[1:])
+        elif operation == "状态":
+            self.get_status(e_context)
+        elif operation == "取消任务":
+            task_id = remaining.split(" ", 1)[1].strip()
+            self.cancel_task(e_context, task_id)
+        elif operation == "导入":
+            # 第一行可以带 预览, 之后每行一条任务
+            first_line, _, lines = remaining[len(operation):].partition("\n")
+            self.import_task_lines(e_context, lines.splitlines(), dry_run="预览" in first_line.split())
+        elif operation == "导出":
+            self.export_task_lines(e_context, remaining.split()[1:])
+        elif operation == "预览":
+            self.get_preview(e_context, remaining.split()[1:])
+        elif operation == "profile":
+            self.start_profile(e_context, remaining.split()[1:])
+        else:
+            try:
+                cycle, time_str, event, group_name = bulk.parse_spec(remaining)
+            except ValueError as e:
+                reply = Reply()
+                reply.type = ReplyType.TEXT
+                reply.content = str(e)
+                e_context["reply"] = reply
+                e_context.action = EventAction.BREAK_PASS
+                logger.error(str(e))
+                return
+            self.add_task(
+                e_context,
+                cycle=cycle,
+                time_str=time_str,
+                event=event,
+                group_name=group_name,
+            )
 
     # 解析事件与组
     def parse_event_and_group(self, event_str):
@@ -218,66 +171,7 @@ class TaskScheduler(Plugin):
         :param time_str: 表示时间的字符串 (例如: "08:30")
         """
         try:
-            # 解析 Cron 表达式，例如 "cron[0 8 * * *]"
-            if cycle.startswith("cron[") and cycle.endswith("]"):
-                cron_expr = cycle[5:-1]
-                return CronTrigger.from_crontab(cron_expr)
-
-            # 解析具体日期周期，例如 "2024-12-03"
-            if re.match(r"\d{4}-\d{2}-\d{2}", cycle):
-                if not time_str:
-                    raise ValueError("必须提供时间字符串 time_str")
-                date_obj = datetime.datetime.strptime(cycle, "%Y-%m-%d").date()
-                time_obj = datetime.datetime.strptime(time_str, "%H:%M").time()
-                run_date = datetime.datetime.combine(date_obj, time_obj)
-                return DateTrigger(run_date=run_date)
-
-            # 解析今天、明天、后天
-            if cycle in ["今天", "明天", "后天"]:
-                if not time_str:
-                    raise ValueError("必须提供时间字符串 time_str")
-                offset_days = {"今天": 0, "明天": 1, "后天": 2}[cycle]
-                base_date = datetime.datetime.today().date() + datetime.timedelta(
-                    days=offset_days
-                )
-                time_obj = datetime.datetime.strptime(time_str, "%H:%M").time()
-                run_date = datetime.datetime.combine(base_date, time_obj)
-                return DateTrigger(run_date=run_date)
-
-            # 解析每周指定日，例如 "每周一"
-            if cycle.startswith("每周"):
-                if not time_str:
-                    raise ValueError("必须提供时间字符串 time_str")
-                weekday_name = cycle[2:]
-                weekday_mapping = {
-                    "一": 0,
-                    "二": 1,
-                    "三": 2,
-                    "四": 3,
-                    "五": 4,
-                    "六": 5,
-                    "日": 6,
-                }
-                if weekday_name not in weekday_mapping:
-                    raise ValueError(f"无效的星期: {weekday_name}")
-                weekday = weekday_mapping[weekday_name]
-                hour, minute = map(int, time_str.split(":"))
-                return CronTrigger(day_of_week=weekday, hour=hour, minute=minute)
-
-            # 默认处理每日、工作日等周期
-            if cycle == "每天":
-                if not time_str:
-                    raise ValueError("必须提供时间字符串 time_str")
-                hour, minute = map(int, time_str.split(":"))
-                return CronTrigger(hour=hour, minute=minute)
-            if cycle == "工作日":
-                if not time_str:
-                    raise ValueError("必须提供时间字符串 time_str")
-                hour, minute = map(int, time_str.split(":"))
-                return CronTrigger(day_of_week="mon-fri", hour=hour, minute=minute)
-
-            # 无法匹配的周期规则
-            raise ValueError(f"无法解析周期: {cycle}")
+            return build_trigger(cycle, time_str)
         except Exception as e:
             raise ValueError(f"生成 Trigger 时出错: {e}")
 
@@ -293,96 +187,121 @@ class TaskScheduler(Plugin):
         reply = Reply()
         reply.type = ReplyType.TEXT
         try:
-            task_id = self.generate_short_id()
+            task_id = self.new_task_ids()[0]
             # event, group_name = parse_event_and_group(event)
-            trigger = self.get_trigger(cycle, time_str)
+            trigger = self.make_trigger(task_id, cycle, time_str)
             _msg = e_context["context"]["msg"]
-            msg = ChatMessage({})
-            msg.ctype = ContextType.TEXT
-            msg.content = event
-
-            # 在群聊中触发
-            if _msg.is_group:
-                # 提供 group_name
-                if group_name is not None:
-                    group_id = self.channel_tools.get_group_id_by_name(group_name)
-                    if group_id is None:
-                        raise ValueError(f"没有找到 {group_name}")
-                    msg.actual_user_id = _msg.actual_user_id
-                    msg.actual_user_nickname = _msg.actual_user_nickname
-                    msg.from_user_id = group_id
-                    msg.from_user_nickname = group_name
-                    msg.other_user_id = group_id
-                    msg.other_user_nickname = group_name
-                    msg.is_group = True
-                    msg.to_user_id = _msg.to_user_id
-                    msg.to_user_nickname = _msg.to_user_nickname
-                    msg.is_at = True
-                    no_need_at = True
-                # 没有提供 group_name
-                else:
-                    msg.actual_user_id = _msg.actual_user_id
-                    msg.actual_user_nickname = _msg.actual_user_nickname
-                    msg.from_user_id = _msg.from_user_id
-                    msg.from_user_nickname = _msg.from_user_nickname
-                    msg.other_user_id = _msg.other_user_id
-                    msg.other_user_nickname = _msg.other_user_nickname
-                    msg.to_user_id = _msg.to_user_id
-                    msg.to_user_nickname = _msg.to_user_nickname
-                    msg.is_group = True
-                    msg.is_at = True
-                    no_need_at = False
-            # 私聊中触发
-            else:
-                # 提供 group_name
-                if group_name is not None:
-                    group_id = self.channel_tools.get_group_id_by_name(group_name)
-                    if group_id is None:
-                        raise ValueError(f"没有找到 {group_name}")
-
-                    msg.actual_user_id = _msg.from_user_id
-                    msg.actual_user_nickname = _msg.from_user_nickname
-                    msg.from_user_id = group_id
-                    msg.from_user_nickname = group_name
-                    msg.other_user_id = group_id
-                    msg.other_user_nickname = group_name
-                    msg.to_user_id = _msg.to_user_id
-                    msg.to_user_nickname = _msg.to_user_nickname
-                    msg.is_at = True
-                    msg.is_group = True
-                    no_need_at = True
-                # 没有提供 group_name
-                else:
-                    msg.from_user_id = _msg.from_user_id
-                    msg.from_user_nickname = _msg.from_user_nickname
-                    msg.other_user_id = _msg.other_user_id
-                    msg.other_user_nickname = _msg.other_user_nickname
-                    msg.to_user_id = _msg.to_user_id
-                    msg.to_user_nickname = _msg.to_user_nickname
-                    msg.is_group = False
-                    no_need_at = False
-
+            recipient_keys, no_need_at, actual_user_id, actual_user_nickname = self.task_target(_msg, group_name)
+
+            record = TaskRecord(
+                task_id,
+                event,
+                group_name,
+                recipient_keys[0],
+                no_need_at,
+                actual_user_id,
+                actual_user_nickname,
+                cycle,
+                time_str,
+                recipient_keys if len(recipient_keys) > 1 else None,
+            )
+            # 在加入新任务之前检查, 提示的是已有的负载
+            hot = fire_preview.hot_minutes(trigger, len(recipient_keys))
+            flush_before_job_write(self.scheduler._lookup_jobstore("default"), self.write_behind)
             self.scheduler.add_job(
                 task_execute,
                 trigger,
                 id=task_id,
-                args=(
-                    task_id,
-                    event,
-                    group_name,
-                    msg,
-                    no_need_at
-                ),
-                misfire_grace_time=60
+                args=(record.encode(),),
+                executor=route_pool(self.config, record),
+                misfire_grace_time=MISFIRE_GRACE_TIME,
             )
+            owner, chat = self.owner_and_chat(_msg)
+            self.write_behind.put(("index", task_id), index_op(record, owner, chat))
             logger.info(f"任务添加成功，任务编号: {task_id}")
             reply.content = f"任务添加成功，任务编号: {task_id}"
+            if hot:
+                reply.content += "\n" + format_hot_minutes(hot)
         except Exception as e:
             logger.error(f"添加任务失败: {e}")
             reply.content = f"添加任务失败: {e}"
         e_context["reply"] = reply
         e_context.action = EventAction.BREAK_PASS
 
+    # 生成任务的 Trigger, 周期任务按任务编号固定错开几秒, 避免同一时刻的任务同时发送
+    def make_trigger(self, task_id: str, cycle: str, time_str: Optional[str] = None):
+        return self.add_jitter(task_id, self.get_trigger(cycle, time_str))
+
+    def add_jitter(self, task_id: str, trigger):
+        if isinstance(trigger, CronTrigger):
+            offset = jitter_offset(task_id, self.config.get("jitter_window", 0))
+            if offset:
+                trigger = OffsetTrigger(trigger, offset)
+        return trigger
+
+    # 任务的发送目标, 返回 (recipient_keys, no_need_at, actual_user_id, actual_user_nickname)
+    # group_ids 为已经查找过的群名 -> 群 id, 批量导入时避免重复查找
+    def task_target(self, _msg, group_name: Optional[str] = None, group_ids=None):
+        # 在群聊中触发
+        if _msg.is_group:
+            actual_user_id = _msg.actual_user_id
+            actual_user_nickname = _msg.actual_user_nickname
+            # 提供 group_name
+            if group_name is not None:
+                recipient_keys = self.register_groups(group_name, _msg, group_ids)
+                no_need_at = True
+            # 没有提供 group_name
+            else:
+                recipient_keys = [registry.register(
+                    True, _msg.other_user_id, _msg.other_user_nickname, _msg.to_user_id, _msg.to_user_nickname
+                )]
+                no_need_at = False
+        # 私聊中触发
+        else:
+            # 提供 group_name
+            if group_name is not None:
+                actual_user_id = _msg.from_user_id
+                actual_user_nickname = _msg.from_user_nickname
+                recipient_keys = self.register_groups(group_name, _msg, group_ids)
+                no_need_at = True
+            # 没有提供 group_name
+            else:
+                actual_user_id = None
+                actual_user_nickname = None
+                recipient_keys = [registry.register(
+                    False, _msg.other_user_id, _msg.other_user_nickname, _msg.to_user_id, _msg.to_user_nickname
+                )]
+                no_need_at = False
+        return recipient_keys, no_need_at, actual_user_id, actual_user_nickname
+
+    # 展开 group[...] 中的群名, 支持 group[a,b,c] 与 config.json 中 audiences 定义的受众名称
+    def expand_groups(self, group_name: str):
+        audiences = self.config.get("audiences", {})
+        names = []
+        for name in re.split(r"[,，]", group_name):
+            name = name.strip()
+            for member in audiences.get(name, [name]):
+                if member and member not in names:
+                    names.append(member)
+        if not names:
+            raise ValueError(f"没有找到 {group_name}")
+        return names
+
+    # 注册 group[...] 中的群, 返回发送目标的 key
+    def register_groups(self, group_name: str, _msg, group_ids=None):
+        recipient_keys = []
+        for name in self.expand_groups(group_name):
+            if group_ids is not None and name in group_ids:
+                group_id = group_ids[name]
+            else:
+                group_id = self.channel_tools.get_group_id_by_name(name)
+            if group_id is None:
+                raise ValueError(f"没有找到 {name}")
+            recipient_keys.append(registry.register(
+                True, group_id, name, _msg.to_user_id, _msg.to_user_nickname
+            ))
+        return recipient_keys
+
     # 取消任务
     def cancel_task(self, e_context: EventContext, task_id: str):
         reply = Reply()
@@ -397,90 +316,320 @@ class TaskScheduler(Plugin):
         e_context["reply"] = reply
         e_context.action = EventAction.BREAK_PASS
 
-    # 列出任务
-    def get_task_list(self, e_context: EventContext):
+    # 消息发送者与所在会话, 与任务列表索引中的 owner/chat 对应
+    def owner_and_chat(self, _msg):
+        if _msg.is_group:
+            return _msg.actual_user_nickname, chat_key(True, _msg.other_user_nickname)
+        return _msg.from_user_nickname, chat_key(False, _msg.other_user_nickname)
+
+    # 列出任务, 参数: [我的|本群] [关键词] [页码], 默认列出当前会话创建的任务
+    def get_task_list(self, e_context: EventContext, args=()):
         reply = Reply()
         reply.type = ReplyType.TEXT
+        owner, chat = self.owner_and_chat(e_context["context"]["msg"])
+        scope = "本群"
+        page = 1
+        keywords = []
+        for arg in args:
+            if arg.isdigit():
+                page = int(arg)
+            elif arg in ("我的", "本群"):
+                scope = arg
+            else:
+                keywords.append(arg)
+        keyword = " ".join(keywords)
+
+        # 刚添加或取消的任务可能还在写队列里
+        self.write_behind.flush()
+        result = query_tasks(
+            self.scheduler._lookup_jobstore("default"),
+            chat=chat if scope == "本群" else None,
+            owner=owner if scope == "我的" else None,
+            keyword=keyword,
+            page=page,
+            page_size=self.config.get("list_page_size", 10),
+            timezone=self.scheduler.timezone,
+        )
+        logger.info(f"[TaskScheduler] 任务列表: {scope} {keyword} 第 {result.page}/{result.pages} 页, 共 {result.total} 个")
+
         results = []
-        jobs = self.scheduler.get_jobs()
-        if jobs:
-            logger.info("任务列表:")
-            results.append("任务列表:")
-            for i, job in enumerate(jobs):
-                logger.info(f"任务编号: {job.id}")
-                results.append(f"任务编号: {job.id}")
-                logger.info(f"下次运行时间: {job.next_run_time}")
-                results.append(f"下次运行时间: {job.next_run_time}")
-                logger.info(f"任务内容: {job.args[1]}")
-                results.append(f"任务内容: {job.args[1]}")
-                if job.args[2]:
-                    logger.info(f"群组: {job.args[2]}")
-                    results.append(f"群组: {job.args[2]}")
-                if i != len(jobs) - 1:
-                    logger.info("--------------------")
+        if result.rows:
+            results.append(f"任务列表({scope}, 第 {result.page}/{result.pages} 页, 共 {result.total} 个):")
+            for i, (job_id, next_run_time, content, group_name) in enumerate(result.rows):
+                results.append(f"任务编号: {job_id}")
+                results.append(f"下次运行时间: {next_run_time if next_run_time is not None else '已暂停'}")
+                results.append(f"任务内容: {content}")
+                if group_name:
+                    results.append(f"群组: {group_name}")
+                if i != len(result.rows) - 1:
                     results.append("--------------------")
+            if result.page < result.pages:
+                trigger_prefix = conf().get("plugin_trigger_prefix", "$")
+                command_prefix = self.config.get("command_prefix", "time")
+                command = " ".join(a for a in (scope, keyword, str(result.page + 1)) if a)
+                results.append(f"发送 {trigger_prefix}{command_prefix} 任务列表 {command} 查看下一页")
         else:
-            logger.info("没有任务")
             results.append("没有任务")
         reply.content = "\n".join(results)
         e_context["reply"] = reply
         e_context.action = EventAction.BREAK_PASS
-    
-                 
-# 执行任务
-def task_execute(
-    task_id: str,
-    event: str,
-    group_name: Optional[str],
-    msg:ChatMessage,
-    no_need_at
-):
-    logger.info(f"开始执行任务{task_id}: {event}, 组: {group_name}")
-    prefix = conf().get("single_chat_prefix", [""])
-
-
-    if pconf('TaskScheduler').get('allow_call_other_plugins', True):
-        call_other_plugins = True
-        for custom_command in pconf('TaskScheduler').get('custom_commands', []):
-            if event.startswith(custom_command['key_word']):
-                event = f"{custom_command['command_prefix']}{event}"
-                break
 
-    content = f"{prefix[0]} {event}" if not msg.is_group else event
-    content_dict = {
-        "no_need_at": no_need_at,
-        "isgroup": msg.is_group,
-        "msg": msg,
-    }
-
-    # channel 是单例的
-    channel = create_channel(conf().get("channel_type"))
-    if isinstance(channel, ChatChannel):
-        context = channel._compose_context(
-            ContextType.TEXT, content, **content_dict
+
+    # 批量导入, 每行一条任务, 格式与添加任务相同; 预览时只校验不导入
+    def import_task_lines(self, e_context: EventContext, lines, dry_run=False):
+        reply = Reply()
+        reply.type = ReplyType.TEXT
+        try:
+            report = self.import_tasks(lines, e_context["context"]["msg"], dry_run)
+            reply.content = report.summary()
+        except Exception as e:
+            logger.error(f"导入任务失败: {e}")
+            reply.content = f"导入任务失败: {e}"
+        e_context["reply"] = reply
+        e_context.action = EventAction.BREAK_PASS
+
+    # 导出当前会话(或自己创建)的任务, 回复的内容可以直接用于导入
+    def export_task_lines(self, e_context: EventContext, args=()):
+        reply = Reply()
+        reply.type = ReplyType.TEXT
+        owner, chat = self.owner_and_chat(e_context["context"]["msg"])
+        scope = "我的" if "我的" in args else "本群"
+        self.write_behind.flush()
+        specs = bulk.iter_specs(
+            self.scheduler._lookup_jobstore("default"),
+            timezone=self.scheduler.timezone,
+            chat=chat if scope == "本群" else None,
+            owner=owner if scope == "我的" else None,
         )
+        results = []
+        for job_id, spec in specs:
+            if len(results) >= bulk.EXPORT_REPLY_LIMIT:
+                results.append(f"# 只显示前 {bulk.EXPORT_REPLY_LIMIT} 个任务")
+                break
+            results.append(spec if spec is not None else f"# {job_id} 缺少周期信息, 无法导出")
+        reply.content = "\n".join(results) if results else "没有任务"
+        e_context["reply"] = reply
+        e_context.action = EventAction.BREAK_PASS
+
+    def import_tasks(self, source, msg=None, dry_run=False):
+        """
+        批量导入任务的 Python API, source 为文件路径、文件对象或逐行的字符串, 返回 bulk.ImportReport
+        msg 为 None 时每行都必须指定 group[...]
+        """
+        return bulk.import_tasks(self, bulk.read_lines(source), msg, dry_run)
+
+    def export_tasks(self, out):
+        """把所有任务逐行写入 out(文件路径或文件对象), 返回导出的任务数"""
+        self.write_behind.flush()
+        return bulk.export_tasks(self.scheduler._lookup_jobstore("default"), out, self.scheduler.timezone)
+
+    def preview(self, start=None, minutes=60):
+        """
+        运行时间预览的 Python API: [start, start + minutes 分钟) 内有任务运行的每一分钟
+        返回 [(分钟开始时间, 运行次数, 发送条数)], start 默认为现在
+        """
+        if start is None:
+            start = datetime.datetime.now(self.scheduler.timezone)
+        return fire_preview.histogram(start, start + datetime.timedelta(minutes=minutes))
+
+    # 未来一段时间每分钟的负载, 参数: [今天|明天|后天] [HH:MM] [分钟数]
+    def get_preview(self, e_context: EventContext, args=()):
+        reply = Reply()
+        reply.type = ReplyType.TEXT
         try:
-            if call_other_plugins:
-                e_context = PluginManager().emit_event(
-                    EventContext(
-                        Event.ON_HANDLE_CONTEXT,
-                        {"channel": channel, "context": context, "reply": Reply()},
-                    )
-                )
-            if e_context["reply"]:
-                reply = e_context["reply"]
-                if not reply.content:
-                    reply.type = ReplyType.TEXT
-                    reply.content = f"【执行定时任务】\n任务编号: {task_id}\n任务内容: {event}"
-                if msg.is_group and reply.type == ReplyType.TEXT and not context.get('no_need_at', False):
-                    reply.content = f"@{msg.actual_user_nickname}\n{reply.content}"
-                channel.send(reply, context)
+            start, minutes = parse_preview_args(args, self.scheduler.timezone)
+        except ValueError:
+            reply.content = f"用法: {self.router.head}预览 [今天|明天|后天] [HH:MM] [分钟数]"
+        else:
+            reply.content = format_preview(start, minutes, self.preview(start, minutes))
+        e_context["reply"] = reply
+        e_context.action = EventAction.BREAK_PASS
+
+    def profile(self, seconds, mode="sample"):
+        """
+        性能分析的 Python API: 对调度与执行任务的线程分析 seconds 秒(阻塞), 返回 profiling.ProfileResult
+        mode 为 sample(采样, 写入 .folded)或 cprofile(写入 .pstats), 结果保存在 tasks.db 所在目录
+        """
+        options = self.config.get("profiling", {})
+        return profiler.run(
+            min(seconds, options.get("max_seconds", 300)),
+            mode,
+            os.path.dirname(db_path),
+            top=options.get("top", 10),
+            interval=options.get("interval", 0.01),
+            keep=options.get("keep", 10),
+        )
+
+    # 管理员命令, 参数: <秒数> [sample|cprofile]; 先回复开始, 结束后把耗时最多的函数发到当前会话
+    def start_profile(self, e_context: EventContext, args=()):
+        reply = Reply()
+        reply.type = ReplyType.TEXT
+        context = e_context["context"]
+        msg = context["msg"]
+        user_id = msg.actual_user_id if msg.is_group else msg.from_user_id
+        mode = args[1] if len(args) > 1 else "sample"
+        if user_id not in global_config.get("admin_users", []):
+            reply.content = "性能分析只允许管理员使用"
+        elif not args or not args[0].isdigit() or int(args[0]) <= 0 or mode not in PROFILE_MODES:
+            reply.content = f"用法: {self.router.head}profile <秒数> [{'|'.join(PROFILE_MODES)}]"
+        elif profiler.busy:
+            reply.content = "已有一个性能分析正在进行"
+        else:
+            seconds = min(int(args[0]), self.config.get("profiling", {}).get("max_seconds", 300))
+
+            def run():
+                try:
+                    content = format_profile(self.profile(seconds, mode))
+                except Exception as e:
+                    logger.error(f"[TaskScheduler] 性能分析失败: {e}")
+                    content = f"性能分析失败: {e}"
+                try:
+                    create_channel(conf().get("channel_type")).send(Reply(ReplyType.TEXT, content), context)
+                except Exception as e:
+                    logger.error(f"[TaskScheduler] 发送性能分析结果失败: {e}")
+
+            threading.Thread(target=run, name="TaskScheduler-profile", daemon=True).start()
+            reply.content = f"开始性能分析({mode}), {seconds} 秒后发送结果"
+        e_context["reply"] = reply
+        e_context.action = EventAction.BREAK_PASS
+
+    # 调度延迟、耗时与失败次数等运行状态
+    def get_status(self, e_context: EventContext):
+        reply = Reply()
+        reply.type = ReplyType.TEXT
+        gauges = metrics.gauges()
+        results = [
+            "任务状态:",
+            f"等待执行: {gauges['queue_depth']}, 执行中: {gauges['running']}, 线程数: {gauges['active_threads']}",
+        ]
+        for alias, pool in metrics.pool_gauges().items():
+            results.append(
+                f"执行池 {alias}: 执行中 {pool['running']}/{pool['capacity']}, 排队 {pool['queued']}, 超时放弃 {pool['gave_up']}"
+            )
+        if metrics.enabled:
+            histograms, counters, lag_by_cycle = metrics.summary()
+            results.append(
+                f"执行: {counters.get('fires_total', 0)}, 错过: {counters.get('misfires_total', 0)}, "
+                f"跳过: {counters.get('skips_total', 0)}, 失败: {counters.get('failures_total', 0)}"
+            )
+            for name, title in (
+                ("fire_lag_seconds", "触发延迟"),
+                ("check_seconds", "条件检查"),
+                ("plugin_seconds", "插件调用"),
+                ("send_seconds", "发送"),
+                ("queue_wait_seconds", "池内排队"),
+            ):
+                histogram = histograms.get(name)
+                if histogram is not None:
+                    results.append(f"{title}: {format_histogram(histogram)}")
+            for cycle, histogram in sorted(lag_by_cycle.items()):
+                results.append(f"  {cycle}: {format_histogram(histogram)}")
+        else:
+            results.append("指标未开启, 可在 config.json 中设置 metrics.enabled")
+        gate = send_gate.stats()
+        if send_gate.enabled:
+            results.append(
+                f"限流: 等待中 {gate['waiting']}, 被推迟 {gate['delayed']}/{gate['admitted']}, "
+                f"平均等待 {gate['avg_wait']:.2f}s, 最长 {gate['max_wait']:.2f}s"
+            )
+        replays = catch_up.stats()
+        if replays["pending"] or replays["replayed"] or replays["dropped"]:
+            results.append(f"补发: 等待中 {replays['pending']}, 已补发 {replays['replayed']}, 放弃 {replays['dropped']}")
+        if leases.enabled:
+            claims = leases.stats()
+            results.append(
+                f"多进程协调: 本进程执行 {claims['claimed']}, 由其它进程执行 {claims['skipped']}, "
+                f"接管 {claims['taken_over']}, 被接管后放弃发送 {claims['fenced']}"
+            )
+        cache = result_cache.stats()
+        if cache["hits"] or cache["misses"]:
+            results.append(f"共享结果: 命中 {cache['hits']}, 合并 {cache['shared']}, 调用 {cache['misses']}")
+        reply.content = "\n".join(results)
+        e_context["reply"] = reply
+        e_context.action = EventAction.BREAK_PASS
+
+
+def format_histogram(histogram):
+    return (
+        f"{histogram.count} 次, p50 {histogram.quantile(0.5):.3f}s, "
+        f"p95 {histogram.quantile(0.95):.3f}s, 最大 {histogram.max:.3f}s"
+    )
+
+
+def parse_preview_args(args, timezone):
+    """返回 (开始时间, 分钟数); 只指定日期时为这一整天, 什么都不指定时为接下来的一小时"""
+    days = None
+    time_obj = None
+    minutes = None
+    for arg in args:
+        if arg in RELATIVE_DAYS:
+            days = RELATIVE_DAYS[arg]
+        elif ":" in arg:
+            time_obj = datetime.datetime.strptime(arg, "%H:%M").time()
+        elif arg.isdigit() and int(arg) > 0:
+            minutes = min(int(arg), PREVIEW_MAX_MINUTES)
+        else:
+            raise ValueError(arg)
+    now = datetime.datetime.now(timezone)
+    if days is None and time_obj is None:
+        return now, minutes or 60
+    if time_obj is None:
+        time_obj = datetime.time()
+        minutes = minutes or PREVIEW_MAX_MINUTES
+    start = now.replace(hour=time_obj.hour, minute=time_obj.minute, second=0, microsecond=0)
+    return start + datetime.timedelta(days=days or 0), minutes or 60
+
+
+def format_preview(start, minutes, rows):
+    end = start + datetime.timedelta(minutes=minutes)
+    lines = [
+        f"{start:%m-%d %H:%M} ~ {end:%m-%d %H:%M}: "
+        f"{sum(runs for _, runs, _ in rows)} 次运行, {sum(sends for _, _, sends in rows)} 条消息"
+    ]
+    if not rows:
+        lines.append("这段时间没有任务")
+        return "\n".join(lines)
+    busiest = max(rows, key=lambda row: row[2])
+    lines.append(f"最忙: {busiest[0]:%m-%d %H:%M}, {busiest[2]} 条消息")
+    shown = rows
+    if len(rows) > PREVIEW_REPLY_LIMIT:
+        lines.append(f"共 {len(rows)} 分钟有任务, 只显示最忙的 {PREVIEW_REPLY_LIMIT} 分钟")
+        shown = sorted(sorted(rows, key=lambda row: row[2], reverse=True)[:PREVIEW_REPLY_LIMIT])
+    for when, runs, sends in shown:
+        lines.append(f"{when:%H:%M} {sends} 条 ({runs} 个任务)")
+    return "\n".join(lines)
+
+
+def format_hot_minutes(hot):
+    when, sends = hot[0]
+    content = f"提示: {when:%m-%d %H:%M} 已有 {sends} 条消息在同一分钟发送"
+    if len(hot) > 1:
+        content += f", 之后还有 {len(hot) - 1} 次运行也在高峰"
+    quiet = fire_preview.quiet_minute(when)
+    if quiet is not None and quiet[1] < sends:
+        content += f", 可以考虑改到 {quiet[0]:%H:%M}(已有 {quiet[1]} 条)"
+    return content
+
+
+def format_profile(result):
+    lines = [
+        f"性能分析({result.mode}) {result.seconds} 秒, "
+        + (f"{result.samples} 个样本" if result.mode == "sample" else f"{result.samples} 次调用"),
+        f"结果: {result.path}",
+    ]
+    if result.skipped:
+        lines.append(f"{result.skipped} 次调用因为无法开启 cProfile 没有统计")
+    if not result.top:
+        lines.append("期间没有执行中的任务")
+    for i, (name, detail) in enumerate(result.top, 1):
+        lines.append(f"{i}. {name} {detail}")
+    return "\n".join(lines)
+
+
+# 执行任务
+def task_execute(payload: bytes):
+    dispatch.execute(payload)
 
-        except Exception as e:
-            logger.error(f"执行任务失败: {e}")
-            reply = Reply()
-            reply.type = ReplyType.TEXT
-            reply.content = f"执行任务失败: {e}"
-            if context:
-                channel.send(reply, context)
 
+# 异步执行器据此把插件调用与发送拆开调度
+task_execute.dispatch_stages = (dispatch.prepare, dispatch.admit, dispatch.deliver)
@@ -0,0 +1,53 @@
+# encoding:utf-8
+"""
+用 benchmarks/stubs 里的替身加载插件模块, 不需要 chatgpt-on-wechat
+
+    python -m pytest tests
+
+插件目录以 plugins.TaskScheduler 的名字注册, 但不执行 __init__.py(它会加载整个插件),
+测试只导入自己需要的模块
+"""
+import os
+import sys
+import types
+from datetime import datetime, timedelta
+
+from apscheduler.job import Job
+from apscheduler.triggers.date import DateTrigger
+from pytz import utc
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PLUGIN_DIR, "benchmarks", "stubs"))
+
+import plugins  # noqa: E402
+
+if "plugins.TaskScheduler" not in sys.modules:
+    package = types.ModuleType("plugins.TaskScheduler")
+    package.__path__ = [PLUGIN_DIR]
+    sys.modules["plugins.TaskScheduler"] = package
+    plugins.TaskScheduler = package
+
+# 测试里的运行时间都相对这个时刻, 以秒表示
+T0 = datetime(2030, 1, 1, 8, 0, tzinfo=utc)
+
+
+def at(seconds):
+    return T0 + timedelta(seconds=seconds)
+
+
+def make_job(scheduler, job_id, next_run_time):
+    """与 scheduler.add_job 构造的 job 字段相同, next_run_time 为空表示暂停"""
+    return Job(
+        scheduler,
+        id=job_id,
+        func="time:sleep",
+        args=(0,),
+        kwargs={},
+        name=job_id,
+        trigger=DateTrigger(next_run_time or T0),
+        executor="default",
+        misfire_grace_time=None,
+        coalesce=True,
+        max_instances=1,
+        next_run_time=next_run_time,
+    )
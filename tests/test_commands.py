@@ -0,0 +1,32 @@
+# encoding:utf-8
+"""custom_commands 索引的匹配顺序与缓存"""
+from plugins.TaskScheduler.commands import CommandTable, command_table
+
+
+def commands(*key_words):
+    return [{"key_word": key_word, "command_prefix": f"${key_word}"} for key_word in key_words]
+
+
+def test_match_keeps_configuration_order():
+    table = CommandTable(commands("天气", "天", "", "新闻"))
+
+    assert table.match("天气 北京")["key_word"] == "天气"
+    assert table.match("天空")["key_word"] == "天"
+    # 空关键词排在"新闻"之前, 匹配所有内容
+    assert table.match("新闻")["key_word"] == ""
+    assert CommandTable(commands("天气")).match("新闻") is None
+    assert CommandTable(None).match("新闻") is None
+
+
+def test_each_configuration_keeps_its_own_table():
+    # 插件自己的配置和全局插件配置是两个对象, 交替使用时不能互相挤掉
+    plugin_config = {"custom_commands": commands("天气")}
+    global_config = {"custom_commands": commands("天气")}
+    table = command_table(plugin_config)
+
+    assert command_table(global_config) is not table
+    assert command_table(plugin_config) is table
+    assert command_table(global_config) is command_table(global_config)
+
+    plugin_config["custom_commands"] = commands("新闻")
+    assert command_table(plugin_config).match("新闻")["key_word"] == "新闻"
@@ -0,0 +1,71 @@
+# encoding:utf-8
+"""_RosterIndex 的命中、负缓存与重建次数"""
+from plugins.TaskScheduler.tools import _RosterIndex
+
+
+def make_index(roster, **kwargs):
+    calls = []
+
+    def fetch(update):
+        calls.append(update)
+        return list(roster)
+
+    return _RosterIndex("group", fetch, ("NickName",), **kwargs), calls
+
+
+def group(n):
+    return {"NickName": f"群{n}", "UserName": f"@@{n}"}
+
+
+def test_hits_after_one_build_and_negative_cache_for_misses():
+    roster = [group(n) for n in range(3)]
+    index, calls = make_index(roster)
+
+    assert index.lookup("群1") == "@@1"
+    assert index.lookup("群2") == "@@2"
+    assert calls == [False]
+
+    assert index.lookup("不存在") is None
+    assert index.lookup("不存在") is None
+    # 本地快照没有才强制拉取一次, 之后走负缓存
+    assert calls == [False, True]
+    assert index.stats()["negative_hits"] == 1
+
+
+def test_oversized_roster_is_fully_indexed_and_misses_do_not_rebuild():
+    roster = [group(n) for n in range(100)]
+    index, calls = make_index(roster, max_entries=10)
+
+    for n in range(100):
+        assert index.lookup(f"群{n}") == f"@@{n}"
+    assert calls == [False]
+
+    for n in range(50):
+        assert index.lookup(f"不存在{n}") is None
+    # 未命中不再每次从整个通讯录重建, 只有第一次允许一次强制刷新
+    assert calls == [False, True]
+    assert index.lookup("群0") == "@@0"
+
+
+def test_negative_cache_is_bounded_without_touching_the_roster():
+    roster = [group(n) for n in range(3)]
+    index, calls = make_index(roster, max_entries=2)
+
+    for n in range(5):
+        assert index.lookup(f"不存在{n}") is None
+    assert index.stats()["size"] == 3 + 2
+    calls.clear()
+
+    assert [index.lookup(f"群{n}") for n in range(3)] == ["@@0", "@@1", "@@2"]
+    assert calls == []
+
+
+def test_invalidate_drops_the_snapshot():
+    roster = [group(0)]
+    index, calls = make_index(roster)
+    assert index.lookup("群0") == "@@0"
+
+    roster[0] = {"NickName": "群0", "UserName": "@@new"}
+    index.invalidate()
+    assert index.lookup("群0") == "@@new"
+    assert calls == [False, False]
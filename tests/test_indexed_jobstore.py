@@ -0,0 +1,125 @@
+# encoding:utf-8
+"""IndexedJobStore 的内存索引(小根堆 + 延迟删除)与 SQLite 中的数据保持一致"""
+import pytest
+from apscheduler.jobstores.base import ConflictingIdError, JobLookupError
+from apscheduler.schedulers.background import BackgroundScheduler
+from conftest import at, make_job
+from pytz import utc
+
+from plugins.TaskScheduler.storage import IndexedJobStore
+
+
+@pytest.fixture
+def scheduler():
+    return BackgroundScheduler(timezone=utc)
+
+
+@pytest.fixture
+def open_store(tmp_path, scheduler):
+    stores = []
+
+    def open_store(flush_interval=60):
+        # flush_interval 很长, 写入只在读之前的 flush 里提交, 测的是读自己的写入
+        store = IndexedJobStore(str(tmp_path / "tasks.db"), flush_interval=flush_interval)
+        store.start(scheduler, "default")
+        stores.append(store)
+        return store
+
+    yield open_store
+    for store in stores:
+        store.shutdown()
+
+
+def due_ids(store, seconds):
+    return [job.id for job in store.get_due_jobs(at(seconds))]
+
+
+def test_add_then_due_in_run_time_order(open_store, scheduler):
+    store = open_store()
+    for job_id, seconds in (("c", 30), ("a", 10), ("b", 20)):
+        store.add_job(make_job(scheduler, job_id, at(seconds)))
+
+    assert store.get_next_run_time() == at(10)
+    assert due_ids(store, 5) == []
+    assert due_ids(store, 20) == ["a", "b"]
+    assert due_ids(store, 30) == ["a", "b", "c"]
+
+
+def test_modify_moves_job_and_drops_stale_heap_entries(open_store, scheduler):
+    store = open_store()
+    a, b = make_job(scheduler, "a", at(10)), make_job(scheduler, "b", at(20))
+    store.add_job(a)
+    store.add_job(b)
+
+    b.next_run_time = at(5)
+    store.update_job(b)
+    a.next_run_time = at(100)
+    store.update_job(a)
+
+    assert store.get_next_run_time() == at(5)
+    # a 在堆里还有 at(10) 的旧条目, 不能再被当作到期
+    assert due_ids(store, 20) == ["b"]
+    assert [job.next_run_time for job in store.get_due_jobs(at(100))] == [at(5), at(100)]
+
+
+def test_repeated_updates_do_not_duplicate_or_grow_the_heap(open_store, scheduler):
+    store = open_store()
+    job = make_job(scheduler, "a", at(0))
+    store.add_job(job)
+    store.add_job(make_job(scheduler, "b", at(50)))
+    for seconds in range(1, 5000):
+        job.next_run_time = at(seconds)
+        store.update_job(job)
+
+    assert due_ids(store, 5000) == ["b", "a"]
+    assert len(store._heap) <= 2 * len(store._next_run_times) + 1024
+
+
+def test_remove_and_pause(open_store, scheduler):
+    store = open_store()
+    store.add_job(make_job(scheduler, "a", at(10)))
+    store.add_job(make_job(scheduler, "b", at(20)))
+    store.add_job(make_job(scheduler, "paused", None))
+
+    store.remove_job("a")
+
+    assert store.get_next_run_time() == at(20)
+    assert due_ids(store, 1000) == ["b"]
+    assert store.lookup_job("a") is None
+    assert store.lookup_job("paused").next_run_time is None
+    with pytest.raises(JobLookupError):
+        store.remove_job("a")
+
+    store.remove_job("b")
+    assert store.get_next_run_time() is None
+    assert due_ids(store, 1000) == []
+
+
+def test_conflicts_see_queued_writes(open_store, scheduler):
+    store = open_store()
+    store.add_job(make_job(scheduler, "a", at(10)))
+    # 还在写队列里, 没有提交
+    with pytest.raises(ConflictingIdError):
+        store.add_job(make_job(scheduler, "a", at(20)))
+
+    store.remove_job("a")
+    # 排队中的 remove 之后可以用同一个编号重新添加
+    store.add_job(make_job(scheduler, "a", at(30)))
+    assert due_ids(store, 30) == ["a"]
+    assert store.lookup_job("a").next_run_time == at(30)
+
+
+def test_index_is_rebuilt_from_sqlite_on_start(open_store, scheduler):
+    store = open_store()
+    a = make_job(scheduler, "a", at(10))
+    store.add_job(a)
+    store.add_job(make_job(scheduler, "b", at(20)))
+    store.add_job(make_job(scheduler, "c", at(30)))
+    a.next_run_time = at(40)
+    store.update_job(a)
+    store.remove_job("c")
+    store.shutdown()
+
+    reopened = open_store()
+    assert reopened.get_next_run_time() == at(20)
+    assert due_ids(reopened, 40) == ["b", "a"]
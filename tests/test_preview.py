@@ -0,0 +1,53 @@
+# encoding:utf-8
+"""FirePreview 添加任务时的高峰提示"""
+import threading
+import time
+from datetime import datetime
+
+from apscheduler.triggers.interval import IntervalTrigger
+from pytz import utc
+
+from plugins.TaskScheduler.preview import FirePreview
+
+
+class ProbeTrigger(IntervalTrigger):
+    """展开时记录 FirePreview 的锁能否被其它线程拿到"""
+
+    def __init__(self, preview, **kwargs):
+        super().__init__(timezone=utc, **kwargs)
+        self.preview = preview
+        self.lock_free = []
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        def probe():
+            acquired = self.preview._lock.acquire(blocking=False)
+            if acquired:
+                self.preview._lock.release()
+            self.lock_free.append(acquired)
+
+        thread = threading.Thread(target=probe)
+        thread.start()
+        thread.join()
+        return super().get_next_fire_time(previous_fire_time, now)
+
+
+def built_preview(minutes, hot_threshold):
+    preview = FirePreview()
+    preview.configure(horizon_hours=1, hot_threshold=hot_threshold)
+    preview._scheduler = type("Scheduler", (), {"timezone": utc})()
+    preview._minutes = minutes
+    preview._end = int(time.time()) + 3600
+    preview._built_at = time.time()
+    return preview
+
+
+def test_hot_minutes_expands_the_trigger_without_holding_the_lock():
+    start = int(time.time() // 60) + 1
+    # 第一分钟已经有 4 条, 第二分钟 1 条
+    preview = built_preview({start: [2, 4], start + 1: [1, 1]}, hot_threshold=5)
+    trigger = ProbeTrigger(preview, minutes=1, start_date=datetime.fromtimestamp(start * 60, utc))
+
+    hot = preview.hot_minutes(trigger, sends=1)
+
+    assert hot == [(datetime.fromtimestamp(start * 60, utc), 4)]
+    assert trigger.lock_free and all(trigger.lock_free)
@@ -0,0 +1,82 @@
+# encoding:utf-8
+"""机器人重新登录后发送目标的修复"""
+import threading
+import types
+
+import pytest
+from lib import itchat
+from sqlalchemy import create_engine
+
+from plugins.TaskScheduler.recipients import RecipientRegistry
+from plugins.TaskScheduler.runtime import RuntimeState
+from plugins.TaskScheduler.storage import WriteBehindQueue, create_tables
+from plugins.TaskScheduler.tools import get_channel_tools
+
+
+@pytest.fixture
+def directory():
+    directory = get_channel_tools().directory
+    saved = list(itchat.chatrooms)
+    itchat.chatrooms[:] = [{"NickName": "群A", "UserName": "@@old"}]
+    directory.invalidate()
+    yield directory
+    itchat.chatrooms[:] = saved
+    directory.invalidate()
+
+
+@pytest.fixture
+def registry(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'tasks.db'}")
+    create_tables(engine)
+    write_behind = WriteBehindQueue(engine, delay=60)
+    registry = RecipientRegistry()
+    registry.bind(engine, write_behind)
+    yield registry
+    write_behind.close()
+
+
+def test_directory_is_cleared_before_the_new_bot_id_is_returned(directory):
+    state = RuntimeState()
+    state._channel = types.SimpleNamespace(user_id="bot1")
+    assert state.bot_user_id() == "bot1"
+    assert directory.groups.lookup("群A") == "@@old"
+
+    # 重新登录: 会话 id 全部换新, 拿到新机器人 id 的调用方不能再查到旧 id
+    itchat.chatrooms[:] = [{"NickName": "群A", "UserName": "@@new"}]
+    state._channel.user_id = "bot2"
+    assert state.bot_user_id() == "bot2"
+    assert directory.groups.lookup("群A") == "@@new"
+
+
+def test_relogin_during_a_repair_does_not_keep_the_old_roster(directory, registry, monkeypatch):
+    state = RuntimeState()
+    state._channel = types.SimpleNamespace(user_id="bot1")
+    state.bot_user_id()
+    recipient = registry.get(registry.register(True, "@@before", "群A", "bot0", "机器人"))
+
+    fetching, release = threading.Event(), threading.Event()
+    get_chatrooms = itchat.get_chatrooms
+
+    def slow_get_chatrooms(update=False):
+        roster = get_chatrooms(update)
+        if not fetching.is_set():
+            # 第一次拉取拿到的是重新登录前的通讯录, 等重新登录之后才返回
+            fetching.set()
+            release.wait(5)
+        return roster
+
+    monkeypatch.setattr(itchat, "get_chatrooms", slow_get_chatrooms)
+    repairing = threading.Thread(target=registry.repair, args=(recipient, "bot1"))
+    repairing.start()
+    assert fetching.wait(5)
+
+    itchat.chatrooms[:] = [{"NickName": "群A", "UserName": "@@new"}]
+    state._channel.user_id = "bot2"
+    assert state.bot_user_id() == "bot2"
+    release.set()
+    repairing.join(5)
+
+    # 重新登录后的修复(reconcile)不能用上一次登录的快照
+    registry.reconcile("bot2")
+    assert (recipient.chat_id, recipient.bot_user_id) == ("@@new", "bot2")
+    assert directory.groups.lookup("群A") == "@@new"
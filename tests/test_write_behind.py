@@ -0,0 +1,134 @@
+# encoding:utf-8
+"""WriteBehindQueue 的合并、提交顺序与读自己的写入"""
+import pytest
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+from conftest import at, make_job
+from sqlalchemy import create_engine, text
+
+from plugins.TaskScheduler.storage import TunedSQLiteJobStore, WriteBehindQueue, flush_before_job_write
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'queue.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE kv (key TEXT PRIMARY KEY, value TEXT)"))
+    return engine
+
+
+@pytest.fixture
+def queue(engine):
+    # delay 很长, 只有显式 flush/close 才提交
+    queue = WriteBehindQueue(engine, delay=60)
+    yield queue
+    queue.close()
+
+
+def put_op(key, value, log=None):
+    def op(connection):
+        if log is not None:
+            log.append((key, value))
+        connection.execute(text("INSERT OR REPLACE INTO kv VALUES (:key, :value)"), {"key": key, "value": value})
+
+    return op
+
+
+def read(engine):
+    with engine.begin() as connection:
+        return dict(connection.execute(text("SELECT key, value FROM kv")).all())
+
+
+def test_same_key_keeps_last_write_at_its_first_position(queue, engine):
+    log = []
+    queue.put("a", put_op("a", "1", log))
+    queue.put("b", put_op("b", "1", log))
+    queue.put("a", put_op("a", "2", log))
+
+    assert len(queue) == 2
+    assert queue.flush() == 2
+    assert log == [("a", "2"), ("b", "1")]
+    assert read(engine) == {"a": "2", "b": "1"}
+    assert queue.flush() == 0
+
+
+def test_pending_is_visible_until_committed(queue, engine):
+    op = put_op("a", "1")
+    queue.put("a", op)
+    assert queue.pending("a") is op
+    assert read(engine) == {}
+
+    queue.flush()
+    assert queue.pending("a") is None
+    assert read(engine) == {"a": "1"}
+
+
+def test_pending_includes_writes_being_committed(queue):
+    seen = []
+
+    def op(connection):
+        # 提交期间, 其它线程(比如 add_job 的编号冲突检查)仍然要能看到这次写入
+        seen.append(queue.pending("a") is op)
+
+    queue.put("a", op)
+    queue.flush()
+    assert seen == [True]
+
+
+def test_failed_op_does_not_drop_the_rest_of_the_batch(queue, engine):
+    def broken(connection):
+        connection.execute(text("INSERT INTO missing VALUES (1)"))
+
+    queue.put("a", put_op("a", "1"))
+    queue.put("broken", broken)
+    queue.put("b", put_op("b", "1"))
+    queue.flush()
+
+    assert read(engine) == {"a": "1", "b": "1"}
+
+
+def test_close_commits_and_rejects_later_writes(queue, engine):
+    queue.put("a", put_op("a", "1"))
+    queue.close()
+
+    assert read(engine) == {"a": "1"}
+    with pytest.raises(RuntimeError):
+        queue.put("b", put_op("b", "1"))
+
+
+def test_tuned_store_reads_its_own_queued_writes(tmp_path):
+    scheduler = BackgroundScheduler()
+    store = TunedSQLiteJobStore(str(tmp_path / "tasks.db"), flush_interval=60)
+    store.start(scheduler, "default")
+    try:
+        job = make_job(scheduler, "a", at(10))
+        store.add_job(job)
+        assert len(store.write_behind) == 1
+        assert store.lookup_job("a").next_run_time == at(10)
+
+        job.next_run_time = at(20)
+        store.update_job(job)
+        assert store.get_next_run_time() == at(20)
+        assert [j.id for j in store.get_due_jobs(at(20))] == ["a"]
+
+        store.remove_job("a")
+        assert store.lookup_job("a") is None
+        assert store.get_all_jobs() == []
+    finally:
+        store.shutdown()
+
+
+def test_flush_before_job_write_only_for_the_default_store(tmp_path, engine):
+    tuned = TunedSQLiteJobStore(str(tmp_path / "tuned.db"), flush_interval=60)
+    tuned.write_behind.put("a", put_op("a", "1"))
+    # job 与发送目标走同一个队列, 顺序由队列保证
+    flush_before_job_write(tuned, tuned.write_behind)
+    assert len(tuned.write_behind) == 1
+    tuned.write_behind.close()
+
+    default = SQLAlchemyJobStore(engine=engine)
+    queue = WriteBehindQueue(engine, delay=60)
+    queue.put("a", put_op("a", "1"))
+    flush_before_job_write(default, queue)
+    assert read(engine) == {"a": "1"}
+    queue.close()
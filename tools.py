@@ -1,15 +1,215 @@
+import threading
+import time
+from collections import OrderedDict
+
 from config import conf
 from common.log import logger
 
 
+class _RosterIndex:
+    """
+    名称 -> id 的哈希索引, 由一次完整的通讯录快照构建
+    - 索引总是完整的通讯录快照, 过了 TTL 整体重建
+    - 未命中(负缓存)带 TTL, 最多 max_entries 个, 按 LRU 淘汰
+    - 刷新是 single-flight 的, 并发未命中只会触发一次通讯录拉取
+    - invalidate 之前开始的拉取结果直接丢弃, 重新登录后不会装回上一次登录的快照
+    """
+
+    def __init__(self, kind, fetch, key_fields, ttl=600, negative_ttl=60,
+                 max_entries=4096, min_refresh_interval=30):
+        self.kind = kind
+        # fetch(update: bool) -> list[dict], 返回完整的通讯录列表
+        self._fetch = fetch
+        self._key_fields = key_fields
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.min_refresh_interval = min_refresh_interval
+
+        self._lock = threading.Lock()
+        # name -> id, 每次刷新整体替换
+        self._entries = {}
+        # name -> expires_at, 通讯录里找不到的名称
+        self._negative = OrderedDict()
+        self._built_at = None
+        self._last_update = None
+        self._inflight = None
+        # 每次 invalidate 加一
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.refreshes = 0
+
+    def lookup(self, name):
+        found, value = self._get(name)
+        if found:
+            return value
+
+        # 未命中: 索引未建立或已过期时先用本地快照重建, 不走网络
+        now = time.monotonic()
+        if self._built_at is None or now - self._built_at >= self.ttl:
+            self._refresh(False)
+            found, value = self._get(name, count=False)
+            if found:
+                return value
+
+        # 仍未命中才拉取最新通讯录, 且两次强制刷新之间至少间隔 min_refresh_interval
+        last_update = self._last_update
+        if last_update is None or time.monotonic() - last_update >= self.min_refresh_interval:
+            self._refresh(True)
+            found, value = self._get(name, count=False)
+            if found:
+                return value
+
+        with self._lock:
+            self._negative[name] = time.monotonic() + self.negative_ttl
+            self._negative.move_to_end(name)
+            while len(self._negative) > self.max_entries:
+                self._negative.popitem(last=False)
+        return None
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = {}
+            self._negative.clear()
+            self._built_at = None
+            self._last_update = None
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries) + len(self._negative),
+                "hits": self.hits,
+                "misses": self.misses,
+                "negative_hits": self.negative_hits,
+                "refreshes": self.refreshes,
+            }
+
+    def _get(self, name, count=True):
+        now = time.monotonic()
+        with self._lock:
+            fresh = self._built_at is not None and now - self._built_at < self.ttl
+            item_id = self._entries.get(name) if fresh else None
+            if item_id is not None:
+                if count:
+                    self.hits += 1
+                return True, item_id
+            expires_at = self._negative.get(name)
+            if expires_at is not None and expires_at > now:
+                self._negative.move_to_end(name)
+                if count:
+                    self.negative_hits += 1
+                return True, None
+            if count:
+                self.misses += 1
+            return False, None
+
+    def _refresh(self, update):
+        with self._lock:
+            inflight = self._inflight
+            if inflight is None:
+                inflight = self._inflight = threading.Event()
+                generation = self._generation
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            # 已有线程在拉取, 等待它的结果即可
+            inflight.wait()
+            return
+
+        try:
+            roster = self._fetch(update) or []
+            now = time.monotonic()
+            index = {}
+            for item in roster:
+                item_id = item.get("UserName")
+                if not item_id:
+                    continue
+                for field in self._key_fields:
+                    name = item.get(field)
+                    # 同名时保留第一个, 与原先 search 的行为一致
+                    if name and name not in index:
+                        index[name] = item_id
+            with self._lock:
+                if generation != self._generation:
+                    logger.debug(f"[TaskScheduler] {self.kind} 拉取期间目录已失效, 丢弃这次结果")
+                    return
+                self._entries = index
+                self._built_at = now
+                if update:
+                    self._last_update = now
+                self.refreshes += 1
+            logger.debug(f"[TaskScheduler] {self.kind} 索引已刷新, 共 {len(index)} 项, update={update}")
+        except Exception as e:
+            logger.error(f"[TaskScheduler] 刷新 {self.kind} 通讯录失败: {e}")
+        finally:
+            with self._lock:
+                self._inflight = None
+            inflight.set()
+
+
+class ContactDirectory:
+    """群聊与好友的共享目录, 供 WrappedChannelTools 做昵称到 id 的解析"""
+
+    def __init__(self, channel):
+        self.groups = _RosterIndex(
+            "group",
+            lambda update: channel.get_chatrooms(update=update),
+            ("NickName",),
+        )
+        self.friends = _RosterIndex(
+            "friend",
+            lambda update: channel.get_friends(update=update),
+            ("RemarkName", "NickName"),
+        )
+
+    def configure(self, ttl=None, negative_ttl=None, max_entries=None, min_refresh_interval=None):
+        for index in (self.groups, self.friends):
+            if ttl is not None:
+                index.ttl = ttl
+            if negative_ttl is not None:
+                index.negative_ttl = negative_ttl
+            if max_entries is not None:
+                index.max_entries = max_entries
+            if min_refresh_interval is not None:
+                index.min_refresh_interval = min_refresh_interval
+
+    def invalidate(self):
+        self.groups.invalidate()
+        self.friends.invalidate()
+
+    def stats(self):
+        return {"groups": self.groups.stats(), "friends": self.friends.stats()}
+
+
+_shared_tools = globals().get("_shared_tools")
+_shared_lock = threading.Lock()
+
+
+def get_channel_tools():
+    """进程内共享的 WrappedChannelTools, 目录索引随之共享"""
+    global _shared_tools
+    if _shared_tools is None:
+        with _shared_lock:
+            if _shared_tools is None:
+                _shared_tools = WrappedChannelTools()
+    return _shared_tools
+
+
 class WrappedChannelTools:
     # itchat 的 UserName 其实都是 id
     def __init__(self):
         channel_type = conf().get("channel_type", "wx")
+        self.directory = None
         if channel_type == "wx":
             from lib import itchat
             self.channel = itchat
             self.channel_type = "wx"
+            self.directory = ContactDirectory(itchat)
         elif channel_type == "ntchat":
             try:
                 from channel.wechatnt.ntchat_channel import wechatnt
@@ -19,37 +219,21 @@ class WrappedChannelTools:
                 logger.error(f"未安装ntchat: {e}")
         else:
             raise ValueError(f"不支持的channel_type: {channel_type}")
-    
+
     def get_user_id_by_name(self, name):
-        id = None
         if self.channel_type == "wx":
-            friends =  self.channel.search_friends(name=name)
-            if not friends:
-                self.channel.get_friends(update=True)
-                friends =  self.channel.search_friends(name=name)
-            if not friends:
-                return None
-            return friends[0].get("UserName")
+            return self.directory.friends.lookup(name)
 
         elif self.channel_type == "ntchat":
             pass
 
         raise ValueError(f"不支持的channel_type: {self.channel_type}")
-    
+
 
     # 根据群名称获取群ID
     def get_group_id_by_name(self, name:str):
         if self.channel_type == "wx":
-            groups = self.channel.search_chatrooms(name=name)
-            if not groups:
-                self.channel.get_chatrooms(update=True)
-                groups = self.channel.search_chatrooms(name=name)
-            if not groups:
-                return None
-            for group in groups:
-                if group.get("NickName") == name:
-                    return group.get("UserName")
-            return None
+            return self.directory.groups.lookup(name)
         elif self.channel_type == "ntchat":
             pass
-        raise ValueError(f"不支持的channel_type: {self.channel_type}")
\ No newline at end of file
+        raise ValueError(f"不支持的channel_type: {self.channel_type}")
@@ -0,0 +1,117 @@
+# encoding:utf-8
+import datetime
+import functools
+import hashlib
+import re
+from datetime import timedelta
+from typing import Optional
+
+from apscheduler.triggers.base import BaseTrigger
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+
+WEEKDAYS = {"一": 0, "二": 1, "三": 2, "四": 3, "五": 4, "六": 5, "日": 6}
+RELATIVE_DAYS = {"今天": 0, "明天": 1, "后天": 2}
+
+
+def build_trigger(cycle: str, time_str: Optional[str] = None):
+    """
+    根据周期和时间生成 Trigger, 相同的周期与时间返回同一个对象
+    Trigger 没有可变状态, 可以被多个任务共用; 今天/明天/后天 按当天的日期分别缓存
+    """
+    today = datetime.date.today() if cycle in RELATIVE_DAYS else None
+    return _build_trigger(cycle, time_str, today)
+
+
+@functools.lru_cache(maxsize=1024)
+def _build_trigger(cycle, time_str, today):
+    # 解析 Cron 表达式，例如 "cron[0 8 * * *]"
+    if cycle.startswith("cron[") and cycle.endswith("]"):
+        cron_expr = cycle[5:-1]
+        return CronTrigger.from_crontab(cron_expr)
+
+    # 解析具体日期周期，例如 "2024-12-03"
+    if re.match(r"\d{4}-\d{2}-\d{2}", cycle):
+        if not time_str:
+            raise ValueError("必须提供时间字符串 time_str")
+        date_obj = datetime.datetime.strptime(cycle, "%Y-%m-%d").date()
+        time_obj = datetime.datetime.strptime(time_str, "%H:%M").time()
+        run_date = datetime.datetime.combine(date_obj, time_obj)
+        return DateTrigger(run_date=run_date)
+
+    # 解析今天、明天、后天
+    if cycle in RELATIVE_DAYS:
+        if not time_str:
+            raise ValueError("必须提供时间字符串 time_str")
+        base_date = today + datetime.timedelta(days=RELATIVE_DAYS[cycle])
+        time_obj = datetime.datetime.strptime(time_str, "%H:%M").time()
+        run_date = datetime.datetime.combine(base_date, time_obj)
+        return DateTrigger(run_date=run_date)
+
+    # 解析每周指定日，例如 "每周一"
+    if cycle.startswith("每周"):
+        if not time_str:
+            raise ValueError("必须提供时间字符串 time_str")
+        weekday_name = cycle[2:]
+        if weekday_name not in WEEKDAYS:
+            raise ValueError(f"无效的星期: {weekday_name}")
+        hour, minute = map(int, time_str.split(":"))
+        return CronTrigger(day_of_week=WEEKDAYS[weekday_name], hour=hour, minute=minute)
+
+    # 默认处理每日、工作日等周期
+    if cycle == "每天":
+        if not time_str:
+            raise ValueError("必须提供时间字符串 time_str")
+        hour, minute = map(int, time_str.split(":"))
+        return CronTrigger(hour=hour, minute=minute)
+    if cycle == "工作日":
+        if not time_str:
+            raise ValueError("必须提供时间字符串 time_str")
+        hour, minute = map(int, time_str.split(":"))
+        return CronTrigger(day_of_week="mon-fri", hour=hour, minute=minute)
+
+    # 无法匹配的周期规则
+    raise ValueError(f"无法解析周期: {cycle}")
+
+
+def jitter_offset(task_id: str, window: int) -> int:
+    """根据任务编号得到 [0, window] 秒内确定的偏移, 重启后也不会变化"""
+    if window <= 0:
+        return 0
+    digest = hashlib.sha1(task_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") % (int(window) + 1)
+
+
+class OffsetTrigger(BaseTrigger):
+    """
+    把另一个 Trigger 的每次触发时间整体推后 offset 秒
+    用来把同一时刻(比如每天 08:00)的大量任务错开, 每个任务的偏移是固定的
+    """
+
+    __slots__ = ("trigger", "offset")
+
+    def __init__(self, trigger, offset):
+        self.trigger = trigger
+        self.offset = int(offset)
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        delta = timedelta(seconds=self.offset)
+        if previous_fire_time is not None:
+            previous_fire_time = previous_fire_time - delta
+        next_fire_time = self.trigger.get_next_fire_time(previous_fire_time, now - delta)
+        return next_fire_time + delta if next_fire_time is not None else None
+
+    def __getstate__(self):
+        return {"version": 1, "trigger": self.trigger, "offset": self.offset}
+
+    def __setstate__(self, state):
+        if state.get("version", 1) > 1:
+            raise ValueError(f"Got serialized data for version {state['version']} of OffsetTrigger")
+        self.trigger = state["trigger"]
+        self.offset = state["offset"]
+
+    def __str__(self):
+        return f"{self.trigger} +{self.offset}s"
+
+    def __repr__(self):
+        return f"<OffsetTrigger ({self.trigger!r}, offset={self.offset})>"